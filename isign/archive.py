@@ -6,20 +6,35 @@
 import abc
 import biplist
 from bundle import IosApp
+import code_resources
 from exceptions import MissingHelpers, NotSignable, NotMatched
 from distutils import spawn
 import logging
 import os
-from os.path import abspath, dirname, exists, isdir, isfile, join, normpath
+from os.path import abspath, dirname, exists, isdir, isfile, islink, join, lexists, normpath, relpath, samefile
 import tempfile
 import re
-from subprocess import call
+import scratch
 import shutil
+import staging
+import utils
 import zipfile
+import zip_reader
+import zip_writer
 
 helper_paths = {}
 log = logging.getLogger(__name__)
 
+# Info.plists of bundles nested inside an app, relative to the app
+NESTED_INFO_PLIST_PATTERN = re.compile(
+    r'^((?:.+/)?(?:PlugIns/[^/]+\.appex|Frameworks/[^/]+\.framework|Watch/[^/]+\.app))/Info\.plist$')
+PROVISIONING_PROFILE_FILENAME = 'embedded.mobileprovision'
+
+# extra keys view() can add to the Info.plist of the app
+VIEW_NESTED_BUNDLES_KEY = 'isignNestedBundles'
+VIEW_PROVISIONING_PROFILE_KEY = 'isignProvisioningProfile'
+PROVISIONING_PROFILE_VIEW_KEYS = ['Name', 'UUID', 'TeamIdentifier', 'ExpirationDate', 'Entitlements']
+
 
 def get_helper(helper_name):
     """ find paths to executables. Cached in helper_paths """
@@ -32,8 +47,33 @@ def get_helper(helper_name):
     return helper_paths[helper_name]
 
 
-def make_temp_dir():
-    return tempfile.mkdtemp(prefix="isign-")
+def make_temp_dir(size=0):
+    """ A scratch directory, with room for size bytes """
+    return scratch.get_scratch_space().mkdtemp(size)
+
+
+def estimate_scratch_size(sizes):
+    """ Space needed to unarchive files of these sizes, and to sign them, which
+        may mean a temporary copy of the largest """
+    return sum(sizes) + max(sizes or [0])
+
+
+def get_provisioning_profile_view(profile_data):
+    """ The interesting parts of a provisioning profile. The profile is a signed
+        plist; we just want to look at it, so we don't verify the signature,
+        we just find the plist inside """
+    start = profile_data.find('<?xml')
+    end = profile_data.find('</plist>')
+    if start == -1 or end == -1:
+        return None
+    profile = biplist.readPlistFromString(profile_data[start:end + len('</plist>')])
+    profile_view = {}
+    for key in PROVISIONING_PROFILE_VIEW_KEYS:
+        if key in profile:
+            profile_view[key] = profile[key]
+    if 'ExpirationDate' in profile_view:
+        profile_view['ExpirationDate'] = profile_view['ExpirationDate'].isoformat()
+    return profile_view
 
 
 class Archive(object):
@@ -43,13 +83,22 @@ class Archive(object):
     # methods we want to ensure are implemented.
 
     @abc.abstractmethod
-    def unarchive_to_temp(self):
-        """ Unarchive and copy to a temp directory """
+    def unarchive_to_temp(self, selective=False):
+        """ Unarchive and copy to a temp directory. If selective, zipped archives
+            leave the files that resigning won't touch in the archive """
         pass
 
     @abc.abstractmethod
-    def archive(cls, path, output_path):
-        """ Archive a directory to an output path """
+    def get_scratch_size(self, selective=False):
+        """ Roughly how much scratch space unarchive_to_temp and resigning will
+            need, worked out without unarchiving """
+        pass
+
+    @abc.abstractmethod
+    def archive(cls, path, output_path, manifest=None, compression_policy=None):
+        """ Archive a directory to an output path. If the directory was extracted
+            from an archive, manifest says what was extracted. compression_policy
+            is a zip_writer.CompressionPolicy, for archives that compress """
         pass
 
     @abc.abstractmethod
@@ -58,8 +107,9 @@ class Archive(object):
         pass
 
     @abc.abstractmethod
-    def precheck(cls, path):
-        """ Check if this is, in fact, an archive of this type """
+    def precheck(cls, path, index=None):
+        """ Check if this is, in fact, an archive of this type. If path is a
+            zip file, index may be a zip_reader.ZipIndex of it """
         pass
 
     @abc.abstractmethod
@@ -67,6 +117,58 @@ class Archive(object):
         """ Locate the directory of the main app (aka bundle) """
         pass
 
+    @abc.abstractmethod
+    def list_bundle_files(self):
+        """ Paths of all the files in the app, relative to the app """
+        pass
+
+    @abc.abstractmethod
+    def read_bundle_file(self, relative_path):
+        """ Contents of a file in the app, without unarchiving """
+        pass
+
+    @abc.abstractmethod
+    def open_bundle_file(self, relative_path):
+        """ A file object to read a file in the app, without unarchiving.
+            For when we only want the beginning of a large file """
+        pass
+
+    def close(self):
+        """ Release anything we hold open to read the archive, like its zip file """
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get_details(self):
+        """ Information about the app beyond its Info.plist: nested bundles
+            and provisioning profiles, all read without unarchiving """
+        details = {}
+        names = set(self.list_bundle_files())
+        if PROVISIONING_PROFILE_FILENAME in names:
+            details[VIEW_PROVISIONING_PROFILE_KEY] = get_provisioning_profile_view(
+                self.read_bundle_file(PROVISIONING_PROFILE_FILENAME))
+        nested_bundles = []
+        for name in sorted(names):
+            matched = NESTED_INFO_PLIST_PATTERN.match(name)
+            if not matched:
+                continue
+            nested_path = matched.group(1)
+            nested_bundle = {
+                'path': nested_path,
+                'info': biplist.readPlistFromString(self.read_bundle_file(name))
+            }
+            profile_name = join(nested_path, PROVISIONING_PROFILE_FILENAME)
+            if profile_name in names:
+                nested_bundle['provisioning_profile'] = get_provisioning_profile_view(
+                    self.read_bundle_file(profile_name))
+            nested_bundles.append(nested_bundle)
+        details[VIEW_NESTED_BUNDLES_KEY] = nested_bundles
+        return details
+
 
 class AppArchive(Archive):
     """ The simplest form of archive -- a naked IosApp Bundle, with no extra directory structure,
@@ -87,7 +189,7 @@ class AppArchive(Archive):
         return biplist.readPlist(cls._get_plist_path(path))
 
     @classmethod
-    def precheck(cls, path):
+    def precheck(cls, path, index=None):
         if not isdir(path):
             return False
         if not os.path.exists(cls._get_plist_path(path)):
@@ -98,22 +200,51 @@ class AppArchive(Archive):
         return is_native
 
     @classmethod
-    def archive(cls, path, output_path):
+    def archive(cls, path, output_path, manifest=None, compression_policy=None):
         if exists(output_path):
             shutil.rmtree(output_path)
+        # files staged as hard links still share their data with the original
+        # app. If that was at output_path, they don't any more
+        staging.break_links(path)
         shutil.move(path, output_path)
         log.info("archived %s to %s" % (cls.__name__, output_path))
 
-    def __init__(self, path):
+    def __init__(self, path, index=None):
         self.path = path
         self.relative_bundle_dir = '.'
         self.bundle_info = self.get_info(self.path)
 
-    def unarchive_to_temp(self):
-        containing_dir = make_temp_dir()
+    def list_bundle_files(self):
+        for root, _, filenames in os.walk(self.path):
+            for filename in filenames:
+                yield relpath(join(root, filename), self.path)
+
+    def read_bundle_file(self, relative_path):
+        with self.open_bundle_file(relative_path) as f:
+            return f.read()
+
+    def open_bundle_file(self, relative_path):
+        return open(join(self.path, relative_path), 'rb')
+
+    def get_scratch_size(self, selective=False):
+        sizes = []
+        for relative_path in self.list_bundle_files():
+            path = join(self.path, relative_path)
+            if islink(path) or (selective and not staging.is_mutable(path, relative_path)):
+                continue
+            sizes.append(os.path.getsize(path))
+        return estimate_scratch_size(sizes)
+
+    def unarchive_to_temp(self, selective=False):
+        """ If selective, files that resigning won't change are cloned or
+            hard linked from the original app, rather than copied """
+        containing_dir = make_temp_dir(self.get_scratch_size(selective))
         log.debug("unarchiving to temp... %s -> %s", self.path, containing_dir)
         shutil.rmtree(containing_dir)  # quirk of copytree, top dir can't exist already
-        shutil.copytree(self.path, containing_dir)
+        if selective:
+            staging.stage(self.path, containing_dir)
+        else:
+            shutil.copytree(self.path, containing_dir)
         return UncompressedArchive(containing_dir, '.', self.__class__)
 
 
@@ -122,7 +253,7 @@ class AppZipArchive(Archive):
         should be re-zipped. """
     app_dir_pattern = r'^([^/]+\.app/).*$'
     extensions = ['.zip']
-    helpers = ['zip', 'unzip']
+    helpers = []
 
     @classmethod
     def is_helpers_present(cls):
@@ -146,12 +277,14 @@ class AppZipArchive(Archive):
         return False
 
     @classmethod
-    def find_bundle_dir(cls, zipfile_obj):
+    def find_bundle_dir(cls, index):
+        """ Find the app in a zip_reader.ZipIndex. Apps are only ever a
+            directory or two deep, so we only need to look at those prefixes,
+            not every name in the archive """
         relative_bundle_dir = None
         apps = set()
-        file_list = zipfile_obj.namelist()
-        for file_name in file_list:
-            matched = re.match(cls.app_dir_pattern, file_name)
+        for prefix in index.dir_prefixes:
+            matched = re.match(cls.app_dir_pattern, prefix)
             if matched:
                 apps.add(matched.group(1))
         if len(apps) == 1:
@@ -168,10 +301,11 @@ class AppZipArchive(Archive):
         return join(relative_bundle_dir, "Info.plist")
 
     @classmethod
-    def precheck(cls, path):
+    def precheck(cls, path, index=None):
         """ Checks if an archive looks like this kind of app. Have to examine
             within the zipfile, b/c we don't want to make temp dirs just yet. This
-            recapitulates a very similar precheck in the Bundle class """
+            recapitulates a very similar precheck in the Bundle class.
+            If we already have a zip_reader.ZipIndex of the archive, use that """
         if not isfile(path):
             return False
         if not cls.is_helpers_present():
@@ -179,62 +313,116 @@ class AppZipArchive(Archive):
         is_native = False
         log.debug('precheck')
         log.debug('path: %s', path)
-        if (cls.is_archive_extension_match(path) and
-                zipfile.is_zipfile(path)):
+        if cls.is_archive_extension_match(path) and (index is not None or zipfile.is_zipfile(path)):
             log.debug("this is an archive, and a zipfile")
-            zipfile_obj = zipfile.ZipFile(path)
-            relative_bundle_dir = cls.find_bundle_dir(zipfile_obj)
-            if relative_bundle_dir is not None:
-                plist_path = cls._get_plist_path(relative_bundle_dir)
-                if plist_path not in zipfile_obj.namelist():
-                    return False
-                plist = cls.get_info(relative_bundle_dir, zipfile_obj)
-                is_native = IosApp.is_native(plist)
+            own_index = index is None
+            if own_index:
+                index = zip_reader.ZipIndex(path)
+            try:
+                relative_bundle_dir = cls.find_bundle_dir(index)
+                if relative_bundle_dir is not None:
+                    plist_path = cls._get_plist_path(relative_bundle_dir)
+                    if plist_path not in index.names:
+                        return False
+                    plist = cls.get_info(relative_bundle_dir, index)
+                    is_native = IosApp.is_native(plist)
+            finally:
+                if own_index:
+                    index.close()
         log.debug("is_native: {}".format(is_native))
         return is_native
 
     @classmethod
-    def get_info(cls, relative_bundle_dir, zipfile_obj):
+    def get_info(cls, relative_bundle_dir, index):
         plist_path = cls._get_plist_path(relative_bundle_dir)
-        plist_bytes = zipfile_obj.read(plist_path)
+        plist_bytes = index.read(plist_path)
         return biplist.readPlistFromString(plist_bytes)
 
-    def __init__(self, path):
+    def __init__(self, path, index=None):
+        """ The archive owns index, if given, and closes it in close() """
         self.path = path
-        zipfile_obj = zipfile.ZipFile(path)
-        self.relative_bundle_dir = self.find_bundle_dir(zipfile_obj)
-        self.bundle_info = self.get_info(self.relative_bundle_dir,
-                                         zipfile_obj)
-
-    def unarchive_to_temp(self):
-        containing_dir = make_temp_dir()
-        call([get_helper('unzip'), "-qu", self.path, "-d", containing_dir])
-        app_dir = abspath(join(containing_dir, self.relative_bundle_dir))
-        return UncompressedArchive(containing_dir, self.relative_bundle_dir, self.__class__)
+        if index is None:
+            index = zip_reader.ZipIndex(path)
+        self.index = index
+        try:
+            self.relative_bundle_dir = self.find_bundle_dir(index)
+            self.bundle_info = self.get_info(self.relative_bundle_dir, index)
+        except Exception:
+            index.close()
+            raise
+
+    def close(self):
+        # extracting shares the index's zip file with the Manifest, so only
+        # close this once we're done archiving too
+        self.index.close()
+
+    def list_bundle_files(self):
+        for name in self.index.names:
+            if name.startswith(self.relative_bundle_dir) and not name.endswith('/'):
+                yield name[len(self.relative_bundle_dir):]
+
+    def read_bundle_file(self, relative_path):
+        return self.index.read(self.relative_bundle_dir + relative_path)
+
+    def open_bundle_file(self, relative_path):
+        return self.index.zipfile_obj.open(self.relative_bundle_dir + relative_path)
+
+    def get_scratch_size(self, selective=False):
+        sizes = [zinfo.file_size for zinfo in self.index.zipfile_obj.infolist()
+                 if not selective or zip_reader.may_be_mutable(zinfo)]
+        return estimate_scratch_size(sizes)
+
+    def unarchive_to_temp(self, selective=False):
+        containing_dir = make_temp_dir(self.get_scratch_size(selective))
+        manifest = zip_reader.extract(self.path, containing_dir,
+                                      selective=selective,
+                                      index=self.index)
+        return UncompressedArchive(containing_dir,
+                                   self.relative_bundle_dir,
+                                   self.__class__,
+                                   manifest)
 
     @classmethod
-    def archive(cls, containing_dir, output_path):
+    def archive(cls, containing_dir, output_path, manifest=None, compression_policy=None):
         """ archive this up into a zipfile. Note this is a classmethod, because
-            the caller will use us on a temp directory somewhere """
-        # the temp file is necessary because zip always adds ".zip" if it
-        # does not have an extension. But we want to respect the desired
-        # output_path's extension, which could be ".ipa" or who knows.
-        # So we move it to the output_path later.
-        #
-        # We also do a little dance with making another temp directory just
-        # to construct the zip file. This is the best way to ensure the an unused
-        # filename. Also, `zip` won't overwrite existing files, so this is safer.
-        temp_zip_dir = None
+            the caller will use us on a temp directory somewhere.
+
+            If we have a manifest of what was originally extracted, members that
+            weren't changed are copied from the original zipfile as they are,
+            and only the files that resigning rewrote are compressed again.
+            compression_policy says how to compress those; by default they are
+            deflated like `zip` would.
+
+            If output_path is the original zipfile, it is updated in place, and
+            the members that weren't changed aren't even copied. """
+        if manifest is not None and exists(output_path) and samefile(manifest.zip_path, output_path):
+            zip_writer.update_archive(containing_dir, manifest, compression_policy)
+            log.info("archived %s to %s in place" % (cls.__name__, output_path))
+            return
+
+        # We build the zip file in a temp file next to the output_path, and rename
+        # it into place later. The output_path could be the original archive,
+        # which we might still be copying members from. And this way we never
+        # leave a partially written archive at the output_path. Being next to it,
+        # the temp file is on the same filesystem, so it doesn't take up scratch
+        # space, and renaming it doesn't mean copying it.
+        temp_zip_fd, temp_zip_file = tempfile.mkstemp(prefix=".isign-zip-",
+                                                      dir=dirname(abspath(output_path)))
+        # mkstemp makes it readable only by us. Give it the mode that
+        # opening output_path to write it would have
+        os.fchmod(temp_zip_fd, 0o666 & ~utils.get_umask())
+        os.close(temp_zip_fd)
         try:
-            # need to chdir and use relative paths, because zip is stupid
-            temp_zip_dir = tempfile.mkdtemp(prefix="isign-zip-")
-            temp_zip_file = join(temp_zip_dir, 'temp.zip')
-            call([get_helper('zip'), "-qr", temp_zip_file, "."], cwd=containing_dir)
+            if manifest is not None:
+                zip_writer.write_archive(containing_dir, temp_zip_file, manifest,
+                                         compression_policy)
+            else:
+                zip_writer.write_directory(containing_dir, temp_zip_file, compression_policy)
             shutil.move(temp_zip_file, output_path)
             log.info("archived %s to %s" % (cls.__name__, output_path))
         finally:
-            if temp_zip_dir is not None and isdir(temp_zip_dir):
-                shutil.rmtree(temp_zip_dir)
+            if exists(temp_zip_file):
+                os.unlink(temp_zip_file)
 
 
 class IpaArchive(AppZipArchive):
@@ -253,64 +441,83 @@ class UncompressedArchive(object):
         This class is also useful if you have an app that's already unzipped and
         you want to sign it. """
 
-    def __init__(self, path, relative_bundle_dir, archive_class):
+    def __init__(self, path, relative_bundle_dir, archive_class, manifest=None):
         """ Path is the "Containing dir", the dir at the root level of the unzipped archive
                 (or the dir itself, in the case of an AppArchive archive)
             relative bundle dir is the dir containing the bundle, e.g. Payload/Foo.app
-            archive class is the kind of archive this was (Ipa, etc.) """
+            archive class is the kind of archive this was (Ipa, etc.)
+            manifest, if any, is the zip_reader.Manifest of what was extracted """
         self.path = path
         self.relative_bundle_dir = relative_bundle_dir
         self.archive_class = archive_class
+        self.manifest = manifest
         bundle_path = normpath(join(path, relative_bundle_dir))
-        self.bundle = IosApp(bundle_path)
+        # it's in scratch space, so patches to it needn't survive a crash
+        self.bundle = IosApp(bundle_path, manifest, durable=False)
 
-    def archive(self, output_path):
+    def archive(self, output_path, compression_policy=None):
         """ Re-zip this back up, or simply copy it out, depending on what the
             original archive class did """
-        self.archive_class.archive(self.path, output_path)
+        self.archive_class.archive(self.path, output_path, self.manifest, compression_policy)
 
     def clone(self, target_path):
         """ Copy the uncompressed archive somewhere else, return initialized
             UncompressedArchive """
-        shutil.copytree(self.path, target_path)
+        shutil.copytree(self.path, target_path, symlinks=True)
+        manifest = None
+        if self.manifest is not None:
+            manifest = self.manifest.clone(target_path)
         return self.__class__(target_path,
                               self.relative_bundle_dir,
-                              self.archive_class)
+                              self.archive_class,
+                              manifest)
 
     def remove(self):
         # the containing dir might be gone already b/c AppArchive simply moves
-        # it to the desired target when done
-        if exists(self.path) and isdir(self.path):
-            log.debug('removing ua: %s', self.path)
-            shutil.rmtree(self.path)
+        # it to the desired target when done. Either way, we release its space
+        log.debug('removing ua: %s', self.path)
+        scratch.get_scratch_space().remove(self.path)
+        code_resources.get_digest_cache().discard_tree(self.path)
 
 
 def archive_factory(path):
     """ Guess what kind of archive we are dealing with, return an
         archive object. Returns None if path did not match any archive type """
     archive = None
-    for cls in [IpaArchive, AppZipArchive, AppArchive]:
-        if cls.precheck(path):
-            archive = cls(path)
-            log.debug("File %s matched as %s", path, cls.__name__)
-            break
+    # read the central directory of a zip file just once, for every check
+    index = None
+    if isfile(path) and lexists(zip_writer.get_recovery_path(path)):
+        # we only read it, so leave recovering it to whoever updates it next
+        log.warning("%s is being updated in place, or its update was interrupted. "
+                    "Resign it in place again to recover it", path)
+    if isfile(path) and zipfile.is_zipfile(path):
+        index = zip_reader.ZipIndex(path)
+    try:
+        for cls in [IpaArchive, AppZipArchive, AppArchive]:
+            if cls.precheck(path, index):
+                # the archive now owns the index, and closes it
+                archive = cls(path, index)
+                log.debug("File %s matched as %s", path, cls.__name__)
+                break
+    finally:
+        if archive is None and index is not None:
+            index.close()
     return archive
 
 
-def view(input_path):
+def view(input_path, details=False):
+    """ The Info.plist of the app, read without unarchiving it. If details,
+        also nested bundles and provisioning profiles, under extra keys """
     if not exists(input_path):
         raise IOError("{0} not found".format(input_path))
-    ua = None
-    bundle_info = None
-    try:
-        archive = archive_factory(input_path)
-        if archive is None:
-            raise NotMatched('No matching archive type found')
-        ua = archive.unarchive_to_temp()
-        bundle_info = ua.bundle.info
-    finally:
-        if ua is not None:
-            ua.remove()
+    archive = archive_factory(input_path)
+    if archive is None:
+        raise NotMatched('No matching archive type found')
+    with archive:
+        bundle_info = archive.bundle_info
+        if details:
+            bundle_info = dict(bundle_info)
+            bundle_info.update(archive.get_details())
     return bundle_info
 
 
@@ -319,27 +526,54 @@ def resign(input_path,
            cms_signer,
            provisioner,
            output_path,
-           info_props=None):
+           info_props=None,
+           compression_policy=None,
+           reuse=code_resources.REUSE_NEVER):
     """ Unified interface to extract any kind of archive from
         a temporary file, resign it with these credentials,
-        and create a similar archive for that resigned app """
+        and create a similar archive for that resigned app.
+        compression_policy is a zip_writer.CompressionPolicy, for
+        zipped archives. reuse says how far to trust the hashes in the
+        app's existing seals; see code_resources.make_seal """
 
     if not exists(input_path):
         raise IOError("{0} not found".format(input_path))
 
+    if isfile(input_path) and exists(output_path) and samefile(input_path, output_path):
+        # updating it in place: no other process may do so until we're done,
+        # and if we died while updating it last time, undo that first
+        with zip_writer.ArchiveLock(input_path):
+            zip_writer.recover_archive(input_path)
+            return _resign(input_path, deep, cms_signer, provisioner, output_path,
+                           info_props, compression_policy, reuse)
+    return _resign(input_path, deep, cms_signer, provisioner, output_path,
+                   info_props, compression_policy, reuse)
+
+
+def _resign(input_path,
+            deep,
+            cms_signer,
+            provisioner,
+            output_path,
+            info_props=None,
+            compression_policy=None,
+            reuse=code_resources.REUSE_NEVER):
+    """ resign, with an archive we update in place locked """
+    archive = None
     ua = None
     bundle_info = None
     try:
         archive = archive_factory(input_path)
         if archive is None:
             raise NotSignable('No matching archive type found')
-        ua = archive.unarchive_to_temp()
+        # we only need the files that resigning rewrites on disk
+        ua = archive.unarchive_to_temp(selective=True)
         if info_props:
             # Override info.plist props of the parent bundle
             ua.bundle.update_info_props(info_props)
-        ua.bundle.resign(deep, cms_signer, provisioner)
+        ua.bundle.resign(deep, cms_signer, provisioner, reuse)
         bundle_info = ua.bundle.info
-        ua.archive(output_path)
+        ua.archive(output_path, compression_policy)
     except NotSignable as e:
         msg = "Not signable: <{0}>: {1}\n".format(input_path, e)
         log.info(msg)
@@ -347,4 +581,6 @@ def resign(input_path,
     finally:
         if ua is not None:
             ua.remove()
+        if archive is not None:
+            archive.close()
     return bundle_info
@@ -14,11 +14,13 @@ import code_resources
 from exceptions import NotMatched
 import copy
 import glob
+from ledger import WriteLedger
 import logging
 import os
 from os.path import basename, exists, join, splitext
 import signable
 import shutil
+import utils
 
 log = logging.getLogger(__name__)
 
@@ -45,10 +47,19 @@ class Bundle(object):
                 any(map(lambda p: p in plist['CFBundleSupportedPlatforms'], platforms))
         )
 
-    def __init__(self, path, native_platforms):
+    def __init__(self, path, native_platforms, manifest=None, ledger=None, durable=True):
         self.path = path
         self.info_path = join(self.path, 'Info.plist')
         self.native_platforms = native_platforms  # TODO extract this from CFBundleSupportedPlatforms?
+        # if we came from an archive, the zip_reader.Manifest of what was extracted
+        self.manifest = manifest
+        # what we write while resigning; shared with bundles nested in this one
+        if ledger is None:
+            ledger = WriteLedger()
+        self.ledger = ledger
+        # whether files we patch must survive a crash. A bundle in a scratch
+        # directory is thrown away if we fail, so it needn't
+        self.durable = durable
         if not exists(self.info_path):
             raise NotMatched("no Info.plist found; probably not a bundle")
         self.info = biplist.readPlist(self.info_path)
@@ -110,6 +121,8 @@ class Bundle(object):
                 changed = True
 
         if changed:
+            self.ledger.record(self.info_path)
+            utils.break_link(self.info_path)
             biplist.writePlist(self.info, self.info_path, binary=True)
         else:
             self.orig_info = None
@@ -134,9 +147,10 @@ class Bundle(object):
             dylib = signable.Dylib(self, dylib_path, cms_signer)
             dylib.sign(self, cms_signer)
 
-    def resign(self, deep, cms_signer, provisioner):
+    def resign(self, deep, cms_signer, provisioner, reuse=code_resources.REUSE_NEVER):
         """ Sign everything in this bundle, in place.  If deep is specified, sign
-            recursively with sub-bundles """
+            recursively with sub-bundles. reuse says how far to trust the hashes
+            in the bundles' existing seals; see code_resources.make_seal """
         # log.debug("SIGNING: %s" % self.path)
         if deep:
             plugins_path = join(self.path, 'PlugIns')
@@ -148,8 +162,9 @@ class Bundle(object):
                     # Appexes are essentially the same as app bundles, for signing purposes
                     # They could be a different class, but there aren't any differences yet noted.
                     # They will have the same OS (e.g. iOS, Watch) as their parent
-                    appex = self.__class__(appex_path)
-                    appex.resign(deep, cms_signer, provisioner)
+                    appex = self.__class__(appex_path, manifest=self.manifest, ledger=self.ledger,
+                                           durable=self.durable)
+                    appex.resign(deep, cms_signer, provisioner, reuse)
 
             frameworks_path = join(self.path, 'Frameworks')
             if exists(frameworks_path):
@@ -159,9 +174,10 @@ class Bundle(object):
                     framework_path = join(frameworks_path, framework_name)
                     # log.debug("checking for framework: %s" % framework_path)
                     try:
-                        framework = Framework(framework_path, self.native_platforms)
+                        framework = Framework(framework_path, self.native_platforms, self.manifest,
+                                              self.ledger, self.durable)
                         # log.debug("resigning: %s" % framework_path)
-                        framework.resign(deep, cms_signer, provisioner)
+                        framework.resign(deep, cms_signer, provisioner, reuse)
                     except NotMatched:
                         # log.debug("not a framework: %s" % framework_path)
                         continue
@@ -174,7 +190,10 @@ class Bundle(object):
         # then create the seal
         # TODO maybe the app should know what its seal path should be...
         self.seal_path = code_resources.make_seal(self.get_executable_path(),
-                                                  self.path)
+                                                  self.path,
+                                                  self.manifest,
+                                                  ledger=self.ledger,
+                                                  reuse=reuse)
 
         # then sign the executable
         executable = self.signable_class(self, self.get_executable_path(), cms_signer)
@@ -201,22 +220,24 @@ class App(Bundle):
     # executable of an app)
     signable_class = signable.Executable
 
-    def __init__(self, path, native_platforms):
+    def __init__(self, path, native_platforms, manifest=None, ledger=None, durable=True):
         self.entitlements = None    # this is a bit ugly, but we have to communicate this down to Codesig
-        super(App, self).__init__(path, native_platforms)
+        super(App, self).__init__(path, native_platforms, manifest, ledger, durable)
 
     def provision(self, team_id, provisioner):
         identifier = '.'.join([team_id, self.get_bundle_id()])
         provisioning_profile_path = provisioner.get_provisioning_profile(identifier)
         target_path = join(self.path, 'embedded.mobileprovision')
         log.debug("provisioning from {} to {}".format(provisioning_profile_path, target_path))
+        self.ledger.record(target_path)
+        utils.break_link(target_path)
         shutil.copyfile(provisioning_profile_path, target_path)
 
     def entitle(self, team_id, provisioner):
         identifier = '.'.join([team_id, self.get_bundle_id()])
         self.entitlements = provisioner.get_entitlements(identifier)
 
-    def resign(self, deep, cms_signer, provisioner):
+    def resign(self, deep, cms_signer, provisioner, reuse=code_resources.REUSE_NEVER):
         """ signs app in place """
         # In the typical case, we add entitlements from the pprof into the app's signature
         if not cms_signer.is_adhoc():
@@ -225,7 +246,7 @@ class App(Bundle):
             self.entitle(team_id, provisioner)
 
         # actually resign this bundle now
-        super(App, self).resign(deep, cms_signer, provisioner)
+        super(App, self).resign(deep, cms_signer, provisioner, reuse)
 
 
 class WatchApp(App):
@@ -234,8 +255,8 @@ class WatchApp(App):
     # possible values for CFBundleSupportedPlatforms
     native_platforms = ['WatchOS', 'WatchSimulator']
 
-    def __init__(self, path):
-        super(WatchApp, self).__init__(path, self.native_platforms)
+    def __init__(self, path, manifest=None, ledger=None, durable=True):
+        super(WatchApp, self).__init__(path, self.native_platforms, manifest, ledger, durable)
 
 
 class IosApp(App):
@@ -255,18 +276,18 @@ class IosApp(App):
     def is_native(cls, info):
         return cls.has_platform(info, cls.native_platforms)
 
-    def __init__(self, path):
-        super(IosApp, self).__init__(path, self.native_platforms)
+    def __init__(self, path, manifest=None, ledger=None, durable=True):
+        super(IosApp, self).__init__(path, self.native_platforms, manifest, ledger, durable)
 
-    def sign_watch_apps(self, deep, cms_signer, provisioner):
+    def sign_watch_apps(self, deep, cms_signer, provisioner, reuse=code_resources.REUSE_NEVER):
         watch_apps_path = join(self.path, 'Watch')
         if exists(watch_apps_path):
             watch_app_paths = glob.glob(join(watch_apps_path, '*.app'))
             for watch_app_path in watch_app_paths:
                 log.debug("found Watch app at {}".format(watch_app_path))
-                watch_app = WatchApp(watch_app_path)
-                watch_app.resign(deep, cms_signer, provisioner)
+                watch_app = WatchApp(watch_app_path, self.manifest, self.ledger, self.durable)
+                watch_app.resign(deep, cms_signer, provisioner, reuse)
 
-    def resign(self, deep, cms_signer, provisioner):
-        self.sign_watch_apps(deep, cms_signer, provisioner)
-        super(IosApp, self).resign(deep, cms_signer, provisioner)
+    def resign(self, deep, cms_signer, provisioner, reuse=code_resources.REUSE_NEVER):
+        self.sign_watch_apps(deep, cms_signer, provisioner, reuse)
+        super(IosApp, self).resign(deep, cms_signer, provisioner, reuse)
@@ -1,18 +1,45 @@
 import binascii
+import collections
 import copy
-import hashlib
+import hash_cache
+from ledger import WriteLedger
 import logging
-from memoizer import memoize
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import os
 import plistlib
 from plistlib import PlistWriter
 import re
+import threading
+import utils
+import zip_reader
 
 OUTPUT_DIRECTORY = '_CodeSignature'
 OUTPUT_FILENAME = 'CodeResources'
 TEMPLATE_FILENAME = 'code_resources_template.xml'
 # DIGEST_ALGORITHM = "sha1"
-HASH_BLOCKSIZE = 65536
+
+# hashlib and file I/O release the GIL, so threads are enough to keep
+# every core busy while hashing
+MAX_WORKERS = multiprocessing.cpu_count()
+# Files smaller than this are hashed in batches, since for them handing
+# out a task costs about as much as hashing
+SMALL_FILE_SIZE = 64 * 1024
+SMALL_FILE_BATCH = 64
+
+# How many files' digests we keep in memory, e.g. so that the files of a
+# framework aren't hashed again for the seal of the app around it
+DIGEST_CACHE_ENTRIES = 100000
+
+# How far to trust the hashes in a bundle's existing seal, for files we didn't
+# write while resigning. With REUSE_IF_OLDER, the file must also be older than
+# the seal. With REUSE_IF_UNWRITTEN, every write since the seal was made
+# must be in the ledger. REUSE_NEVER hashes every file, and is the default:
+# the seal and the files' times come from whoever made the app, so reuse is
+# only safe for apps from a trusted source.
+REUSE_NEVER = 'never'
+REUSE_IF_OLDER = 'older'
+REUSE_IF_UNWRITTEN = 'unwritten'
 
 log = logging.getLogger(__name__)
 
@@ -88,28 +115,259 @@ class PathRule(object):
         return 'PathRule:' + str(self.flags) + ':' + str(self.weight)
 
 
+class RuleMatcher(object):
+    """ Finds the rule for a path: the first exclusion rule that matches, or
+        else the heaviest rule that matches, the earliest one if there's a tie.
+        Otherwise the default rule.
+
+        Rather than trying every rule against every path, we put the rules in
+        that order, and compile them into one alternation. Its first branch that
+        matches is the rule we want. If the patterns can't be combined safely,
+        we try them one by one, in the same order, until one matches """
+
+    # backreferences, conditionals and global inline flags would mean
+    # something else once patterns are combined
+    UNCOMBINABLE_RE = re.compile(r'\\[1-9]|\(\?P=|\(\?\(|\(\?[iLmsux]+\)')
+    GROUP_PREFIX = '_rule'
+
+    def __init__(self, rules, default_rule):
+        self.default_rule = default_rule
+        exclusions = [rule for rule in rules if rule.flags and rule.is_exclusion()]
+        # a rule that's no heavier than the default can never be chosen over it
+        weighted = [rule for rule in rules
+                    if not rule.is_exclusion() and rule.weight > default_rule.weight]
+        # sorting is stable, so earlier rules still win ties
+        weighted.sort(key=lambda rule: rule.weight, reverse=True)
+        self.rules = exclusions + weighted
+        self.pattern = None
+        patterns = [rule.pattern.pattern for rule in self.rules]
+        if not any(self.UNCOMBINABLE_RE.search(pattern) for pattern in patterns):
+            branches = ['(?P<{}{}>{})'.format(self.GROUP_PREFIX, i, pattern)
+                        for i, pattern in enumerate(patterns)]
+            try:
+                self.pattern = re.compile('|'.join(branches), re.IGNORECASE)
+            except (re.error, AssertionError, OverflowError) as e:
+                # e.g. too many groups, or clashing group names
+                log.debug("can't combine resource rules, matching one by one: %s", e)
+
+    def match(self, path):
+        if self.pattern is None:
+            for rule in self.rules:
+                if rule.matches(path):
+                    return rule
+            return self.default_rule
+        match = self.pattern.match(path)
+        if match is None:
+            return self.default_rule
+        # the branch that matched is the group that closed last
+        return self.rules[int(match.lastgroup[len(self.GROUP_PREFIX):])]
+
+
+def get_data(entry, key):
+    """ Binary data from an entry in a seal, which is either just a Data
+        element, or a dict of them """
+    if isinstance(entry, plistlib.Data):
+        entry = {'hash': entry}
+    if isinstance(entry, dict) and isinstance(entry.get(key), plistlib.Data):
+        return entry[key].data
+    return None
+
+
+class PreviousSeal(object):
+    """ The CodeResources seal a bundle had before we resigned it. Its hashes
+        are as good as ours for files that haven't changed since """
+
+    def __init__(self, path, digests, ledger, reuse=REUSE_NEVER, manifest=None):
+        self.path = path
+        # path -> {hash type: binary digest}
+        self.digests = digests
+        self.ledger = ledger
+        self.reuse = reuse
+        self.manifest = manifest
+        self.mtime = os.stat(path).st_mtime
+
+    @classmethod
+    def load(cls, app_dir, ledger, reuse=REUSE_NEVER, manifest=None):
+        """ The seal of the bundle at app_dir, or None if it doesn't have one we can read """
+        path = os.path.join(app_dir, OUTPUT_DIRECTORY, OUTPUT_FILENAME)
+        if reuse == REUSE_NEVER or not os.path.isfile(path) or path in ledger:
+            return None
+        try:
+            plist = plistlib.readPlist(path)
+        except Exception as e:
+            log.debug("can't read previous seal %s: %s", path, e)
+            return None
+        files = plist.get('files', {})
+        digests = {}
+        for name, entry in plist.get('files2', {}).iteritems():
+            sha1 = get_data(entry, 'hash') or get_data(files.get(name), 'hash')
+            sha256 = get_data(entry, 'hash2')
+            if sha1 is not None and sha256 is not None:
+                file_path = os.path.join(app_dir, zip_reader.encode_path(name))
+                digests[file_path] = {'sha1': sha1, 'sha256': sha256}
+        log.debug("previous seal %s has hashes of %d files", path, len(digests))
+        return cls(path, digests, ledger, reuse, manifest)
+
+    def get_mtime(self, path):
+        if os.path.lexists(path):
+            return os.lstat(path).st_mtime
+        if self.manifest is not None:
+            return self.manifest.get_mtime(path)
+        return None
+
+    def get_hashes(self, path):
+        """ {hash type: binary digest} of a file, if the seal has them and
+            they can still be trusted. Otherwise None """
+        digests = self.digests.get(path)
+        if digests is None or path in self.ledger or os.path.islink(path):
+            return None
+        if self.reuse == REUSE_IF_OLDER:
+            mtime = self.get_mtime(path)
+            # we can't tell the order of changes within the same tick of the clock
+            if mtime is None or mtime >= self.mtime:
+                return None
+        return digests
+
+
+class ResourceRules(object):
+    """ A set of resource rules, compiled once, to be shared by every seal
+        that uses them, from any thread. Don't change it; extend() it into
+        a new one instead """
+
+    def __init__(self, rules_data):
+        # pattern -> properties, as in 'rules2' of a seal
+        self.data = copy.deepcopy(rules_data)
+        self.rules = tuple(PathRule(pattern, properties)
+                           for pattern, properties in self.data.iteritems())
+        self.matcher = RuleMatcher(self.rules, ResourceBuilder.NULL_PATH_RULE)
+
+    def extend(self, custom_rules_data):
+        """ New rules, with these custom ones added, or replacing ours with the same pattern """
+        rules_data = dict(self.data)
+        rules_data.update(custom_rules_data)
+        return self.__class__(rules_data)
+
+
+class SealEntry(object):
+    """ What a seal says about one file: its digests, raw, and whether it's
+        optional. Or for a symlink, its target instead of digests. Big
+        bundles have hundreds of thousands of these, so they are kept
+        small, and shared between 'files' and 'files2' """
+    __slots__ = ('sha1', 'sha256', 'optional', 'symlink')
+
+    def __init__(self, sha1, sha256, optional=False, symlink=None):
+        self.sha1 = sha1
+        self.sha256 = sha256
+        self.optional = optional
+        self.symlink = symlink
+
+    @classmethod
+    def for_symlink(cls, target, optional=False):
+        return cls(None, None, optional, target)
+
+    def get_plist_value(self):
+        """ The entry as plistlib reads and writes it """
+        if self.symlink is not None:
+            value = {'symlink': self.symlink}
+        else:
+            # the Data element in plists is base64-encoded
+            value = {'hash': plistlib.Data(self.sha1),
+                     'hash2': plistlib.Data(self.sha256)}
+        if self.optional:
+            value['optional'] = True
+        return value
+
+
+class SealWriter(PlistWriter):
+    """ Writes a seal byte for byte as plistlib.writePlist would, but streams
+        'files' and 'files2' straight from SealEntry records, rather than
+        making them into dicts of Data first. Everything else, e.g. the
+        rules, goes through the usual (patched) writeValue """
+
+    SEAL_ENTRY_KEYS = ('files', 'files2')
+
+    def write_seal(self, plist, files, files2):
+        """ plist with these {relative path: SealEntry} as 'files' and 'files2' """
+        self.writeln('<plist version="1.0">')
+        self.beginElement('dict')
+        values = dict(plist, files=files, files2=files2)
+        for key in sorted(values):
+            self.simpleElement('key', key)
+            if key in self.SEAL_ENTRY_KEYS:
+                self.write_entries(values[key])
+            else:
+                self.writeValue(values[key])
+        self.endElement('dict')
+        self.writeln('</plist>')
+
+    def write_entries(self, entries):
+        """ Same as writeDict of their plist values, one entry at a time """
+        self.beginElement('dict')
+        outer = self.indentLevel * self.indent
+        inner = outer + self.indent
+        # writeData wraps base64 to fit the indentation inside an entry's dict
+        maxlinelength = max(16, 76 - len(inner.replace("\t", " " * 8)))
+
+        maxbinsize = (maxlinelength // 4) * 3
+
+        def data_lines(data):
+            if len(data) <= maxbinsize:
+                # a digest usually fits on one line
+                return inner + binascii.b2a_base64(data)
+            lines = plistlib._encodeBase64(data, maxlinelength).split("\n")
+            return ''.join(inner + line + "\n" for line in lines if line)
+
+        entry_fmt = (outer + "<key>{}</key>\n" +
+                     outer + "<dict>\n" +
+                     inner + "<key>hash</key>\n" +
+                     inner + "<data>\n{}" + inner + "</data>\n" +
+                     inner + "<key>hash2</key>\n" +
+                     inner + "<data>\n{}" + inner + "</data>\n{}" +
+                     outer + "</dict>\n")
+        # 'optional' sorts before 'symlink'
+        symlink_fmt = (outer + "<key>{}</key>\n" +
+                       outer + "<dict>\n{}" +
+                       inner + "<key>symlink</key>\n" +
+                       inner + "<string>{}</string>\n" +
+                       outer + "</dict>\n")
+        optional = inner + "<key>optional</key>\n" + inner + "<true/>\n"
+        write = self.file.write
+        for relative_path in sorted(entries):
+            entry = entries[relative_path]
+            if entry.symlink is not None:
+                write(symlink_fmt.format(plistlib._escapeAndEncode(relative_path),
+                                         optional if entry.optional else '',
+                                         plistlib._escapeAndEncode(entry.symlink)))
+                continue
+            write(entry_fmt.format(plistlib._escapeAndEncode(relative_path),
+                                   data_lines(entry.sha1),
+                                   data_lines(entry.sha256),
+                                   optional if entry.optional else ''))
+        self.endElement('dict')
+
+
 class ResourceBuilder(object):
     NULL_PATH_RULE = PathRule()
 
-    def __init__(self, app_path, rules_data, respect_omissions=False):
+    def __init__(self, app_path, rules_data, respect_omissions=False, manifest=None,
+                 workers=MAX_WORKERS, previous_seal=None):
+        """ rules_data is a ResourceRules, or the dict of rules to make one from """
         self.app_path = app_path
         self.app_dir = os.path.dirname(app_path)
-        self.rules = []
         self.respect_omissions = respect_omissions
-        for pattern, properties in rules_data.iteritems():
-            self.rules.append(PathRule(pattern, properties))
+        # if the app came from an archive, the zip_reader.Manifest of what
+        # was extracted, which knows the hashes of the files it extracted or skipped
+        self.manifest = manifest
+        self.workers = workers
+        # the PreviousSeal of this bundle, if we may reuse its hashes
+        self.previous_seal = previous_seal
+        if not isinstance(rules_data, ResourceRules):
+            rules_data = ResourceRules(rules_data)
+        self.rules = rules_data.rules
+        self.matcher = rules_data.matcher
 
     def find_rule(self, path):
-        best_rule = ResourceBuilder.NULL_PATH_RULE
-        for rule in self.rules:
-            # log.debug('trying rule ' + str(rule) + ' against ' + path)
-            if rule.matches(path):
-                if rule.flags and rule.is_exclusion():
-                    best_rule = rule
-                    break
-                elif rule.weight > best_rule.weight:
-                    best_rule = rule
-        return best_rule
+        return self.matcher.match(path)
 
     def get_rule_and_paths(self, root, path):
         path = os.path.join(root, path)
@@ -117,16 +375,80 @@ class ResourceBuilder(object):
         rule = self.find_rule(relative_path)
         return (rule, path, relative_path)
 
+    def get_filenames(self, root, filenames):
+        """ Files in this directory, including any not extracted from the archive """
+        if self.manifest is None:
+            return filenames
+        return filenames + self.manifest.get_unextracted_filenames(root)
+
+    def get_hashes(self, path):
+        """ {hash type: binary digest} of a file. If it hasn't changed since
+            the bundle was last sealed, or since it came out of an archive,
+            we already know them. Otherwise, read it """
+        if self.previous_seal is not None:
+            digests = self.previous_seal.get_hashes(path)
+            if digests is not None:
+                return digests
+        if self.manifest is not None:
+            digests = self.manifest.get_hashes(path)
+            if digests is not None:
+                return digests
+        return get_hashes_binary(path)
+
+    def get_all_hashes(self, paths):
+        """ {path: {hash type: binary digest}} for all these files, hashed on a
+            pool of workers. Large files are a task each; small ones go out in
+            batches. Files only in the archive count as large, since they have
+            to be decompressed """
+        if self.workers <= 1 or len(paths) < 2:
+            return dict((path, self.get_hashes(path)) for path in paths)
+        small_paths, large_paths = [], []
+        for path in paths:
+            if os.path.isfile(path) and os.path.getsize(path) < SMALL_FILE_SIZE:
+                small_paths.append(path)
+            else:
+                large_paths.append(path)
+        pool = ThreadPool(self.workers)
+        try:
+            large_result = pool.map_async(self.get_hashes, large_paths, chunksize=1)
+            small_result = pool.map_async(self.get_hashes, small_paths,
+                                          chunksize=SMALL_FILE_BATCH)
+            hashes = dict(zip(large_paths, large_result.get()))
+            hashes.update(zip(small_paths, small_result.get()))
+        finally:
+            pool.close()
+            pool.join()
+        return hashes
+
     def scan(self):
         """
         Walk entire directory, compile mapping
         path relative to source_dir -> digest and other data
         """
-        file_entries = {}
+        files, files2 = self.scan_both()
+        if self.respect_omissions is True:
+            files = files2
+        return dict((relative_path, entry.get_plist_value())
+                    for relative_path, entry in files.iteritems())
+
+    def scan_both(self):
+        """
+        Walk entire directory once, evaluating each path's rule once, and
+        compile the mappings for both 'files' and 'files2', of relative path
+        to SealEntry. They are the same, except that the second one leaves
+        out files the rules omit.
+
+        Symlinks, to files or directories, are never followed. Like codesign,
+        we record their targets in 'files2', and leave them out of 'files'
+        """
+        # (rule, path, relative_path) of every file to seal, hashed after the walk
+        to_seal = []
+        # (rule, relative_path, target) of every symlink
+        symlinks = []
         # rule_debug_fmt = "rule: {0}, path: {1}, relative_path: {2}"
         for root, dirs, filenames in os.walk(self.app_dir):
             # log.debug("root: {0}".format(root))
-            for filename in filenames:
+            for filename in self.get_filenames(root, filenames):
                 rule, path, relative_path = self.get_rule_and_paths(root,
                                                                     filename)
                 # log.debug(rule_debug_fmt.format(rule, path, relative_path))
@@ -134,28 +456,27 @@ class ResourceBuilder(object):
                 if rule.is_exclusion():
                     continue
 
-                if rule.is_omitted() and self.respect_omissions is True:
-                    continue
-
                 if self.app_path == path:
                     continue
 
-                # the Data element in plists is base64-encoded
-                val = {'hash': plistlib.Data(get_hash_binary(path, 'sha1')),
-                       'hash2': plistlib.Data(get_hash_binary(path, 'sha256'))}
-
-                if rule.is_optional():
-                    val['optional'] = True
+                if os.path.islink(path):
+                    symlinks.append((rule, relative_path, os.readlink(path)))
+                    continue
 
-                if len(val) == 1 and 'hash' in val:
-                    file_entries[relative_path] = val['hash']
-                else:
-                    file_entries[relative_path] = val
+                to_seal.append((rule, path, relative_path))
 
-            for dirname in dirs:
+            # iterate over a copy, since we remove from dirs as we go
+            for dirname in list(dirs):
                 rule, path, relative_path = self.get_rule_and_paths(root,
                                                                     dirname)
 
+                if os.path.islink(path):
+                    # os.walk doesn't descend into these anyway
+                    dirs.remove(dirname)
+                    if not rule.is_exclusion():
+                        symlinks.append((rule, relative_path, os.readlink(path)))
+                    continue
+
                 if rule.is_nested() and '.' not in path:
                     dirs.remove(dirname)
                     continue
@@ -163,70 +484,219 @@ class ResourceBuilder(object):
                 if relative_path == OUTPUT_DIRECTORY:
                     dirs.remove(dirname)
 
-        return file_entries
+        hashes = self.get_all_hashes([path for _, path, _ in to_seal])
+        file_entries = {}
+        file_entries2 = {}
+        for rule, path, relative_path in to_seal:
+            digests = hashes[path]
+            entry = SealEntry(digests['sha1'], digests['sha256'], rule.is_optional())
+            file_entries[relative_path] = entry
+            if not rule.is_omitted():
+                file_entries2[relative_path] = entry
+
+        for rule, relative_path, target in symlinks:
+            if not rule.is_omitted():
+                file_entries2[relative_path] = SealEntry.for_symlink(target, rule.is_optional())
+
+        return file_entries, file_entries2
+
+
+def get_stat_key(path):
+    """ Enough of a file's stat to tell if it was rewritten or replaced. Python 2
+        has no nanosecond mtimes, so the ctime helps with changes in the same tick """
+    st = os.stat(path)
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime, st.st_ctime)
+
+
+class DigestCache(object):
+    """ Digests of files we hashed recently, by path. An entry is only used
+        while the file still has the stat it had when we hashed it. At most
+        max_entries are kept, evicting the least recently used """
+
+    def __init__(self, max_entries=DIGEST_CACHE_ENTRIES):
+        self.max_entries = max_entries
+        # path -> (stat key, {hash type: binary digest}), least recently used first
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, path, stat_key):
+        with self.lock:
+            entry = self.entries.pop(path, None)
+            if entry is None or entry[0] != stat_key:
+                self.misses += 1
+                return None
+            self.entries[path] = entry
+            self.hits += 1
+            return entry[1]
+
+    def put(self, path, stat_key, digests):
+        with self.lock:
+            self.entries.pop(path, None)
+            self.entries[path] = (stat_key, digests)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def discard_tree(self, dir_path):
+        """ Forget the files under dir_path, e.g. when a job is done with it """
+        prefix = os.path.join(dir_path, '')
+        with self.lock:
+            for path in [path for path in self.entries if path.startswith(prefix)]:
+                del self.entries[path]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def get_stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries)}
+
+
+_digest_cache = DigestCache()
+
+
+def get_digest_cache():
+    """ The DigestCache for this process """
+    return _digest_cache
+
+
+_template = None
+_default_rules = None
+_template_lock = threading.Lock()
+
+
+def _load_template():
+    """ The template, read once per process, shared. Don't change it """
+    global _template, _default_rules
+    with _template_lock:
+        if _template is None:
+            current_dir = os.path.dirname(os.path.abspath(__file__))
+            template_path = os.path.join(current_dir, TEMPLATE_FILENAME)
+            with open(template_path, 'r') as fh:
+                template = plistlib.readPlist(fh)
+            _default_rules = ResourceRules(template['rules2'])
+            _template = template
+    return _template
 
 
 def get_template():
     """
     Obtain the 'template' plist which also contains things like
-    default rules about which files should count
+    default rules about which files should count. This is a copy,
+    which the caller may change
     """
-    current_dir = os.path.dirname(os.path.abspath(__file__))
-    template_path = os.path.join(current_dir, TEMPLATE_FILENAME)
-    fh = open(template_path, 'r')
-    return plistlib.readPlist(fh)
+    return copy.deepcopy(_load_template())
+
+
+def get_default_rules():
+    """ The ResourceRules in the template, compiled once per process. Processes
+        forked after the first seal share them too """
+    _load_template()
+    return _default_rules
+
+
+def get_hashes_binary(path):
+    """ Get every hash CodeResources needs of a file at path, encoded as binary,
+        reading the file just once. Returns {hash type: digest}. If we hashed
+        the file recently, and it hasn't changed, it isn't read at all. If we
+        keep a hash cache, files with the same contents are only hashed once """
+    # before reading, so a change while we read makes the entry stale
+    stat_key = get_stat_key(path)
+    digests = _digest_cache.get(path, stat_key)
+    if digests is not None:
+        return digests
+    cache = hash_cache.get_hash_cache()
+    if cache is not None and not hash_cache.is_worth_caching(os.path.getsize(path)):
+        cache = None
+    if cache is not None:
+        key = hash_cache.get_file_key(path)
+        digests = cache.get(key)
+    if digests is None:
+        with open(path, 'rb') as afile:
+            digests = zip_reader.hash_stream(afile)
+        if cache is not None:
+            cache.put(key, digests)
+    _digest_cache.put(path, stat_key, digests)
+    return digests
 
 
-@memoize
-def get_hash_hex(path, hash_type):
-    """ Get the hash of a file at path, encoded as hexadecimal """
-    if hash_type == 'sha1':
-        hasher = hashlib.sha1()
-    elif hash_type == 'sha256':
-        hasher = hashlib.sha256()
-    else:
+def get_hash_binary(path, hash_type):
+    """ Get the hash of a file at path, encoded as binary """
+    digests = get_hashes_binary(path)
+    if hash_type not in digests:
         raise ValueError("unknown hash_type: %r" % hash_type)
-    with open(path, 'rb') as afile:
-        buf = afile.read(HASH_BLOCKSIZE)
-        while len(buf) > 0:
-            hasher.update(buf)
-            buf = afile.read(HASH_BLOCKSIZE)
-    return hasher.hexdigest()
+    return digests[hash_type]
 
 
-@memoize
-def get_hash_binary(path, hash_type):
-    """ Get the hash of a file at path, encoded as binary """
-    return binascii.a2b_hex(get_hash_hex(path, hash_type))
+def get_hash_hex(path, hash_type):
+    """ Get the hash of a file at path, encoded as hexadecimal """
+    return binascii.b2a_hex(get_hash_binary(path, hash_type))
 
 
-def write_plist(target_dir, plist):
-    """ Write the CodeResources file """
+def get_output_path(target_dir, ledger=None):
+    """ Path of the CodeResources file, ready to be written """
     output_dir = os.path.join(target_dir, OUTPUT_DIRECTORY)
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
     output_path = os.path.join(output_dir, OUTPUT_FILENAME)
-    fh = open(output_path, 'w')
-    plistlib.writePlist(plist, fh)
+    if ledger is not None:
+        ledger.record(output_path)
+    utils.break_link(output_path)
     return output_path
 
 
-def make_seal(source_app_path, target_dir=None):
+def write_plist(target_dir, plist, ledger=None):
+    """ Write the CodeResources file """
+    output_path = get_output_path(target_dir, ledger)
+    with open(output_path, 'w') as fh:
+        plistlib.writePlist(plist, fh)
+    return output_path
+
+
+def write_seal(target_dir, plist, files, files2, ledger=None):
+    """ Write the CodeResources file, with {relative path: SealEntry}
+        as its 'files' and 'files2' """
+    output_path = get_output_path(target_dir, ledger)
+    with open(output_path, 'w') as fh:
+        SealWriter(fh).write_seal(plist, files, files2)
+    return output_path
+
+
+def make_seal(source_app_path, target_dir=None, manifest=None, workers=MAX_WORKERS,
+              ledger=None, reuse=REUSE_NEVER, rules=None):
     """
     Given a source app, create a CodeResources file for the
     surrounding directory, and write it into the appropriate path in a target
-    directory
+    directory. If the app came from an archive, manifest is the
+    zip_reader.Manifest of what was extracted, which accounts for files that
+    weren't extracted, and knows the hashes of those that were.
+    Files are hashed on a pool of this many workers.
+
+    If reuse allows, hashes in the app's existing seal are reused for files
+    that aren't in the ledger of what we wrote. Only do that for apps from a
+    trusted source; by default every file is hashed.
+
+    rules are the ResourceRules to seal with, by default the template's.
+    For custom rules, extend() those from get_default_rules()
     """
     if target_dir is None:
         target_dir = os.path.dirname(source_app_path)
-    template = get_template()
     # n.b. code_resources_template not only contains a template of
     # what the file should look like; it contains default rules
     # deciding which files should be part of the seal
-    rules = template['rules2']
-    plist = copy.deepcopy(template)
-    resource_builder = ResourceBuilder(source_app_path, rules)
-    plist['files'] = resource_builder.scan()
-    resource_builder2 = ResourceBuilder(source_app_path, rules, True)
-    plist['files2'] = resource_builder2.scan()
-    return write_plist(target_dir, plist)
+    if rules is None:
+        rules = get_default_rules()
+    # the template is shared, so we only replace its top level entries
+    plist = dict(_load_template())
+    plist['rules2'] = rules.data
+    if ledger is None:
+        ledger = WriteLedger()
+    previous_seal = PreviousSeal.load(os.path.dirname(source_app_path), ledger, reuse, manifest)
+    resource_builder = ResourceBuilder(source_app_path, rules, manifest=manifest, workers=workers,
+                                       previous_seal=previous_seal)
+    files, files2 = resource_builder.scan_both()
+    cache = hash_cache.get_hash_cache()
+    if cache is not None:
+        log.debug("hash cache so far: %(hits)d hits, %(misses)d misses", cache.get_stats())
+    return write_seal(target_dir, plist, files, files2, ledger)
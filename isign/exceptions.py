@@ -36,3 +36,14 @@ class OpenSslFailure(Exception):
 class BadIdentifier(Exception):
     """ an application-identifier or CFBundleIdentifier is wrong """
     pass
+
+
+class OutOfScratchSpace(Exception):
+    """ there isn't room for the temporary files we need """
+    pass
+
+
+class ArchiveLocked(Exception):
+    """ thrown if another process is updating an archive
+        we want to update, or recover """
+    pass
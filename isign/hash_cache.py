@@ -0,0 +1,358 @@
+""" A persistent cache of the hashes CodeResources needs, so that files we
+    have seen before, in this app or in any other, needn't be hashed again.
+
+    Signing farms resign the same frameworks, fonts and asset bundles over and
+    over, in different apps. So entries are keyed by content, not by path: the
+    size of a file, its CRC-32, and a SHA-256 of its first and last 64 KiB.
+    Working out the key still means reading the file, but that is several
+    times cheaper than working out a SHA-1 and a SHA-256 of all of it.
+
+    For a file of 128 KiB or less, the SHA-256 would cover all of it, so the
+    key would cost as much as the hashes. Those files, most of the files in an
+    app, aren't cached at all. The cache is for the large ones, where the time
+    goes.
+
+    A file that matches a file already in the cache in its size, CRC-32,
+    start and end gets that file's hashes. CRC-32 collisions are easy to make
+    on purpose, so only share a cache between hosts that resign apps you
+    trust, and never let anything else write to it.
+
+    There are two backends:
+
+    - SqliteHashCache, a SQLite database, for a cache local to one host
+    - DirectoryHashCache, a file per entry, for a directory shared between
+      hosts. Entries are written under a temporary name and renamed into
+      place, so concurrent writers never leave a partial entry
+
+    Both keep at most max_entries, evicting the ones used least recently. When
+    an entry was last used is only recorded to within USED_REFRESH_INTERVAL,
+    so that hits are reads alone.
+    Each counts its hits and misses, so we can tell how much hashing it saves.
+
+    The cache is off unless configure() is called, or the ISIGN_HASH_CACHE
+    (a SQLite database) or ISIGN_SHARED_HASH_CACHE (a directory) environment
+    variable is set. """
+
+import abc
+import binascii
+import errno
+import hashlib
+import logging
+import os
+from os.path import dirname, isdir, join
+import sqlite3
+import thread
+import threading
+import time
+import utils
+import zlib
+
+log = logging.getLogger(__name__)
+
+ENV = 'ISIGN_HASH_CACHE'
+SHARED_ENV = 'ISIGN_SHARED_HASH_CACHE'
+
+MAX_ENTRIES = 1000000
+# how many entries we add between checks for ones to evict
+EVICT_INTERVAL = 1000
+# how stale an entry's last use may get before a hit records it again. Eviction
+# only needs a rough order, and a write for every hit would cost more than the hit saves
+USED_REFRESH_INTERVAL = 60 * 60
+# how much of the start and of the end of a file the key covers
+SAMPLE_SIZE = 64 * 1024
+# files up to this size would be covered by their key completely, so we don't cache them
+MAX_SAMPLED_SIZE = 2 * SAMPLE_SIZE
+
+
+def is_worth_caching(size):
+    """ Whether working out the key of a file this size costs less than hashing it """
+    return size > MAX_SAMPLED_SIZE
+
+
+def make_key(size, crc, sample):
+    """ Key for a file of this size and CRC-32, where sample is its first
+        and last SAMPLE_SIZE bytes, or all of it if it is no bigger than that """
+    return '{:016x}{:08x}{}'.format(size, crc & 0xffffffff, hashlib.sha256(sample).hexdigest())
+
+
+class Sampler(object):
+    """ Keeps the first and last SAMPLE_SIZE bytes of what it's given """
+
+    def __init__(self):
+        self.head = ''
+        self.tail = ''
+
+    def update(self, buf):
+        if len(self.head) < SAMPLE_SIZE:
+            needed = SAMPLE_SIZE - len(self.head)
+            self.head += buf[:needed]
+            buf = buf[needed:]
+        if len(buf) >= SAMPLE_SIZE:
+            self.tail = buf[-SAMPLE_SIZE:]
+        elif buf:
+            self.tail = (self.tail + buf)[-SAMPLE_SIZE:]
+
+    def get_sample(self):
+        return self.head + self.tail
+
+
+def get_zinfo_key(zipfile_obj, zinfo):
+    """ Key for a member of a zip file. Its size and CRC-32 are in the
+        central directory, but we have to read it for the sample """
+    sampler = Sampler()
+    source = zipfile_obj.open(zinfo)
+    try:
+        for buf in utils.read_chunks(source):
+            sampler.update(buf)
+    finally:
+        source.close()
+    return make_key(zinfo.file_size, zinfo.CRC, sampler.get_sample())
+
+
+def get_file_key(path):
+    """ Key for a file on disk. Same as if it were in a zip file """
+    crc = 0
+    size = 0
+    sampler = Sampler()
+    with open(path, 'rb') as f:
+        for buf in utils.read_chunks(f):
+            crc = zlib.crc32(buf, crc)
+            size += len(buf)
+            sampler.update(buf)
+    return make_key(size, crc, sampler.get_sample())
+
+
+def encode(digests):
+    return ' '.join('{}={}'.format(hash_type, binascii.b2a_hex(digest))
+                    for hash_type, digest in sorted(digests.iteritems()))
+
+
+def decode(value):
+    digests = {}
+    for item in value.split():
+        hash_type, digest = item.split('=')
+        digests[hash_type] = binascii.a2b_hex(digest)
+    return digests
+
+
+class HashCache(object):
+    """ Maps keys of file contents to {hash type: binary digest} """
+    __metaclass__ = abc.ABCMeta
+
+    def __init__(self, max_entries=MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.puts = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """ The digests of a file with this key, or None """
+        value = self._get(key)
+        with self.lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if value is None:
+            return None
+        return decode(value)
+
+    def put(self, key, digests):
+        self._put(key, encode(digests))
+        with self.lock:
+            self.puts += 1
+            should_evict = self.puts % EVICT_INTERVAL == 0
+        if should_evict:
+            self.evict_after_put(key)
+
+    def get_stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+    @abc.abstractmethod
+    def _get(self, key):
+        """ The encoded digests stored under key, or None """
+        pass
+
+    @abc.abstractmethod
+    def _put(self, key, value):
+        pass
+
+    @abc.abstractmethod
+    def evict(self):
+        """ Remove the least recently used entries, beyond max_entries """
+        pass
+
+    def evict_after_put(self, key):
+        """ Called every EVICT_INTERVAL puts, the last of them of key """
+        self.evict()
+
+
+class SqliteHashCache(HashCache):
+    """ Entries in a table of a SQLite database, with when they were last used """
+
+    def __init__(self, path, max_entries=MAX_ENTRIES):
+        super(SqliteHashCache, self).__init__(max_entries)
+        self.path = path
+        self.connection = None
+        # connections can't be shared with processes we fork, e.g. in multisign
+        self.pid = None
+
+    def _connect(self):
+        if self.connection is None or self.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=60, isolation_level=None,
+                                         check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            # with WAL, a crash can lose the last few entries, but never corrupts the
+            # cache, and commits don't wait for the disk
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS hashes '
+                               '(key TEXT PRIMARY KEY, digests TEXT, used REAL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS hashes_used ON hashes (used)')
+            self.connection = connection
+            self.pid = os.getpid()
+        return self.connection
+
+    def _get(self, key):
+        with self.lock:
+            connection = self._connect()
+            row = connection.execute('SELECT digests, used FROM hashes WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            now = time.time()
+            if now - row[1] > USED_REFRESH_INTERVAL:
+                connection.execute('UPDATE hashes SET used = ? WHERE key = ?', (now, key))
+        return str(row[0])
+
+    def _put(self, key, value):
+        with self.lock:
+            self._connect().execute('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?)',
+                                    (key, value, time.time()))
+
+    def evict(self):
+        with self.lock:
+            cursor = self._connect().execute(
+                'DELETE FROM hashes WHERE key IN '
+                '(SELECT key FROM hashes ORDER BY used DESC LIMIT -1 OFFSET ?)',
+                (self.max_entries,))
+        if cursor.rowcount > 0:
+            log.debug("evicted %d entries from hash cache %s", cursor.rowcount, self.path)
+
+
+class DirectoryHashCache(HashCache):
+    """ Entries as files in a directory, which may be shared with other hosts.
+        A file's modification time is when its entry was last used.
+
+        Entries are spread over SHARDS subdirectories by the end of their key.
+        Walking all of them may mean stat()ing a million files, on network
+        storage, so as we put entries we only evict from one shard at a time,
+        keeping it to its share of max_entries. evict() does every shard, e.g.
+        from a maintenance job """
+
+    SHARDS = 256
+
+    def __init__(self, path, max_entries=MAX_ENTRIES):
+        super(DirectoryHashCache, self).__init__(max_entries)
+        self.path = path
+
+    def get_shard(self, key):
+        # the SHA-256 is at the end, and varies more than the size
+        return key[-2:]
+
+    def get_entry_path(self, key):
+        return join(self.path, self.get_shard(key), key)
+
+    def _get(self, key):
+        entry_path = self.get_entry_path(key)
+        try:
+            with open(entry_path, 'rb') as f:
+                value = f.read()
+                used = os.fstat(f.fileno()).st_mtime
+            if time.time() - used > USED_REFRESH_INTERVAL:
+                os.utime(entry_path, None)
+        except (IOError, OSError):
+            # not there, or just evicted
+            return None
+        return value
+
+    def _put(self, key, value):
+        entry_path = self.get_entry_path(key)
+        try:
+            os.makedirs(dirname(entry_path))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        temp_path = '{}.{}.{}.tmp'.format(entry_path, os.getpid(), thread.get_ident())
+        with open(temp_path, 'wb') as f:
+            f.write(value)
+        os.rename(temp_path, entry_path)
+
+    def evict(self):
+        for shard in os.listdir(self.path):
+            if isdir(join(self.path, shard)):
+                self.evict_shard(shard)
+
+    def evict_after_put(self, key):
+        self.evict_shard(self.get_shard(key))
+
+    def evict_shard(self, shard):
+        """ Remove the least recently used entries in a shard, beyond its share of max_entries """
+        shard_path = join(self.path, shard)
+        max_shard_entries = max(1, self.max_entries // self.SHARDS)
+        entries = []
+        try:
+            filenames = os.listdir(shard_path)
+        except OSError:
+            # nothing was ever put in it
+            return
+        for filename in filenames:
+            if filename.endswith('.tmp'):
+                continue
+            entry_path = join(shard_path, filename)
+            try:
+                entries.append((os.stat(entry_path).st_mtime, entry_path))
+            except OSError:
+                pass
+        if len(entries) <= max_shard_entries:
+            return
+        entries.sort(reverse=True)
+        evicted = 0
+        for _, entry_path in entries[max_shard_entries:]:
+            try:
+                os.unlink(entry_path)
+                evicted += 1
+            except OSError:
+                # someone else evicted it first
+                pass
+        log.debug("evicted %d entries from hash cache %s", evicted, shard_path)
+
+
+_hash_cache = None
+_configured = False
+
+
+def configure(path=None, shared=False, max_entries=MAX_ENTRIES):
+    """ Cache hashes in a SQLite database at path, or if shared, in a
+        directory at path. With no path, don't cache """
+    global _hash_cache, _configured
+    if path is None:
+        _hash_cache = None
+    elif shared:
+        if not isdir(path):
+            os.makedirs(path)
+        _hash_cache = DirectoryHashCache(path, max_entries)
+    else:
+        _hash_cache = SqliteHashCache(path, max_entries)
+    _configured = True
+    return _hash_cache
+
+
+def get_hash_cache():
+    """ The HashCache for this process, configured from the environment
+        if configure() wasn't called. None if we don't cache """
+    if not _configured:
+        if os.environ.get(SHARED_ENV):
+            configure(os.environ[SHARED_ENV], shared=True)
+        else:
+            configure(os.environ.get(ENV) or None)
+    return _hash_cache
@@ -0,0 +1,194 @@
+""" Takes stock of many apps at once: bundle ids, versions, team ids, when their
+    provisioning profiles expire, nested bundles and architectures.
+
+    Apps are never unarchived. For zipped apps we read the central directory and
+    the few members we need, and only the header of the main executable. Apps
+    are examined in a pool of processes, and results are streamed out as JSON
+    Lines, one app at a time, so memory stays bounded however many apps there are. """
+
+from archive import archive_factory, VIEW_NESTED_BUNDLES_KEY, VIEW_PROVISIONING_PROFILE_KEY
+import json
+import logging
+import multiprocessing
+import os
+from os.path import basename, isdir, join, splitext
+import struct
+
+log = logging.getLogger(__name__)
+
+MAX_PROCESSES = multiprocessing.cpu_count()
+
+# file extensions of archives we look for, when given a directory
+ARCHIVE_EXTENSIONS = ['.ipa', '.zip']
+APP_EXTENSION = '.app'
+
+# enough of a Mach-O file to read every architecture in a fat header
+HEADER_SIZE = 4096
+
+# fat magic -> (byte order of the fat header, size of each fat_arch in it)
+FAT_HEADERS = {
+    0xcafebabe: ('>', 20),  # FAT_MAGIC
+    0xbebafeca: ('<', 20),  # FAT_CIGAM
+    0xcafebabf: ('>', 32),  # FAT_MAGIC_64
+    0xbfbafeca: ('<', 32),  # FAT_CIGAM_64
+}
+MACHO_MAGICS = [0xfeedface, 0xfeedfacf]
+MACHO_CIGAMS = [0xcefaedfe, 0xcffaedfe]
+
+# from mach/machine.h: (cputype, cpusubtype) -> name. A subtype of None matches any
+CPU_TYPE_ARM = 12
+CPU_TYPE_ARM64 = 0x0100000c
+CPU_TYPE_ARM64_32 = 0x0200000c
+CPU_TYPE_X86 = 7
+CPU_TYPE_X86_64 = 0x01000007
+CPU_SUBTYPE_MASK = 0x00ffffff
+ARCHITECTURE_NAMES = {
+    (CPU_TYPE_ARM, 6): 'armv6',
+    (CPU_TYPE_ARM, 9): 'armv7',
+    (CPU_TYPE_ARM, 11): 'armv7s',
+    (CPU_TYPE_ARM, 12): 'armv7k',
+    (CPU_TYPE_ARM, None): 'arm',
+    (CPU_TYPE_ARM64, 2): 'arm64e',
+    (CPU_TYPE_ARM64, None): 'arm64',
+    (CPU_TYPE_ARM64_32, None): 'arm64_32',
+    (CPU_TYPE_X86, None): 'i386',
+    (CPU_TYPE_X86_64, None): 'x86_64',
+}
+
+
+def get_architecture_name(cputype, cpusubtype):
+    cpusubtype &= CPU_SUBTYPE_MASK
+    for key in [(cputype, cpusubtype), (cputype, None)]:
+        if key in ARCHITECTURE_NAMES:
+            return ARCHITECTURE_NAMES[key]
+    return 'unknown({}:{})'.format(cputype, cpusubtype)
+
+
+def get_architectures(header):
+    """ Names of the architectures in a Mach-O file, thin or fat, from its first bytes """
+    if len(header) < 12:
+        return []
+    magic = struct.unpack('>I', header[:4])[0]
+    if magic in FAT_HEADERS:
+        byte_order, fat_arch_size = FAT_HEADERS[magic]
+        nfat_arch = struct.unpack(byte_order + 'I', header[4:8])[0]
+        architectures = []
+        for i in range(nfat_arch):
+            offset = 8 + i * fat_arch_size
+            if offset + 8 > len(header):
+                break
+            cputype, cpusubtype = struct.unpack(byte_order + 'II', header[offset:offset + 8])
+            architectures.append(get_architecture_name(cputype, cpusubtype))
+        return architectures
+    if magic in MACHO_MAGICS:
+        return [get_architecture_name(*struct.unpack('>II', header[4:12]))]
+    if magic in MACHO_CIGAMS:
+        return [get_architecture_name(*struct.unpack('<II', header[4:12]))]
+    return []
+
+
+def get_executable_name(bundle_info, bundle_path):
+    """ Like Bundle.get_executable_path, but just the name """
+    if 'CFBundleExecutable' in bundle_info:
+        return bundle_info['CFBundleExecutable']
+    executable_name, _ = splitext(basename(bundle_path.rstrip('/')))
+    return executable_name
+
+
+def get_bundle_summary(bundle_info):
+    return {
+        'bundle_id': bundle_info.get('CFBundleIdentifier'),
+        'version': bundle_info.get('CFBundleShortVersionString'),
+        'build': bundle_info.get('CFBundleVersion'),
+    }
+
+
+def get_profile_summary(profile_view):
+    if profile_view is None:
+        return {}
+    team_ids = profile_view.get('TeamIdentifier') or [None]
+    return {
+        'team_id': team_ids[0],
+        'profile_name': profile_view.get('Name'),
+        'profile_uuid': profile_view.get('UUID'),
+        'profile_expiration': profile_view.get('ExpirationDate'),
+    }
+
+
+def inventory_app(path):
+    """ Everything we want to know about one app, as a dict that can be
+        serialized as JSON. If the app can't be read, the dict says why """
+    record = {'path': path}
+    archive = None
+    try:
+        archive = archive_factory(path)
+        if archive is None:
+            record['error'] = 'not an app'
+            return record
+        record['archive_type'] = archive.__class__.__name__
+        record['name'] = archive.bundle_info.get('CFBundleName')
+        record['minimum_os'] = archive.bundle_info.get('MinimumOSVersion')
+        record.update(get_bundle_summary(archive.bundle_info))
+
+        details = archive.get_details()
+        record.update(get_profile_summary(details.get(VIEW_PROVISIONING_PROFILE_KEY)))
+        nested_bundles = []
+        for nested in details[VIEW_NESTED_BUNDLES_KEY]:
+            nested_record = {'path': nested['path']}
+            nested_record.update(get_bundle_summary(nested['info']))
+            nested_bundles.append(nested_record)
+        record['nested_bundles'] = nested_bundles
+
+        executable_name = get_executable_name(archive.bundle_info, archive.relative_bundle_dir)
+        with archive.open_bundle_file(executable_name) as executable:
+            record['architectures'] = get_architectures(executable.read(HEADER_SIZE))
+    except Exception as e:
+        log.debug("could not take inventory of %s", path, exc_info=True)
+        record['error'] = str(e) or e.__class__.__name__
+    finally:
+        if archive is not None:
+            archive.close()
+    return record
+
+
+def find_apps(paths):
+    """ Paths of apps in these paths. Directories are searched for archives and
+        app directories, but we don't look inside apps """
+    for path in paths:
+        if not isdir(path) or path.rstrip('/').endswith(APP_EXTENSION):
+            yield path
+            continue
+        for root, dirs, filenames in os.walk(path):
+            dirs.sort()
+            for dirname in list(dirs):
+                if dirname.endswith(APP_EXTENSION):
+                    dirs.remove(dirname)
+                    yield join(root, dirname)
+            for filename in sorted(filenames):
+                if splitext(filename)[1].lower() in ARCHIVE_EXTENSIONS:
+                    yield join(root, filename)
+
+
+def inventory(paths, processes=MAX_PROCESSES):
+    """ Take inventory of all the apps in paths, which may be apps or directories
+        of apps. Yields a record for each app, in no particular order """
+    pool = multiprocessing.Pool(max(1, processes))
+    try:
+        for record in pool.imap_unordered(inventory_app, find_apps(paths)):
+            yield record
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def write_json_lines(records, output):
+    """ Write records to a file object as JSON Lines. Returns how many we wrote """
+    count = 0
+    for record in records:
+        output.write(json.dumps(record, sort_keys=True))
+        output.write('\n')
+        count += 1
+    return count
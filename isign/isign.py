@@ -1,5 +1,6 @@
 import archive
 import biplist
+import code_resources
 # import makesig
 import exceptions
 import glob
@@ -67,7 +68,9 @@ def resign_with_creds_dir(input_path,
 def resign_adhoc(input_path,
                  deep=True,
                  output_path=join(os.getcwd(), "out"),
-                 info_props=None):
+                 info_props=None,
+                 compression_policy=None,
+                 reuse=code_resources.REUSE_NEVER):
     cms_signer = AdhocCmsSigner()
     try:
         return archive.resign(input_path,
@@ -75,7 +78,9 @@ def resign_adhoc(input_path,
                               cms_signer,
                               None,  # no provisioner
                               output_path,
-                              info_props)
+                              info_props,
+                              compression_policy,
+                              reuse)
     except exceptions.NotSignable as e:
         raise NotSignable(e)
 
@@ -90,9 +95,14 @@ def resign(input_path,
            signer_class=Pkcs1Signer,
            signer_arguments=None,
            info_props=None,
-           entitlements_paths=None):
+           entitlements_paths=None,
+           compression_policy=None,
+           reuse=code_resources.REUSE_NEVER):
     """ Essentially a wrapper around archive.resign(). We initialize the CmsSigner, entitlements,
-        and set default arguments """
+        and set default arguments. compression_policy, a zip_writer.CompressionPolicy,
+        controls how a zipped app is compressed again. reuse, e.g.
+        code_resources.REUSE_IF_OLDER, lets the new seals reuse hashes from the
+        app's existing ones; only use it for apps from a trusted source """
 
     if signer_arguments is None:
         signer_arguments = {}
@@ -120,16 +130,19 @@ def resign(input_path,
                               cms_signer,
                               provisioner,
                               output_path,
-                              info_props)
+                              info_props,
+                              compression_policy,
+                              reuse)
     except exceptions.NotSignable as e:
         # re-raise the exception without exposing internal
         # details of how it happened
         raise NotSignable(e)
 
 
-def view(input_path):
-    """ Obtain information about the app """
+def view(input_path, details=False):
+    """ Obtain information about the app. If details, also about nested
+        bundles and provisioning profiles """
     try:
-        return archive.view(input_path)
+        return archive.view(input_path, details)
     except exceptions.NotSignable as e:
         raise NotSignable(e)
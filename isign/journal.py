@@ -0,0 +1,219 @@
+""" Writes into a file in place, keeping an undo journal of the bytes it
+    overwrites, so that if anything goes wrong the file can be put back
+    exactly as it was.
+
+    Resigning a Mach-O usually changes just its headers and its code signature,
+    a few kilobytes, however large the binary is. Patching those ranges in place
+    costs much less than copying the whole file to change them, and the journal
+    is only as big as what we changed.
+
+    The journal is kept in memory, and if writing the patches fails, it puts
+    the file back. For a durable file, e.g. one the user gave us to sign in
+    place, the journal is also written to disk, next to the file, and synced
+    before the file is touched. So even if the process is killed, or the
+    machine loses power, partway through patching, recover() can put the file
+    back the next time we read it. Files in scratch directories don't need
+    that: if we die, they are thrown away, and syncing costs more than the
+    patch. """
+
+import hashlib
+import logging
+import os
+from os.path import abspath, basename, dirname, join, lexists
+import struct
+import utils
+
+log = logging.getLogger(__name__)
+
+JOURNAL_PREFIX = '.isign-journal-'
+JOURNAL_MAGIC = 'isignjnl'
+# original size of the file, number of records
+JOURNAL_HEADER = '<8sQI'
+# offset, length of the original bytes that follow
+JOURNAL_RECORD = '<QI'
+
+
+def get_journal_path(path):
+    return join(dirname(abspath(path)), JOURNAL_PREFIX + basename(path))
+
+
+def encode_journal(original_size, journal):
+    """ The journal as bytes, ending with a SHA-1 of the rest, so we can tell
+        if it was completely written """
+    parts = [struct.pack(JOURNAL_HEADER, JOURNAL_MAGIC, original_size, len(journal))]
+    for offset, original in journal:
+        parts.append(struct.pack(JOURNAL_RECORD, offset, len(original)))
+        parts.append(original)
+    data = ''.join(parts)
+    return data + hashlib.sha1(data).digest()
+
+
+def decode_journal(data):
+    """ (original size, [(offset, original bytes)]), or None if the journal is incomplete """
+    data, digest = data[:-20], data[-20:]
+    if len(data) < struct.calcsize(JOURNAL_HEADER) or hashlib.sha1(data).digest() != digest:
+        return None
+    magic, original_size, count = struct.unpack_from(JOURNAL_HEADER, data)
+    if magic != JOURNAL_MAGIC:
+        return None
+    position = struct.calcsize(JOURNAL_HEADER)
+    journal = []
+    for _ in range(count):
+        offset, length = struct.unpack_from(JOURNAL_RECORD, data, position)
+        position += struct.calcsize(JOURNAL_RECORD)
+        journal.append((offset, data[position:position + length]))
+        position += length
+    return original_size, journal
+
+
+def undo(f, original_size, journal):
+    """ Put back everything that was overwritten, and cut off anything
+        written past the original end of the file """
+    for offset, original in reversed(journal):
+        f.seek(offset)
+        f.write(original)
+    f.truncate(original_size)
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def remove_journal(path):
+    journal_path = get_journal_path(path)
+    if lexists(journal_path):
+        os.unlink(journal_path)
+        utils.fsync_path(dirname(journal_path))
+
+
+def recover(path):
+    """ If we were interrupted while patching the file at path, put it back
+        the way it was. Returns True if there was an interrupted patch """
+    journal_path = get_journal_path(path)
+    if not lexists(journal_path):
+        return False
+    with open(journal_path, 'rb') as f:
+        decoded = decode_journal(f.read())
+    # an incomplete journal means we never started patching
+    if decoded is not None and lexists(path):
+        log.warning("patching %s was interrupted, rolling it back", path)
+        with open(path, 'r+b') as f:
+            undo(f, *decoded)
+    remove_journal(path)
+    return True
+
+
+class JournaledFile(object):
+    """ A file opened for patching. Supports just what construct needs to build
+        into it: seek, tell, read and write.
+
+        Writes are held in memory, and reads see them, until commit(). Then the
+        journal of what they overwrite is taken, and if durable, written to
+        disk, and only after that are they written to the file. Used as a
+        context manager, the changes are kept if the block succeeds, and
+        dropped if it raises. """
+
+    def __init__(self, path, durable=True):
+        self.path = path
+        self.durable = durable
+        if durable:
+            recover(path)
+        self.f = open(path, 'r+b')
+        self.f.seek(0, os.SEEK_END)
+        self.original_size = self.f.tell()
+        self.f.seek(0)
+        self.position = 0
+        # (offset, data), in the order written
+        self.writes = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+
+    def get_size(self):
+        return max([self.original_size] + [offset + len(data) for offset, data in self.writes])
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.get_size()
+        self.position = offset
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        end = self.get_size()
+        if size >= 0:
+            end = min(end, self.position + size)
+        if end <= self.position:
+            return ''
+        self.f.seek(self.position)
+        data = bytearray(self.f.read(end - self.position))
+        # anything between the original end of the file and what we wrote reads as zeros
+        data.extend('\0' * (end - self.position - len(data)))
+        for offset, written in self.writes:
+            start = max(offset, self.position)
+            stop = min(offset + len(written), end)
+            if start < stop:
+                data[start - self.position:stop - self.position] = written[start - offset:stop - offset]
+        self.position = end
+        return str(data)
+
+    def write(self, data):
+        self.writes.append((self.position, data))
+        self.position += len(data)
+
+    def get_journal(self):
+        """ [(offset, original bytes)] of everything the writes overwrite """
+        journal = []
+        for offset, data in self.writes:
+            if offset < self.original_size:
+                self.f.seek(offset)
+                journal.append((offset, self.f.read(min(len(data), self.original_size - offset))))
+        return journal
+
+    def get_journal_size(self):
+        return sum(min(len(data), self.original_size - offset)
+                   for offset, data in self.writes if offset < self.original_size)
+
+    def write_journal(self, journal):
+        journal_path = get_journal_path(self.path)
+        with open(journal_path, 'wb') as f:
+            f.write(encode_journal(self.original_size, journal))
+            f.flush()
+            os.fsync(f.fileno())
+        utils.fsync_path(dirname(journal_path))
+
+    def commit(self):
+        journal = self.get_journal()
+        if self.durable:
+            self.write_journal(journal)
+        try:
+            for offset, data in self.writes:
+                self.f.seek(offset)
+                self.f.write(data)
+            self.f.flush()
+            if self.durable:
+                os.fsync(self.f.fileno())
+        except Exception:
+            undo(self.f, self.original_size, journal)
+            self.f.close()
+            if self.durable:
+                remove_journal(self.path)
+            raise
+        self.f.close()
+        if self.durable:
+            remove_journal(self.path)
+        log.debug("patched %s in place, %d bytes in %d writes",
+                  self.path, self.get_journal_size(), len(self.writes))
+
+    def rollback(self):
+        """ Nothing was written to the file yet, so just forget the writes """
+        log.debug("dropping %d writes to %s", len(self.writes), self.path)
+        self.writes = []
+        self.f.close()
@@ -0,0 +1,46 @@
+""" Keeps track of the files we write while resigning a bundle.
+
+    A bundle's existing CodeResources seal already has hashes of its files.
+    For every file we didn't write, and which hasn't changed since it was
+    sealed, we can reuse them rather than hashing the file again. So whatever
+    writes into a bundle (signing a binary, updating an Info.plist, adding a
+    provisioning profile or a seal) records the path here first. A bundle
+    and everything nested in it share one ledger. """
+
+import logging
+import os
+import threading
+
+log = logging.getLogger(__name__)
+
+
+def normalize(path):
+    return os.path.normpath(os.path.abspath(path))
+
+
+class WriteLedger(object):
+    """ The paths we have written to, or are about to """
+
+    def __init__(self):
+        self.paths = set()
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # we get pickled to go to other processes, e.g. in multisign, but locks can't be
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def record(self, path):
+        with self.lock:
+            self.paths.add(normalize(path))
+
+    def __contains__(self, path):
+        return normalize(path) in self.paths
+
+    def __len__(self):
+        return len(self.paths)
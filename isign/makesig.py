@@ -18,6 +18,8 @@ import utils
 
 log = logging.getLogger(__name__)
 
+PAGE_SIZE = 0x1000
+
 
 def make_arg(data_type, arg):
     if data_type.name == 'Data':
@@ -220,6 +222,28 @@ def make_basic_codesig(entitlements_file, drs, code_limit, hashes, signer, ident
     return macho_cs.Blob.parse(chunk)
 
 
+def iter_pages(header, f, length):
+    """ The pages of header followed by length bytes read from f, zero padded
+        if f is short. Only a chunk of f is in memory at a time """
+    buf = header
+    while length > 0:
+        chunk = f.read(min(length, utils.COPY_BUFSIZE))
+        if not chunk:
+            log.warn("expected {} more bytes, zero padding.".format(length))
+            chunk = "\x00" * min(length, utils.COPY_BUFSIZE)
+        length -= len(chunk)
+        buf += chunk
+        offset = 0
+        while len(buf) - offset >= PAGE_SIZE:
+            yield buf[offset:offset + PAGE_SIZE]
+            offset += PAGE_SIZE
+        buf = buf[offset:]
+    offset = 0
+    while offset < len(buf):
+        yield buf[offset:offset + PAGE_SIZE]
+        offset += PAGE_SIZE
+
+
 def make_signature(arch_macho, arch_offset, arch_size, cmds, f, entitlements_file, codesig_data_length, signer, ident):
     # NB: arch_offset is absolute in terms of file start.  Everything else is relative to arch_offset!
 
@@ -237,7 +261,7 @@ def make_signature(arch_macho, arch_offset, arch_size, cmds, f, entitlements_fil
     log.debug("codesig offset: {}".format(codesig_offset))
     codeLimit = codesig_offset
     log.debug("new cL: {}".format(hex(codeLimit)))
-    nCodeSlots = int(math.ceil(float(codesig_offset) / 0x1000))
+    nCodeSlots = int(math.ceil(float(codesig_offset) / PAGE_SIZE))
     log.debug("new nCS: {}".format(nCodeSlots))
 
 
@@ -298,20 +322,13 @@ def make_signature(arch_macho, arch_offset, arch_size, cmds, f, entitlements_fil
         actual_data = macho.MachO.build(arch_macho)
         log.debug("actual_data length with codesig LC {}".format(len(actual_data)))
 
-        # Now seek to the start of the actual data and read until the end of the arch.
+        # Now seek to the start of the actual data and hash until the end of the arch,
+        # a page at a time, so we never hold the whole slice in memory.
         f.seek(arch_offset + len(actual_data))
         bytes_to_read = codesig_offset + arch_offset - f.tell()
-        file_slice = f.read(bytes_to_read)
-        if len(file_slice) < bytes_to_read:
-            log.warn("expected {} bytes but got {}, zero padding.".format(bytes_to_read, len(file_slice)))
-            file_slice += ("\x00" * (bytes_to_read - len(file_slice)))
-        actual_data += file_slice
-
-        for i in xrange(nCodeSlots):
-            actual_data_slice = actual_data[(0x1000 * i):(0x1000 * i + 0x1000)]
-
-            actual = hashlib.sha1(actual_data_slice).digest()
-            log.debug("Slot {} (File page @{}): {}".format(i, hex(0x1000 * i), actual.encode('hex')))
+        for i, page in enumerate(iter_pages(actual_data, f, bytes_to_read)):
+            actual = hashlib.sha1(page).digest()
+            log.debug("Slot %d (File page @%s): %s", i, hex(PAGE_SIZE * i), actual.encode('hex'))
             hashes.append(actual)
     else:
         hashes = fake_hashes
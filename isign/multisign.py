@@ -2,10 +2,12 @@ import os.path
 from os.path import isdir
 import isign
 from archive import archive_factory
+import code_resources
 from signer import CmsSigner, Pkcs1Signer
 from provisioner import Provisioner
 import logging
 import multiprocessing
+import scratch
 
 log = logging.getLogger(__name__)
 
@@ -14,10 +16,11 @@ MAX_PROCESSES = multiprocessing.cpu_count()
 
 def resign(args, deep=True):
     """ Given a tuple consisting of a path to an uncompressed archive,
-        credential directory, and desired output path, resign accordingly.
+        credential directory, desired output path, and how far to trust
+        the hashes in the app's existing seals, resign accordingly.
 
         Returns a tuple of (cred_dir, path to resigned app) """
-    ua, cred_dir, resigned_path = args
+    ua, cred_dir, resigned_path, reuse = args
 
     try:
         log.debug('resigning with %s %s -> %s', ua.path, cred_dir, resigned_path)
@@ -30,7 +33,7 @@ def resign(args, deep=True):
         # sign it (in place)
         provisioning_profile = os.path.join(cred_dir, isign.DEFAULT_PROVISIONING_PROFILE_FILENAME)
         provisioner = Provisioner([provisioning_profile], [])
-        ua.bundle.resign(deep, signer, provisioner)
+        ua.bundle.resign(deep, signer, provisioner, reuse)
 
         log.debug("outputing %s", resigned_path)
         # and archive it there
@@ -51,10 +54,12 @@ def clone_ua(args):
     return ua
 
 
-def multisign(original_path, cred_dirs_to_output_paths, info_props=None):
+def multisign(original_path, cred_dirs_to_output_paths, info_props=None,
+              reuse=code_resources.REUSE_NEVER):
     """ Given a path to an app,
         a mapping of credential directories to desired output paths,
         optional info.plist properties to overwrite,
+        and how far to trust the hashes in the app's existing seals,
 
         produce re-signed versions of the app as desired.
 
@@ -68,13 +73,17 @@ def multisign(original_path, cred_dirs_to_output_paths, info_props=None):
         log.debug("%s didn't look like an app...", original_path)
         return None
 
-    return multisign_archive(archive, cred_dirs_to_output_paths, info_props)
+    with archive:
+        return multisign_archive(archive, cred_dirs_to_output_paths, info_props, reuse)
 
 
-def multisign_archive(archive, cred_dirs_to_output_paths, info_props=None):
+def multisign_archive(archive, cred_dirs_to_output_paths, info_props=None,
+                      reuse=code_resources.REUSE_NEVER):
     """ Given an isign.archive object,
         a mapping of credential directories to desired output paths,
         optional info.plist properties to overwrite,
+        and how far to trust the hashes in the app's existing seals
+        (see code_resources.make_seal),
 
         produce re-signed versions of the IPA.
 
@@ -89,11 +98,13 @@ def multisign_archive(archive, cred_dirs_to_output_paths, info_props=None):
 
     # ua is potentially an isign.archive.UncompressedArchive
     ua = None
+    target_ua_paths = []
 
     results = []
 
     try:
-        ua = archive.unarchive_to_temp()
+        # only the files that resigning rewrites need to be on disk, and copied
+        ua = archive.unarchive_to_temp(selective=True)
         if info_props:
             # Override info.plist props
             ua.bundle.update_info_props(info_props)
@@ -104,11 +115,14 @@ def multisign_archive(archive, cred_dirs_to_output_paths, info_props=None):
         uas = [ua]
 
         # But the rest need to be copied. This might take a while, so let's do it in parallel
-        # this will copy them to /path/to/uncompressedArchive_1, .._2, and so on
+        # this will copy them to new scratch directories, with room reserved for each,
         # and make UncompressedArchive objects that can be used for resigning
-        target_ua_paths = []
+        scratch_space = scratch.get_scratch_space()
+        clone_size = scratch.get_size(ua.path)
         for i in range(1, len(cred_dirs_to_output_paths)):
-            target_ua_paths.append((ua, ua.path + '_' + str(i)))
+            target_ua_path = scratch_space.mkdtemp(clone_size)
+            os.rmdir(target_ua_path)  # quirk of copytree, top dir can't exist already
+            target_ua_paths.append((ua, target_ua_path))
         uas += p.map(clone_ua, target_ua_paths)
 
         # now we should have one UncompressedArchive for every credential directory
@@ -117,7 +131,7 @@ def multisign_archive(archive, cred_dirs_to_output_paths, info_props=None):
         # We will now construct arguments for all the resignings
         resign_args_tuples = []
         for i, (cred_dir, output_path) in enumerate(cred_dirs_to_output_paths.items()):
-            resign_args_tuples.append((uas[i], cred_dir, output_path))
+            resign_args_tuples.append((uas[i], cred_dir, output_path, reuse))
         log.debug('resign args: %s', resign_args_tuples)
 
         # In parallel, resign each uncompressed archive with supplied credentials,
@@ -132,5 +146,8 @@ def multisign_archive(archive, cred_dirs_to_output_paths, info_props=None):
     finally:
         if ua is not None and isdir(ua.path):
             ua.remove()
+        # clones are removed as they are resigned, but in other processes
+        for _, target_ua_path in target_ua_paths:
+            scratch.get_scratch_space().remove(target_ua_path)
 
     return results
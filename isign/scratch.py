@@ -0,0 +1,142 @@
+""" Where isign puts its scratch files: unarchived apps, and copies of them.
+
+    These can be as big as the apps we sign, and when they were leaked they
+    have filled up disks in production. So they all come from one place, which
+
+    - tries a list of roots in order, e.g. a tmpfs first and a disk after it,
+      and uses the first one with room for what we expect to write there
+    - holds the bytes we expect to write to each directory against a budget
+      for this process, so several jobs can share a host without running it
+      out of space
+    - removes everything it handed out that is still there when the process
+      exits
+
+    Roots and budget can be set with configure(), or the ISIGN_SCRATCH_ROOTS
+    (separated like PATH) and ISIGN_SCRATCH_BUDGET (bytes) environment
+    variables. """
+
+import atexit
+from exceptions import OutOfScratchSpace
+import logging
+import os
+from os.path import isdir, join, lexists
+import shutil
+import tempfile
+import threading
+
+log = logging.getLogger(__name__)
+
+ROOTS_ENV = 'ISIGN_SCRATCH_ROOTS'
+BUDGET_ENV = 'ISIGN_SCRATCH_BUDGET'
+
+
+def get_free_space(path):
+    """ Bytes available to us on the filesystem holding path """
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+
+def get_size(path):
+    """ Bytes taken up by the files under path, not following symlinks """
+    size = 0
+    for root, _, filenames in os.walk(path):
+        for filename in filenames:
+            size += os.lstat(join(root, filename)).st_size
+    return size
+
+
+class ScratchSpace(object):
+    """ Hands out scratch directories, and keeps track of them.
+
+        roots is a list of directories to put scratch directories in, in order
+        of preference. By default, the system's temp directory.
+        budget is how many bytes this process may have reserved at once, or None
+        for no limit beyond the space free on the roots. """
+
+    def __init__(self, roots=None, budget=None):
+        if not roots:
+            roots = [tempfile.gettempdir()]
+        self.roots = roots
+        self.budget = budget
+        # path -> (root, bytes reserved for it)
+        self.reservations = {}
+        self.lock = threading.Lock()
+
+    def get_reserved(self, root=None):
+        """ Bytes reserved in total, or on a particular root """
+        return sum(size for reserved_root, size in self.reservations.values()
+                   if root is None or reserved_root == root)
+
+    def _choose_root(self, size):
+        if self.budget is not None and self.get_reserved() + size > self.budget:
+            raise OutOfScratchSpace("{} bytes of scratch space would exceed the budget of {}, "
+                                    "with {} reserved".format(size, self.budget, self.get_reserved()))
+        for root in self.roots:
+            if not isdir(root):
+                log.debug("scratch root %s doesn't exist, skipping", root)
+                continue
+            if get_free_space(root) - self.get_reserved(root) >= size:
+                return root
+            log.debug("scratch root %s doesn't have %d bytes free", root, size)
+        raise OutOfScratchSpace("no room for {} bytes of scratch space in {}".format(size, ', '.join(self.roots)))
+
+    def mkdtemp(self, size=0, prefix='isign-'):
+        """ Make a scratch directory on the first root with room for size bytes,
+            which stay reserved until the directory is removed """
+        with self.lock:
+            root = self._choose_root(size)
+            path = tempfile.mkdtemp(prefix=prefix, dir=root)
+            self.reservations[path] = (root, size)
+        log.debug("scratch dir %s, reserved %d bytes", path, size)
+        return path
+
+    def release(self, path):
+        """ Stop reserving space for a directory we handed out, which is
+            gone already, or which we no longer need to keep track of """
+        with self.lock:
+            self.reservations.pop(path, None)
+
+    def remove(self, path):
+        """ Remove a directory we handed out, and release its space """
+        if lexists(path):
+            shutil.rmtree(path)
+        self.release(path)
+
+    def cleanup(self):
+        """ Remove everything we handed out that is still there """
+        for path in list(self.reservations):
+            if lexists(path):
+                log.debug("cleaning up scratch dir %s", path)
+                shutil.rmtree(path, ignore_errors=True)
+            self.release(path)
+
+
+_scratch_space = None
+
+
+def configure(roots=None, budget=None):
+    """ Set where scratch directories go, and how much space they may take.
+        Anything handed out before is cleaned up """
+    global _scratch_space
+    if _scratch_space is not None:
+        _scratch_space.cleanup()
+    _scratch_space = ScratchSpace(roots, budget)
+    return _scratch_space
+
+
+def get_scratch_space():
+    """ The ScratchSpace for this process, configured from the environment
+        if configure() wasn't called """
+    if _scratch_space is None:
+        roots = [root for root in os.environ.get(ROOTS_ENV, '').split(os.pathsep) if root]
+        budget = os.environ.get(BUDGET_ENV)
+        configure(roots, int(budget) if budget else None)
+    return _scratch_space
+
+
+def _cleanup():
+    if _scratch_space is not None:
+        _scratch_space.cleanup()
+
+
+atexit.register(_cleanup)
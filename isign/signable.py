@@ -12,6 +12,7 @@ from codesig import (Codesig,
                      RequirementsSlot,
                      ApplicationSlot,
                      InfoSlot)
+import journal
 import logging
 import macho
 from makesig import make_signature
@@ -33,6 +34,10 @@ class Signable(object):
         self.path = path
         self.signer = signer
 
+        # if we were interrupted patching this last time, undo that first.
+        # A bundle in scratch space would have been thrown away instead
+        if bundle.durable:
+            journal.recover(self.path)
         self.f = open(self.path, "rb")
         self.f.seek(0, os.SEEK_END)
         self.file_end = self.f.tell()
@@ -164,8 +169,8 @@ class Signable(object):
             return None
 
     def sign(self, app, signer):
-
-        temp = tempfile.NamedTemporaryFile('wb', delete=False)
+        # so the seals of the bundles around us don't reuse our old hashes
+        self.bundle.ledger.record(self.path)
 
         # If signing fat binary from scratch, need special handling
 
@@ -173,6 +178,7 @@ class Signable(object):
         # we should still guard against this.
         if self.sign_from_scratch and 'FatArch' in self.m.data:
             assert len(self.arches) >= 2
+            temp = tempfile.NamedTemporaryFile('wb', delete=False, dir=os.path.dirname(self.path))
 
             # todo(markwang): Update fat headers and mach_start for each slice if needewd
             log.debug('signing fat binary from scratch')
@@ -213,7 +219,7 @@ class Signable(object):
             for arch in reversed(sorted_archs):
                 self.f.seek(arch['old_arch_offset'])
                 temp.seek(arch['arch_offset'])
-                temp.write(self.f.read(arch['old_arch_size']))
+                utils.copy_stream(self.f, temp, arch['old_arch_size'])
 
                 temp.seek(arch['arch_offset'] + arch['codesig_arch_offset'])
                 temp.write(arch['codesig_data'])
@@ -225,20 +231,32 @@ class Signable(object):
 
 
         else:
-            # copy self.f into temp, reset to beginning of file
-            self.f.seek(0)
-            temp.write(self.f.read())
-            temp.seek(0)
-
-            # write new codesign blocks for each arch
+            # new codesign blocks for each arch
             offset_fmt = ("offset: {2}, write offset: {0}, "
                           "new_codesig_data len: {1}")
+            patches = []
             for arch in self.arches:
                 offset, new_codesig_data = self._sign_arch(arch, app, signer)
                 write_offset = arch['macho'].macho_start + offset
                 log.debug(offset_fmt.format(write_offset,
                                             len(new_codesig_data),
                                             offset))
+                patches.append((write_offset, new_codesig_data))
+
+            # Usually the new signatures fit where the old ones were, and we only
+            # have to change those and the headers. So we patch the file itself
+            # rather than copying all of it.
+            if not self.sign_from_scratch and all(len(new_codesig_data) == arch['codesig_len']
+                                                  for arch, (_, new_codesig_data)
+                                                  in zip(self.arches, patches)):
+                self._patch_in_place(patches)
+                return
+
+            # copy self.f into temp, then write the new codesign blocks
+            temp = tempfile.NamedTemporaryFile('wb', delete=False, dir=os.path.dirname(self.path))
+            self.f.seek(0)
+            utils.copy_stream(self.f, temp)
+            for write_offset, new_codesig_data in patches:
                 temp.seek(write_offset)
                 temp.write(new_codesig_data)
 
@@ -253,6 +271,21 @@ class Signable(object):
         # log.debug("moving temporary file to {0}".format(self.path))
         os.rename(temp.name, self.path)
 
+    def _patch_in_place(self, patches):
+        """ Write the new code signatures and headers into the file itself.
+            What they overwrite is journaled first, so if anything goes wrong,
+            the file can be put back as it was. If the bundle is durable, the
+            journal goes to disk, so even if we are killed """
+        log.debug("patching {0} in place".format(self.path))
+        # if it's linked to another copy of the app, don't change that one
+        utils.break_link(self.path)
+        with journal.JournaledFile(self.path, durable=self.bundle.durable) as f:
+            for write_offset, new_codesig_data in patches:
+                f.seek(write_offset)
+                f.write(new_codesig_data)
+            f.seek(0)
+            macho.MachoFile.build_stream(self.m, f)
+
 
 class Executable(Signable):
     """ The main executable of an app. """
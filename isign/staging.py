@@ -0,0 +1,168 @@
+""" Stages an app directory for resigning, without copying all of it.
+
+    Resigning only rewrites a handful of files: Mach-O binaries, Info.plists,
+    provisioning profiles and code signatures. So where the filesystem can
+    clone files copy-on-write (reflinks), everything is cloned, which costs
+    next to nothing. Otherwise files that resigning might rewrite are copied,
+    and everything else is hard linked to the original.
+
+    A hard link shares its data with the original, so writing to it would
+    change the original app too. Files we link are ones that resigning never
+    writes, and everything that does write to a staged app either replaces
+    files whole (Mach-O binaries) or breaks the link first, with
+    utils.break_link. When a staged app becomes the resigned app, whatever is
+    still linked gets a copy of its own, with break_links(), so the two apps
+    never share files. """
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+from os.path import join, relpath, splitext
+import shutil
+import struct
+import sys
+import utils
+import zip_reader
+
+log = logging.getLogger(__name__)
+
+# from linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+# errors meaning this filesystem, or this pair of paths, can't do it
+UNSUPPORTED_ERRNOS = [errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.EXDEV,
+                      errno.ENOSYS, errno.EPERM, errno.EMLINK]
+
+
+def _clonefile_function():
+    """ macOS's clonefile(2), if we're on macOS """
+    if sys.platform != 'darwin':
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        return libc.clonefile
+    except (OSError, AttributeError):
+        return None
+
+
+def reflink(source, target):
+    """ Make target a copy-on-write clone of source. Returns False if the
+        filesystem can't, in which case target isn't created """
+    clonefile = _clonefile_function()
+    if clonefile is not None:
+        if clonefile(source, target, 0) == 0:
+            return True
+        if ctypes.get_errno() in UNSUPPORTED_ERRNOS:
+            return False
+        raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()), target)
+
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    with open(source, 'rb') as source_fp:
+        with open(target, 'wb') as target_fp:
+            try:
+                fcntl.ioctl(target_fp.fileno(), FICLONE, source_fp.fileno())
+            except (IOError, OSError) as e:
+                if e.errno not in UNSUPPORTED_ERRNOS:
+                    raise
+                cloned = False
+            else:
+                cloned = True
+    if not cloned:
+        os.unlink(target)
+        return False
+    shutil.copystat(source, target)
+    return True
+
+
+def hardlink(source, target):
+    """ Hard link target to source. Returns False if the filesystem can't """
+    try:
+        os.link(source, target)
+    except OSError as e:
+        if e.errno not in UNSUPPORTED_ERRNOS:
+            raise
+        return False
+    return True
+
+
+def is_macho(path):
+    """ Peek at the magic number of a file """
+    with open(path, 'rb') as f:
+        magic = f.read(4)
+    return len(magic) == 4 and struct.unpack('>I', magic)[0] in zip_reader.MACHO_MAGICS
+
+
+def is_mutable(path, relative_path):
+    """ Might resigning rewrite this file? Same rules as zip_reader.is_mutable """
+    parts = relative_path.split(os.sep)
+    if parts[-1] in zip_reader.MUTABLE_FILENAMES or zip_reader.MUTABLE_DIRNAME in parts[:-1]:
+        return True
+    is_executable = os.stat(path).st_mode & 0o111
+    if splitext(parts[-1])[1] in zip_reader.MACHO_EXTENSIONS or is_executable:
+        return is_macho(path)
+    return False
+
+
+class Stager(object):
+    """ Remembers what the filesystem turned out to support, so we only
+        try what fails once """
+
+    def __init__(self):
+        self.can_reflink = True
+        self.can_hardlink = True
+        self.counts = {'cloned': 0, 'linked': 0, 'copied': 0}
+
+    def stage_file(self, source, target, relative_path):
+        if self.can_reflink:
+            if reflink(source, target):
+                self.counts['cloned'] += 1
+                return
+            self.can_reflink = False
+        if self.can_hardlink and not is_mutable(source, relative_path):
+            if hardlink(source, target):
+                self.counts['linked'] += 1
+                return
+            self.can_hardlink = False
+        shutil.copy2(source, target)
+        self.counts['copied'] += 1
+
+
+def stage(source_dir, target_dir):
+    """ Make target_dir look like a copy of source_dir, which is safe to resign,
+        doing as little copying as we can. Symlinks are kept as symlinks.
+        target_dir must not exist yet """
+    stager = Stager()
+    os.mkdir(target_dir)
+    for root, dirs, filenames in os.walk(source_dir):
+        target_root = join(target_dir, relpath(root, source_dir))
+        for name in list(dirs):
+            source = join(root, name)
+            target = join(target_root, name)
+            if os.path.islink(source):
+                os.symlink(os.readlink(source), target)
+                # os.walk would follow it
+                dirs.remove(name)
+            else:
+                os.mkdir(target)
+        for name in filenames:
+            source = join(root, name)
+            target = join(target_root, name)
+            if os.path.islink(source):
+                os.symlink(os.readlink(source), target)
+            else:
+                stager.stage_file(source, target, relpath(source, source_dir))
+        shutil.copystat(root, target_root)
+    log.debug("staged %s at %s: %d cloned, %d linked, %d copied", source_dir, target_dir,
+              stager.counts['cloned'], stager.counts['linked'], stager.counts['copied'])
+
+
+def break_links(path):
+    """ Give every file under path that is hard linked to another its own copy """
+    for root, _, filenames in os.walk(path):
+        for name in filenames:
+            utils.break_link(join(root, name))
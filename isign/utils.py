@@ -1,4 +1,11 @@
 import binascii
+import os
+import shutil
+import stat
+
+# how much of a file we read into memory at once, when copying or hashing it.
+# However large an app or binary is, memory use stays bounded by this
+COPY_BUFSIZE = 1024 * 1024
 
 
 def print_data(data):
@@ -12,6 +19,54 @@ def round_up(x, k):
     return ((x + k - 1) & -k)
 
 
+def read_chunks(f, length=None):
+    """ Read length bytes from f, or everything to the end if length is None,
+        a chunk at a time. Stops early if f does """
+    while length is None or length > 0:
+        size = COPY_BUFSIZE if length is None else min(length, COPY_BUFSIZE)
+        chunk = f.read(size)
+        if not chunk:
+            break
+        if length is not None:
+            length -= len(chunk)
+        yield chunk
+
+
+def fsync_path(path):
+    """ Make sure what was written to a file, or to a directory's entries, is on disk """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def get_umask():
+    """ The umask of this process. It can only be read by setting it """
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+def copy_stream(source, target, length=None):
+    """ Copy length bytes from one file object to another, or everything
+        to the end if length is None """
+    for chunk in read_chunks(source, length):
+        target.write(chunk)
+
+
+def break_link(path):
+    """ If path is hard linked to another file, give it a copy of its own,
+        so we can write to it without changing the other """
+    if not os.path.lexists(path):
+        return
+    st = os.lstat(path)
+    if stat.S_ISREG(st.st_mode) and st.st_nlink > 1:
+        temp_path = path + '.isign-unlink'
+        shutil.copy2(path, temp_path)
+        os.rename(temp_path, path)
+
+
 def print_structure(container, struct):
     actual_data = struct.build(container)
     return "{}".format(struct.parse(actual_data))
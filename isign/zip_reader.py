@@ -0,0 +1,448 @@
+""" Reads zip archives (IPAs, zipped apps) in-process, so we don't depend on
+    an external `unzip` helper. Members are decompressed in parallel, and we
+    keep the unix permissions and symlinks recorded in the archive, like
+    `unzip` does.
+
+    While decompressing, we also hash files the way the CodeResources seal
+    needs, so sealing doesn't have to read them back from disk. Except for
+    code, code signatures and provisioning profiles: resigning replaces
+    those, nested ones before the seals of the bundles around them, so they
+    are hashed after that.
+
+    Resigning only rewrites Mach-O binaries, Info.plists, provisioning profiles
+    and code signatures. So we can also extract selectively: just those files,
+    symlinks, and the directories. Everything else stays in the zip file, and
+    whoever needs its hashes can stream it from there. """
+
+from exceptions import NotSignable
+import hash_cache
+import hashlib
+import logging
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import os
+from os.path import basename, dirname, isdir, join, lexists, normpath, splitext
+import stat
+import struct
+import time
+import utils
+import zipfile
+
+log = logging.getLogger(__name__)
+
+# zlib and file I/O release the GIL, so threads are enough to keep
+# every core busy while decompressing
+MAX_WORKERS = multiprocessing.cpu_count()
+
+# the digests CodeResources needs for every file
+HASH_TYPES = ['sha1', 'sha256']
+
+# files that resigning may rewrite, and so must be extracted
+MUTABLE_FILENAMES = ['Info.plist', 'embedded.mobileprovision']
+MUTABLE_DIRNAME = '_CodeSignature'
+# unless we sign ad hoc, these are replaced, not just possibly rewritten
+REPLACED_FILENAMES = ['embedded.mobileprovision']
+
+# Mach-O files are signed in place. They usually have no extension, or are dylibs,
+# or are executable. We check the magic number of those to be sure
+MACHO_EXTENSIONS = ['', '.dylib']
+MACHO_MAGICS = [
+    0xfeedface,  # MH_MAGIC
+    0xcefaedfe,  # MH_CIGAM
+    0xfeedfacf,  # MH_MAGIC_64
+    0xcffaedfe,  # MH_CIGAM_64
+    0xcafebabe,  # FAT_MAGIC
+    0xbebafeca,  # FAT_CIGAM
+    0xcafebabf,  # FAT_MAGIC_64
+    0xbfbafeca,  # FAT_CIGAM_64
+]
+
+
+def get_mode(zinfo):
+    """ Unix mode of this member, or 0 if the archiver didn't record one """
+    return (zinfo.external_attr >> 16) & 0xFFFF
+
+
+def is_dir(zinfo):
+    return zinfo.filename.endswith('/')
+
+
+def is_symlink(zinfo):
+    return stat.S_ISLNK(get_mode(zinfo))
+
+
+def get_date_time(zinfo):
+    """ Timestamp of this member, as seconds since the epoch """
+    return time.mktime(zinfo.date_time + (0, 0, -1))
+
+
+def get_target_path(target_dir, name):
+    """ Where a member should be extracted to. Like `unzip`, we refuse to
+        write anything outside of the target directory. The path is bytes even
+        for UTF-8 names, so it can be used whatever the locale's encoding is """
+    target_dir, name = encode_path(target_dir), encode_path(name)
+    path = normpath(join(target_dir, name))
+    is_inside = path == target_dir or path.startswith(target_dir + os.sep)
+    if name.startswith('/') or not is_inside:
+        raise NotSignable("unsafe path in archive: {}".format(name))
+    return path
+
+
+def encode_path(path):
+    """ zipfile decodes utf-8 names to unicode; paths from the filesystem are bytes """
+    if isinstance(path, unicode):
+        return path.encode('utf-8')
+    return path
+
+
+def hash_stream(source, target=None):
+    """ Read source to the end, copying it to target if given.
+        Returns {hash type: binary digest} for everything in HASH_TYPES """
+    hashers = dict((hash_type, hashlib.new(hash_type)) for hash_type in HASH_TYPES)
+    while True:
+        buf = source.read(utils.COPY_BUFSIZE)
+        if not buf:
+            break
+        if target is not None:
+            target.write(buf)
+        for hasher in hashers.values():
+            hasher.update(buf)
+    return dict((hash_type, hasher.digest()) for hash_type, hasher in hashers.iteritems())
+
+
+def hash_member(zipfile_obj, zinfo, target=None):
+    """ Read a member of a zip file to the end, copying it to target if given.
+        Returns {hash type: binary digest}, which we may already have in the
+        hash cache, in which case we needn't work them out """
+    cache = hash_cache.get_hash_cache()
+    if not hash_cache.is_worth_caching(zinfo.file_size):
+        cache = None
+    digests = None
+    key = None
+    if cache is not None:
+        key = hash_cache.get_zinfo_key(zipfile_obj, zinfo)
+        digests = cache.get(key)
+        if digests is not None and target is None:
+            return digests
+    source = zipfile_obj.open(zinfo)
+    try:
+        if digests is not None:
+            utils.copy_stream(source, target)
+        else:
+            digests = hash_stream(source, target)
+            if cache is not None:
+                cache.put(key, digests)
+    finally:
+        source.close()
+    return digests
+
+
+def get_stat_signature(path):
+    """ Enough of a file's stat to tell if it was rewritten or replaced since """
+    st = os.lstat(path)
+    return (st.st_ino, st.st_size, st.st_mtime, st.st_ctime)
+
+
+def get_dir_prefixes(names, depth):
+    """ Every directory prefix of these names, up to depth directories deep.
+        e.g. 'Payload/Foo.app/Info.plist' -> 'Payload/', 'Payload/Foo.app/' """
+    prefixes = set()
+    for name in names:
+        end = -1
+        for _ in range(depth):
+            end = name.find('/', end + 1)
+            if end == -1:
+                break
+            prefixes.add(name[:end + 1])
+    return prefixes
+
+
+class ZipIndex(object):
+    """ What's in a zip file, from reading its central directory once. Detecting
+        what kind of archive this is, reading its Info.plist, and extracting it
+        can all share this, rather than each opening and scanning the zip file """
+
+    # apps are never found deeper than this, e.g. Payload/Foo.app/
+    PREFIX_DEPTH = 2
+
+    def __init__(self, path):
+        self.path = path
+        self.zipfile_obj = zipfile.ZipFile(path)
+        self.names = set(self.zipfile_obj.NameToInfo)
+        self.dir_prefixes = get_dir_prefixes(self.names, self.PREFIX_DEPTH)
+        # member name -> contents, for small files we've read, like Info.plist
+        self.contents = {}
+
+    def read(self, name):
+        if name not in self.contents:
+            self.contents[name] = self.zipfile_obj.read(name)
+        return self.contents[name]
+
+    def close(self):
+        self.zipfile_obj.close()
+
+
+class Manifest(object):
+    """ Remembers what we extracted from a zip file, and what state each file was
+        left in. That way we can tell later which files were rewritten while
+        resigning, and copy the rest straight from the original archive.
+
+        It also remembers the files we left in the zip file, if we extracted
+        selectively. Until something is written at their path, they count
+        as unchanged, and can be read from the zip file.
+
+        Finally, it knows the digests of those files, as long as they are unchanged """
+
+    def __init__(self, zip_path, target_dir, zipfile_obj=None):
+        self.zip_path = zip_path
+        self.target_dir = target_dir
+        # member name -> stat signature just after extraction
+        self.signatures = {}
+        # path -> member name, for files extracted
+        self.names = {}
+        # directory path -> {filename: member name}, for files not extracted
+        self.unextracted = {}
+        # member name -> {hash type: binary digest}
+        self.digests = {}
+        # the zip file, open for reading, if we already have it
+        self._zipfile_obj = zipfile_obj
+
+    def __getstate__(self):
+        # we get pickled to go to other processes, but open files can't be
+        state = self.__dict__.copy()
+        state['_zipfile_obj'] = None
+        return state
+
+    def get_path(self, name):
+        return encode_path(normpath(join(self.target_dir, name)))
+
+    def record(self, name, digests=None):
+        """ Note the state of a member we just extracted, and its digests if known """
+        path = self.get_path(name)
+        self.signatures[name] = get_stat_signature(path)
+        self.names[path] = name
+        if digests is not None:
+            self.digests[name] = digests
+
+    def skip(self, name):
+        """ Note that we left this member in the zip file """
+        path = self.get_path(name)
+        self.unextracted.setdefault(dirname(path), {})[basename(path)] = name
+
+    def get_unextracted_name(self, path):
+        """ Member name of the file at path, if we left it in the zip file
+            and nothing has been written there since. Otherwise None """
+        path = normpath(path)
+        name = self.unextracted.get(dirname(path), {}).get(basename(path))
+        if name is None or lexists(path):
+            return None
+        return name
+
+    def get_unextracted_filenames(self, dir_path):
+        """ Filenames in this directory that are still only in the zip file """
+        dir_path = normpath(dir_path)
+        return [filename for filename in self.unextracted.get(dir_path, {})
+                if not lexists(join(dir_path, filename))]
+
+    def is_unchanged(self, name):
+        """ True if this member is on disk exactly as we extracted it, or if we
+            didn't extract it and nothing took its place """
+        path = self.get_path(name)
+        if name not in self.signatures:
+            return self.get_unextracted_name(path) is not None
+        return lexists(path) and get_stat_signature(path) == self.signatures[name]
+
+    def get_mtime(self, path):
+        """ Modification time of the file at path. If we left it in the zip file,
+            the one recorded there, as it would have been if we extracted it """
+        name = self.get_unextracted_name(path)
+        if name is None:
+            return os.lstat(path).st_mtime
+        return get_date_time(self._get_zipfile().getinfo(name))
+
+    def _get_zipfile(self):
+        if self._zipfile_obj is None:
+            self._zipfile_obj = zipfile.ZipFile(self.zip_path)
+        return self._zipfile_obj
+
+    def get_hash_binary(self, path, hash_type):
+        """ Hash of a file from the archive, if we know it. Either we hashed it while
+            extracting, and it hasn't changed since, or we left it in the zip file, and
+            stream it from there. Otherwise returns None """
+        if hash_type not in HASH_TYPES:
+            raise ValueError("unknown hash_type: %r" % hash_type)
+        digests = self.get_hashes(path)
+        if digests is None:
+            return None
+        return digests[hash_type]
+
+    def get_hashes(self, path):
+        """ Like get_hash_binary, but {hash type: digest} for every type in HASH_TYPES """
+        path = normpath(path)
+        name = self.get_unextracted_name(path)
+        if name is not None:
+            if name not in self.digests:
+                zipfile_obj = self._get_zipfile()
+                self.digests[name] = hash_member(zipfile_obj, zipfile_obj.getinfo(name))
+        else:
+            name = self.names.get(path)
+            if name is None or name not in self.digests or not self.is_unchanged(name):
+                return None
+        return self.digests[name]
+
+    def clone(self, target_dir):
+        """ Manifest for a copy of target_dir. Only files that were unchanged here
+            are considered unchanged in the copy """
+        manifest = self.__class__(self.zip_path, target_dir, self._zipfile_obj)
+        for name in self.signatures:
+            if self.is_unchanged(name):
+                manifest.record(name, self.digests.get(name))
+        for filenames in self.unextracted.values():
+            for name in filenames.values():
+                if self.is_unchanged(name):
+                    manifest.skip(name)
+                    if name in self.digests:
+                        manifest.digests[name] = self.digests[name]
+        return manifest
+
+
+def is_macho(zipfile_obj, zinfo):
+    """ Peek at the magic number of a member """
+    source = zipfile_obj.open(zinfo)
+    try:
+        magic = source.read(4)
+    finally:
+        source.close()
+    return len(magic) == 4 and struct.unpack('>I', magic)[0] in MACHO_MAGICS
+
+
+def may_be_code(zinfo):
+    """ Might this member be code or a code signature, going by its name and
+        mode alone? Resigning rewrites those """
+    parts = zinfo.filename.split('/')
+    if MUTABLE_DIRNAME in parts[:-1]:
+        return True
+    is_executable = get_mode(zinfo) & 0o111
+    return bool(splitext(parts[-1])[1] in MACHO_EXTENSIONS or is_executable)
+
+
+def will_be_replaced(zinfo):
+    """ Will resigning most likely replace this member? Then it's not worth hashing
+        while extracting """
+    return zinfo.filename.split('/')[-1] in REPLACED_FILENAMES or may_be_code(zinfo)
+
+
+def may_be_mutable(zinfo):
+    """ Might resigning rewrite this member, going by its name and mode alone? """
+    return zinfo.filename.split('/')[-1] in MUTABLE_FILENAMES or may_be_code(zinfo)
+
+
+def is_mutable(zipfile_obj, zinfo):
+    """ Might resigning rewrite this member? """
+    if not may_be_mutable(zinfo):
+        return False
+    parts = zinfo.filename.split('/')
+    if parts[-1] in MUTABLE_FILENAMES or MUTABLE_DIRNAME in parts[:-1]:
+        return True
+    return is_macho(zipfile_obj, zinfo)
+
+
+def _set_attributes(zinfo, path):
+    mode = get_mode(zinfo)
+    if mode:
+        os.chmod(path, stat.S_IMODE(mode))
+    date_time = get_date_time(zinfo)
+    os.utime(path, (date_time, date_time))
+
+
+def _extract_file(zipfile_obj, manifest, zinfo, path):
+    with open(path, 'wb') as target:
+        if will_be_replaced(zinfo):
+            source = zipfile_obj.open(zinfo)
+            try:
+                utils.copy_stream(source, target)
+            finally:
+                source.close()
+            digests = None
+        else:
+            digests = hash_member(zipfile_obj, zinfo, target)
+    _set_attributes(zinfo, path)
+    manifest.record(zinfo.filename, digests)
+
+
+def _extract_symlink(zipfile_obj, manifest, zinfo, path):
+    if lexists(path):
+        os.unlink(path)
+    os.symlink(zipfile_obj.read(zinfo), path)
+    manifest.record(zinfo.filename)
+
+
+def _get_members(zipfile_obj, target_dir):
+    """ Sort members into directories, files and symlinks, paired with the path
+        they'll be extracted to. If a name occurs twice, the last one wins, as
+        it would if they were extracted one after another """
+    members = {}
+    for zinfo in zipfile_obj.infolist():
+        path = get_target_path(target_dir, zinfo.filename)
+        members[path] = zinfo
+    dirs, files, links = [], [], []
+    for path, zinfo in members.iteritems():
+        if is_dir(zinfo):
+            dirs.append((zinfo, path))
+        elif is_symlink(zinfo):
+            links.append((zinfo, path))
+        else:
+            files.append((zinfo, path))
+    return dirs, files, links
+
+
+def extract(zip_path, target_dir, workers=MAX_WORKERS, selective=False, index=None):
+    """ Extract everything in the zip file at zip_path into target_dir,
+        decompressing members in parallel. Returns a Manifest of what was extracted.
+
+        If selective, only extract the files resigning might rewrite, plus
+        symlinks and directories. The rest are recorded in the Manifest.
+
+        If we already have a ZipIndex of this zip file, we use its open zip file """
+    target_dir = normpath(target_dir)
+    if index is not None:
+        zipfile_obj = index.zipfile_obj
+    else:
+        zipfile_obj = zipfile.ZipFile(zip_path)
+    manifest = Manifest(zip_path, target_dir, zipfile_obj)
+    pool = ThreadPool(max(1, workers))
+    try:
+        dirs, files, links = _get_members(zipfile_obj, target_dir)
+
+        # Make every directory up front, so workers never race to create parents.
+        # Not every archiver adds entries for directories, so derive them from files too.
+        needed_dirs = set(path for _, path in dirs)
+        needed_dirs.update(dirname(path) for _, path in files + links)
+        for path in sorted(needed_dirs):
+            if not isdir(path):
+                os.makedirs(path)
+
+        if selective:
+            mutable = pool.map(lambda member: is_mutable(zipfile_obj, member[0]), files)
+            for (zinfo, _), is_member_mutable in zip(files, mutable):
+                if not is_member_mutable:
+                    manifest.skip(zinfo.filename)
+            files = [member for member, is_member_mutable in zip(files, mutable)
+                     if is_member_mutable]
+
+        # Biggest members first, so one large binary doesn't end up finishing last
+        files.sort(key=lambda member: member[0].file_size, reverse=True)
+        pool.map(lambda member: _extract_file(zipfile_obj, manifest, *member), files)
+
+        for zinfo, path in links:
+            _extract_symlink(zipfile_obj, manifest, zinfo, path)
+
+        # Directory times last, since extracting into a directory updates them.
+        # Deepest first, for the same reason.
+        for zinfo, path in sorted(dirs, key=lambda member: member[1], reverse=True):
+            _set_attributes(zinfo, path)
+    finally:
+        pool.close()
+        pool.join()
+    log.debug("extracted %d files, %d symlinks from %s", len(files), len(links), zip_path)
+    return manifest
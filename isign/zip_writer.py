@@ -0,0 +1,607 @@
+""" Writes zip archives (IPAs, zipped apps) in-process.
+
+    Resigning only rewrites a handful of files in an app: executables, the
+    CodeResources seal, the provisioning profile, and sometimes Info.plist.
+    So rather than recompressing the whole tree, we copy every member that
+    wasn't touched straight out of the original archive, still compressed,
+    and only compress the files that actually changed.
+
+    When we do have to compress, files are deflated in parallel, and written
+    out in order as they finish.
+
+    When the output is the original archive itself, we don't even copy: changed
+    members are appended to the end of the file, followed by a new central
+    directory. The old copies are left where they were, as dead space, until
+    there is enough of it to be worth compacting the archive.
+
+    Until the new central directory is written, the archive isn't readable.
+    So before appending, we write a recovery record next to it, with the size
+    it had. If we die partway through, the next time we update the archive,
+    recover_archive() truncates it back to that size, which is exactly the
+    archive it was. While updating, we hold an exclusive lock on the archive,
+    so that no other process updates it, or recovers it, at the same time.
+    Just reading an archive never recovers it. """
+
+from collections import deque
+import errno
+from exceptions import ArchiveLocked
+import fcntl
+import logging
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import os
+from os.path import abspath, basename, dirname, exists, isdir, islink, join, lexists, relpath
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import utils
+import zipfile
+import zip_reader
+import zlib
+
+log = logging.getLogger(__name__)
+
+# zlib and file I/O release the GIL, so threads are enough to keep
+# every core busy while compressing
+MAX_WORKERS = multiprocessing.cpu_count()
+
+# compressed data is kept in memory up to this size, then spills to a temp file
+SPOOL_MAX_SIZE = 8 * 1024 * 1024
+
+# formats that are compressed already. Deflating them again costs time and
+# saves next to nothing
+STORE_EXTENSIONS = ['.car', '.jpeg', '.jpg', '.mp4', '.png', '.zip']
+
+# indexes into the local file header, as unpacked with zipfile.structFileHeader
+FH_SIGNATURE = 0
+FH_FILENAME_LENGTH = 10
+FH_EXTRA_FIELD_LENGTH = 11
+
+# header id of the extra field holding zip64 sizes and offsets
+ZIP64_EXTRA_ID = 0x0001
+
+# general purpose flag meaning "CRC and sizes follow the data"
+DATA_DESCRIPTOR_FLAG = 0x08
+DATA_DESCRIPTOR_SIZE = 16
+
+# prefix of the recovery record next to an archive being updated in place
+RECOVERY_PREFIX = '.isign-recovery-'
+
+# when an archive updated in place is more than this fraction dead space
+# (superseded members and old central directories), we rewrite it
+MAX_DEAD_SPACE_RATIO = 0.5
+
+
+def strip_zip64_extra(extra):
+    """ Remove any zip64 extra field. zipfile adds a fresh one when needed,
+        with the right offsets for the archive it is writing """
+    stripped = []
+    while len(extra) >= 4:
+        header_id, size = struct.unpack('<HH', extra[:4])
+        if header_id != ZIP64_EXTRA_ID:
+            stripped.append(extra[:4 + size])
+        extra = extra[4 + size:]
+    return ''.join(stripped)
+
+
+def get_data_offset(fp, zinfo):
+    """ Offset of the compressed data of a member, just past its local header """
+    fp.seek(zinfo.header_offset)
+    header = struct.unpack(zipfile.structFileHeader, fp.read(zipfile.sizeFileHeader))
+    if header[FH_SIGNATURE] != zipfile.stringFileHeader:
+        raise zipfile.BadZipfile("Bad local file header for {}".format(zinfo.filename))
+    return (zinfo.header_offset + zipfile.sizeFileHeader +
+            header[FH_FILENAME_LENGTH] + header[FH_EXTRA_FIELD_LENGTH])
+
+
+def copy_zinfo(zinfo):
+    """ A ZipInfo describing the same member, ready to be written elsewhere """
+    new_zinfo = zipfile.ZipInfo(zinfo.filename, zinfo.date_time)
+    for attr in ['compress_type', 'comment', 'create_system', 'create_version',
+                 'extract_version', 'internal_attr', 'external_attr',
+                 'CRC', 'compress_size', 'file_size']:
+        setattr(new_zinfo, attr, getattr(zinfo, attr))
+    # we always know the CRC and sizes up front, so there is no data descriptor
+    new_zinfo.flag_bits = zinfo.flag_bits & ~DATA_DESCRIPTOR_FLAG
+    new_zinfo.extra = strip_zip64_extra(zinfo.extra)
+    return new_zinfo
+
+
+def get_member_size(zinfo):
+    """ Roughly how much space a member takes up in the archive. The local header's
+        extra field can differ from the central directory's, but not by much """
+    size = zipfile.sizeFileHeader + len(zinfo.filename) + len(zinfo.extra) + zinfo.compress_size
+    if zinfo.flag_bits & DATA_DESCRIPTOR_FLAG:
+        size += DATA_DESCRIPTOR_SIZE
+    return size
+
+
+def get_recovery_path(path):
+    return join(dirname(abspath(path)), RECOVERY_PREFIX + basename(path))
+
+
+def write_recovery_record(path, original_size):
+    """ Note durably the size of an archive we are about to append to """
+    recovery_path = get_recovery_path(path)
+    with open(recovery_path, 'wb') as f:
+        f.write('{}\n'.format(original_size))
+        f.flush()
+        os.fsync(f.fileno())
+    utils.fsync_path(dirname(recovery_path))
+
+
+def remove_recovery_record(path):
+    recovery_path = get_recovery_path(path)
+    if lexists(recovery_path):
+        os.unlink(recovery_path)
+        utils.fsync_path(dirname(recovery_path))
+
+
+class ArchiveLock(object):
+    """ An exclusive lock on an archive, so that only one process at a time
+        updates it in place, or recovers it. It is taken without blocking: if
+        another process holds it, acquire() raises ArchiveLocked. A process
+        that holds it may take it again. The operating system drops it if
+        the process dies """
+
+    # (st_dev, st_ino) -> [locked file, count], for the archives this process has locked
+    held = {}
+    held_lock = threading.Lock()
+
+    def __init__(self, path):
+        self.path = path
+        self.key = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def acquire(self):
+        f = open(self.path, 'rb')
+        st = os.fstat(f.fileno())
+        key = (st.st_dev, st.st_ino)
+        with self.held_lock:
+            if key in self.held:
+                f.close()
+                self.held[key][1] += 1
+            else:
+                try:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError as e:
+                    f.close()
+                    if e.errno in (errno.EAGAIN, errno.EACCES):
+                        raise ArchiveLocked("{} is being updated by another process".format(self.path))
+                    raise
+                self.held[key] = [f, 1]
+        self.key = key
+
+    def release(self):
+        with self.held_lock:
+            held = self.held[self.key]
+            held[1] -= 1
+            if held[1] == 0:
+                # closing it unlocks it
+                held[0].close()
+                del self.held[self.key]
+        self.key = None
+
+
+def recover_archive(path):
+    """ If we died while updating the archive at path in place, put it back the
+        way it was. Returns True if there was an interrupted update. If another
+        process is updating it right now, leaves it alone and returns False """
+    if not lexists(get_recovery_path(path)):
+        return False
+    if not exists(path):
+        remove_recovery_record(path)
+        return True
+    try:
+        with ArchiveLock(path):
+            return _recover_archive(path)
+    except ArchiveLocked:
+        log.warning("%s is being updated by another process, not recovering it", path)
+        return False
+
+
+def _recover_archive(path):
+    """ recover_archive, with the archive locked """
+    recovery_path = get_recovery_path(path)
+    # the process updating it may have finished before we locked it
+    if not lexists(recovery_path):
+        return False
+    with open(recovery_path, 'rb') as f:
+        record = f.read()
+    # if the record wasn't written completely, we never started appending
+    if record.endswith('\n') and record.strip().isdigit():
+        original_size = int(record)
+        if os.path.getsize(path) >= original_size:
+            log.warning("update of %s was interrupted, truncating it back to %d bytes",
+                        path, original_size)
+            with open(path, 'r+b') as f:
+                f.truncate(original_size)
+                f.flush()
+                os.fsync(f.fileno())
+        else:
+            log.warning("%s is smaller than before its interrupted update, leaving it", path)
+    remove_recovery_record(path)
+    return True
+
+
+def get_dead_space(path):
+    """ Bytes of an archive that belong to neither its members nor its central directory """
+    with zipfile.ZipFile(path) as zipfile_obj:
+        live_size = sum(get_member_size(zinfo) for zinfo in zipfile_obj.infolist())
+        return max(0, zipfile_obj.start_dir - live_size)
+
+
+class CompressionPolicy(object):
+    """ How to compress the members we write ourselves, as opposed to members
+        copied from the original archive, which keep their compressed data.
+
+        level is the zlib compression level, 0-9 (0 stores everything).
+        Files with any of store_extensions are stored without compression.
+        If keep_original is set, members that were already in the original
+        archive keep the compression method they had there. """
+
+    def __init__(self, level=zlib.Z_DEFAULT_COMPRESSION, store_extensions=None, keep_original=False):
+        self.level = level
+        if store_extensions is None:
+            store_extensions = []
+        self.store_extensions = set(extension.lower() for extension in store_extensions)
+        self.keep_original = keep_original
+
+    def get_compress_type(self, arcname, original_zinfo=None):
+        """ ZIP_STORED or ZIP_DEFLATED. original_zinfo is this member in the
+            original archive, if it was there """
+        if self.keep_original and original_zinfo is not None:
+            return original_zinfo.compress_type
+        if self.level == 0:
+            return zipfile.ZIP_STORED
+        if os.path.splitext(arcname)[1].lower() in self.store_extensions:
+            return zipfile.ZIP_STORED
+        return zipfile.ZIP_DEFLATED
+
+
+# deflate everything at zlib's default level, like `zip` does
+DEFAULT_COMPRESSION_POLICY = CompressionPolicy()
+
+
+def compress_file(path, level=zlib.Z_DEFAULT_COMPRESSION):
+    """ Deflate a file, the way zipfile would. Returns the CRC, the uncompressed size,
+        and a file holding the compressed data """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    spool = tempfile.SpooledTemporaryFile(SPOOL_MAX_SIZE)
+    crc = 0
+    file_size = 0
+    with open(path, 'rb') as f:
+        while True:
+            buf = f.read(utils.COPY_BUFSIZE)
+            if not buf:
+                break
+            file_size += len(buf)
+            crc = zlib.crc32(buf, crc)
+            spool.write(compressor.compress(buf))
+    spool.write(compressor.flush())
+    return crc & 0xffffffff, file_size, spool
+
+
+class ZipWriter(object):
+    """ Writes a zip file, one member at a time. Members are either compressed from
+        files on disk, or copied without recompression from another zip file.
+
+        Members are written in the order they were added, but files are compressed
+        on a pool of workers, a few members ahead of what is being written.
+
+        With append, an existing archive is updated: new members are written
+        after everything already in the file, and a member written again
+        replaces the old one in the central directory. Nothing that was in the
+        file is overwritten, so if anything goes wrong the file is truncated
+        back to what it was: right away, or if the process dies, by
+        recover_archive() the next time. The archive is locked until the
+        writer is closed or aborted. """
+
+    def __init__(self, path, workers=MAX_WORKERS, compression_policy=None, append=False):
+        self.append = append
+        self.archive_lock = None
+        if append:
+            self.archive_lock = ArchiveLock(path)
+            self.archive_lock.acquire()
+            try:
+                recover_archive(path)
+                self.original_size = os.path.getsize(path)
+                write_recovery_record(path, self.original_size)
+                self.zipfile_obj = zipfile.ZipFile(path, 'a', zipfile.ZIP_DEFLATED, allowZip64=True)
+            except Exception:
+                self.archive_lock.release()
+                raise
+            # zipfile would write over the old central directory
+            self.zipfile_obj.fp.seek(0, os.SEEK_END)
+        else:
+            self.zipfile_obj = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+        if compression_policy is None:
+            compression_policy = DEFAULT_COMPRESSION_POLICY
+        self.compression_policy = compression_policy
+        self.pool = ThreadPool(max(1, workers))
+        # how many members may be compressed ahead of the one being written.
+        # Bounds memory (and temp space) to a few spooled members per worker
+        self.window = max(1, workers) * 2
+        # (async result or None, function that writes the member given the result)
+        self.pending = deque()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            try:
+                self.close()
+            except Exception:
+                # e.g. a member that failed to compress, found while draining
+                self.abort()
+                raise
+        else:
+            self.abort()
+
+    def abort(self):
+        self.pool.terminate()
+        self.pool.join()
+        if self.append:
+            try:
+                self.rollback()
+            finally:
+                self.archive_lock.release()
+        else:
+            self.zipfile_obj.close()
+
+    def close(self):
+        try:
+            self._drain()
+        finally:
+            self.pool.close()
+            self.pool.join()
+        if self.append:
+            self._replace_members()
+        self.zipfile_obj.close()
+        if self.append:
+            # the archive must be complete on disk before we forget how to undo it
+            utils.fsync_path(self.zipfile_obj.filename)
+            remove_recovery_record(self.zipfile_obj.filename)
+            self.archive_lock.release()
+
+    def rollback(self):
+        """ Put an archive we were appending to back the way it was """
+        # don't write a central directory on close
+        self.zipfile_obj._didModify = False
+        self.zipfile_obj.close()
+        with open(self.zipfile_obj.filename, 'r+b') as f:
+            f.truncate(self.original_size)
+            f.flush()
+            os.fsync(f.fileno())
+        remove_recovery_record(self.zipfile_obj.filename)
+
+    def remove(self, arcname):
+        """ Drop a member from the central directory of an archive we are appending to """
+        del self.zipfile_obj.NameToInfo[arcname]
+        self.zipfile_obj._didModify = True
+
+    def _replace_members(self):
+        """ Members written again take the place of the originals in the central
+            directory, so the archive lists them in the same order as before """
+        name_to_info = self.zipfile_obj.NameToInfo
+        filelist = []
+        for zinfo in self.zipfile_obj.filelist:
+            if name_to_info.get(zinfo.filename) is None:
+                continue
+            filelist.append(name_to_info.pop(zinfo.filename))
+        self.zipfile_obj.filelist = filelist
+        self.zipfile_obj.NameToInfo = dict((zinfo.filename, zinfo) for zinfo in filelist)
+
+    def _queue(self, write, result=None):
+        self.pending.append((result, write))
+        self._drain(self.window)
+
+    def _drain(self, limit=0):
+        """ Write queued members, in order, until at most `limit` are still queued """
+        while len(self.pending) > limit:
+            result, write = self.pending.popleft()
+            write(result.get() if result is not None else None)
+
+    def _append(self, zinfo, chunks):
+        """ Write a member whose CRC and sizes are already known """
+        fp = self.zipfile_obj.fp
+        zinfo.header_offset = fp.tell()
+        zip64 = (zinfo.file_size > zipfile.ZIP64_LIMIT or
+                 zinfo.compress_size > zipfile.ZIP64_LIMIT)
+        fp.write(zinfo.FileHeader(zip64))
+        written = 0
+        for chunk in chunks:
+            fp.write(chunk)
+            written += len(chunk)
+        if written != zinfo.compress_size:
+            # the source ended before the size we wrote in the header
+            raise zipfile.BadZipfile("Truncated zip file")
+        self.zipfile_obj.filelist.append(zinfo)
+        self.zipfile_obj.NameToInfo[zinfo.filename] = zinfo
+        # zipfile only writes the central directory on close if it thinks
+        # it wrote something itself
+        self.zipfile_obj._didModify = True
+
+    def copy_member(self, source_fp, zinfo):
+        """ Copy a member of the zip file open at source_fp, without decompressing it.
+            source_fp has to stay open until the writer is closed """
+        def write(_):
+            source_fp.seek(get_data_offset(source_fp, zinfo))
+            self._append(copy_zinfo(zinfo), utils.read_chunks(source_fp, zinfo.compress_size))
+        self._queue(write)
+
+    def _write_symlink(self, path, arcname):
+        """ Store a symlink as a link, the way `zip -y` does """
+        st = os.lstat(path)
+        zinfo = zipfile.ZipInfo(arcname, time.localtime(st.st_mtime)[0:6])
+        zinfo.create_system = 3
+        zinfo.external_attr = (st.st_mode & 0xFFFF) << 16
+        self.zipfile_obj.writestr(zinfo, os.readlink(path), zipfile.ZIP_STORED)
+
+    def _write_compressed(self, path, arcname, compressed):
+        """ Write a file that a worker deflated with compress_file """
+        crc, file_size, spool = compressed
+        st = os.stat(path)
+        zinfo = zipfile.ZipInfo(arcname, time.localtime(st.st_mtime)[0:6])
+        zinfo.create_system = 3
+        zinfo.external_attr = (st.st_mode & 0xFFFF) << 16
+        zinfo.CRC = crc
+        zinfo.file_size = file_size
+        try:
+            zinfo.compress_size = spool.tell()
+            if zinfo.compress_size < file_size:
+                zinfo.compress_type = zipfile.ZIP_DEFLATED
+                spool.seek(0)
+                self._append(zinfo, utils.read_chunks(spool, zinfo.compress_size))
+                return
+        finally:
+            spool.close()
+        # like zip, store files that don't get any smaller
+        zinfo.compress_type = zipfile.ZIP_STORED
+        zinfo.compress_size = file_size
+        with open(path, 'rb') as f:
+            self._append(zinfo, utils.read_chunks(f, file_size))
+
+    def write_file(self, path, arcname, compress_type=None):
+        """ Add a file, directory, or symlink on disk to the archive. Unless
+            compress_type is given, the compression policy decides how to store it """
+        if compress_type is None:
+            compress_type = self.compression_policy.get_compress_type(arcname)
+        if islink(path):
+            self._queue(lambda _: self._write_symlink(path, arcname))
+        elif isdir(path) or compress_type == zipfile.ZIP_STORED:
+            self._queue(lambda _: self.zipfile_obj.write(path, arcname, zipfile.ZIP_STORED))
+        else:
+            result = self.pool.apply_async(compress_file, (path, self.compression_policy.level))
+            self._queue(lambda compressed: self._write_compressed(path, arcname, compressed), result)
+
+
+def _walk_arcnames(containing_dir):
+    """ (path, arcname) of everything in a directory, in the order `zip -r` would
+        add them. Symlinks to directories are included, but not followed """
+    for root, dirs, files in os.walk(containing_dir):
+        dirs.sort()
+        for name in dirs:
+            path = join(root, name)
+            arcname = relpath(path, containing_dir)
+            yield path, arcname if islink(path) else arcname + '/'
+        for name in sorted(files):
+            path = join(root, name)
+            yield path, relpath(path, containing_dir)
+
+
+def write_directory(containing_dir, output_path, compression_policy=None):
+    """ Zip up everything in containing_dir, like `zip -qr` would """
+    with ZipWriter(output_path, compression_policy=compression_policy) as writer:
+        for path, arcname in _walk_arcnames(containing_dir):
+            writer.write_file(path, arcname)
+
+
+def write_archive(containing_dir, output_path, manifest, compression_policy=None):
+    """ Zip up containing_dir, which was extracted from manifest.zip_path and then
+        modified. Members that weren't touched since extraction are copied from
+        the original archive as they are; the rest are compressed again, according
+        to compression_policy """
+    copied = 0
+    compressed = 0
+    written = set()
+    with open(manifest.zip_path, 'rb') as source_fp, \
+            ZipWriter(output_path, compression_policy=compression_policy) as writer:
+        source = zipfile.ZipFile(source_fp)
+        # keep the original order of members
+        for zinfo in source.infolist():
+            arcname = zip_reader.encode_path(zinfo.filename)
+            path = manifest.get_path(arcname)
+            if arcname in written:
+                continue
+            if manifest.is_unchanged(zinfo.filename) or (zip_reader.is_dir(zinfo) and lexists(path)):
+                # including members we never extracted
+                writer.copy_member(source_fp, zinfo)
+                copied += 1
+            elif not lexists(path):
+                # deleted while resigning
+                continue
+            else:
+                compress_type = writer.compression_policy.get_compress_type(arcname, zinfo)
+                writer.write_file(path, zinfo.filename, compress_type)
+                compressed += 1
+            written.add(arcname)
+
+        # then anything that was added while resigning
+        for path, arcname in _walk_arcnames(containing_dir):
+            if arcname not in written:
+                writer.write_file(path, arcname)
+                compressed += 1
+    log.debug("copied %d members, compressed %d into %s", copied, compressed, output_path)
+
+
+def compact_archive(path):
+    """ Rewrite an archive without its dead space. Members are copied as they are """
+    temp_fd, temp_path = tempfile.mkstemp(prefix='.isign-compact-', dir=os.path.dirname(path))
+    os.close(temp_fd)
+    try:
+        with open(path, 'rb') as source_fp, ZipWriter(temp_path) as writer:
+            for zinfo in zipfile.ZipFile(source_fp).infolist():
+                writer.copy_member(source_fp, zinfo)
+        # it takes the place of the user's archive, so it keeps its mode, not mkstemp's
+        shutil.copymode(path, temp_path)
+        os.rename(temp_path, path)
+    finally:
+        if lexists(temp_path):
+            os.unlink(temp_path)
+
+
+def update_archive(containing_dir, manifest, compression_policy=None,
+                   max_dead_space_ratio=MAX_DEAD_SPACE_RATIO):
+    """ Like write_archive, but updates manifest.zip_path itself. Only members
+        that changed since extraction, and new files, are written, at the end of
+        the archive. If that leaves the archive too much dead space, it is
+        compacted. If anything goes wrong, the archive is left as it was.
+        Raises ArchiveLocked if another process is updating it """
+    with ArchiveLock(manifest.zip_path):
+        _update_archive(containing_dir, manifest, compression_policy, max_dead_space_ratio)
+
+
+def _update_archive(containing_dir, manifest, compression_policy, max_dead_space_ratio):
+    """ update_archive, with the archive locked """
+    path = manifest.zip_path
+    compressed = 0
+    removed = 0
+    with ZipWriter(path, compression_policy=compression_policy, append=True) as writer:
+        written = set()
+        for zinfo in writer.zipfile_obj.infolist():
+            arcname = zip_reader.encode_path(zinfo.filename)
+            member_path = manifest.get_path(arcname)
+            if arcname in written:
+                continue
+            written.add(arcname)
+            if manifest.is_unchanged(zinfo.filename) or (zip_reader.is_dir(zinfo) and lexists(member_path)):
+                continue
+            writer.remove(zinfo.filename)
+            if lexists(member_path):
+                compress_type = writer.compression_policy.get_compress_type(arcname, zinfo)
+                writer.write_file(member_path, zinfo.filename, compress_type)
+                compressed += 1
+            else:
+                # deleted while resigning
+                removed += 1
+
+        for member_path, arcname in _walk_arcnames(containing_dir):
+            if arcname not in written:
+                writer.write_file(member_path, arcname)
+                compressed += 1
+    log.debug("updated %s in place: compressed %d members, removed %d", path, compressed, removed)
+
+    dead_space = get_dead_space(path)
+    if dead_space > max_dead_space_ratio * os.path.getsize(path):
+        log.debug("compacting %s, %d bytes are dead space", path, dead_space)
+        compact_archive(path)
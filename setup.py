@@ -41,7 +41,6 @@ setup(
     install_requires=[
         'biplist==0.9',
         'construct==2.5.2',
-        'memoizer==0.0.1',
         'pyOpenSSL>=19'
     ],
     package_data={
@@ -51,6 +50,7 @@ setup(
     },
     scripts=['bin/isign',
              'bin/multisign',
+             'bin/isign_inventory',
              'bin/isign_export_creds.sh',
              'bin/isign_guess_mobileprovision.sh']
 )
@@ -0,0 +1,57 @@
+# compare how long it takes to zip up an extracted app, with the external `zip`
+# helper and with zip_writer at various numbers of workers.
+#
+#     python tests/benchmark_zip.py [path/to/app.ipa] [workers ...]
+
+from isign_base_test import IsignBaseTest
+from isign import zip_reader, zip_writer
+from distutils import spawn
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def timed(label, func, output_path):
+    if os.path.exists(output_path):
+        os.unlink(output_path)
+    start = time.time()
+    func()
+    elapsed = time.time() - start
+    print "{:<24} {:>8.2f}s {:>12d} bytes".format(label, elapsed, os.path.getsize(output_path))
+
+
+def zip_helper(containing_dir, output_path):
+    subprocess.check_call(['zip', '-qr', output_path, '.'], cwd=containing_dir)
+
+
+def zip_writer_workers(containing_dir, output_path, workers):
+    with zip_writer.ZipWriter(output_path, workers=workers) as writer:
+        for path, arcname in zip_writer._walk_arcnames(containing_dir):
+            writer.write_file(path, arcname)
+
+
+ipa_path = sys.argv[1] if len(sys.argv) > 1 else IsignBaseTest.TEST_IPA_XCODE11
+workers_counts = [int(arg) for arg in sys.argv[2:]] or sorted(set([1, multiprocessing.cpu_count()]))
+
+temp_dir = tempfile.mkdtemp(prefix='isign-benchmark-')
+try:
+    containing_dir = os.path.join(temp_dir, 'extracted')
+    output_path = os.path.join(temp_dir, 'output.zip')
+    manifest = zip_reader.extract(ipa_path, containing_dir)
+    print "zipping {}".format(ipa_path)
+
+    if spawn.find_executable('zip'):
+        timed('zip -qr', lambda: zip_helper(containing_dir, output_path), output_path)
+    for workers in workers_counts:
+        timed('zip_writer, {} workers'.format(workers),
+              lambda: zip_writer_workers(containing_dir, output_path, workers),
+              output_path)
+    timed('zip_writer, raw copy',
+          lambda: zip_writer.write_archive(containing_dir, output_path, manifest),
+          output_path)
+finally:
+    shutil.rmtree(temp_dir)
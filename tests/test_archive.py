@@ -1,6 +1,10 @@
 from isign_base_test import IsignBaseTest
 from isign.archive import archive_factory, Archive, AppArchive, AppZipArchive, IpaArchive
+from isign import archive as isign_archive
+from isign import zip_reader
 import logging
+import os
+import stat
 
 log = logging.getLogger(__name__)
 
@@ -37,6 +41,67 @@ class TestArchive(IsignBaseTest):
     def test_archive_factory_simulator_app(self):
         self._test_good(self.TEST_SIMULATOR_APP_XCODE7, AppZipArchive)
 
+    def test_archive_factory_reads_zip_once(self):
+        """ detection, info and extraction all share one index of the zip file """
+        indexes = []
+        original_zip_index = zip_reader.ZipIndex
+
+        def counting_zip_index(path):
+            index = original_zip_index(path)
+            indexes.append(index)
+            return index
+
+        zip_reader.ZipIndex = counting_zip_index
+        ua = None
+        try:
+            archive = archive_factory(self.TEST_IPA_XCODE11)
+            assert archive.__class__ is IpaArchive
+            assert archive.relative_bundle_dir == 'Payload/IsignTestApp.app/'
+            assert archive.bundle_info['CFBundleName'] == 'IsignTestApp'
+            ua = archive.unarchive_to_temp()
+            assert len(indexes) == 1
+            assert archive.index is indexes[0]
+        finally:
+            zip_reader.ZipIndex = original_zip_index
+            if ua is not None:
+                ua.remove()
+
+    def test_zip_indexes_closed(self):
+        """ every index we open is closed, whether or not the zip file is an app """
+        indexes = []
+        original_zip_index = zip_reader.ZipIndex
+
+        def recording_zip_index(path):
+            index = original_zip_index(path)
+            indexes.append(index)
+            return index
+
+        output_path = self.get_temp_file()
+        zip_reader.ZipIndex = recording_zip_index
+        try:
+            assert archive_factory(self.TEST_NONAPP_IPA) is None
+            isign_archive.view(self.TEST_WATCH_IPA_XCODE11, details=True)
+            self.resign(self.TEST_IPA_XCODE11, output_path=output_path)
+            with archive_factory(self.TEST_IPA_XCODE11) as archive:
+                assert archive.bundle_info is not None
+            assert len(indexes) == 4
+            for index in indexes:
+                assert index.zipfile_obj.fp is None
+        finally:
+            zip_reader.ZipIndex = original_zip_index
+            self.unlink(output_path)
+
+    def test_archive_mode(self):
+        """ a new archive gets the usual mode for a new file, not mkstemp's """
+        output_path = self.get_temp_file()
+        umask = os.umask(0o022)
+        try:
+            self.resign(self.TEST_IPA_XCODE11, output_path=output_path)
+            assert stat.S_IMODE(os.stat(output_path).st_mode) == 0o644
+        finally:
+            os.umask(umask)
+            self.unlink(output_path)
+
 
 class TestBundleInfo(IsignBaseTest):
 
@@ -56,6 +121,43 @@ class TestBundleInfo(IsignBaseTest):
         self._test_bundle_info(self.TEST_IPA_XCODE7)
 
 
+class TestView(IsignBaseTest):
+
+    def _view_without_temp_dirs(self, path, details=False):
+        """ view, making sure nothing gets unarchived """
+        def no_temp_dirs():
+            raise AssertionError("view should not unarchive")
+        original_make_temp_dir = isign_archive.make_temp_dir
+        isign_archive.make_temp_dir = no_temp_dirs
+        try:
+            return isign_archive.view(path, details)
+        finally:
+            isign_archive.make_temp_dir = original_make_temp_dir
+
+    def test_view_ipa(self):
+        bundle_info = self._view_without_temp_dirs(self.TEST_IPA_XCODE11)
+        assert bundle_info['CFBundleName'] == 'IsignTestApp'
+        assert isign_archive.VIEW_NESTED_BUNDLES_KEY not in bundle_info
+
+    def test_view_ipa_details(self):
+        bundle_info = self._view_without_temp_dirs(self.TEST_WATCH_IPA_XCODE11, details=True)
+        assert bundle_info['CFBundleIdentifier'] == 'net.neilk.isignTestWatchApp'
+        assert 'Name' in bundle_info[isign_archive.VIEW_PROVISIONING_PROFILE_KEY]
+        nested_paths = [nested['path'] for nested in bundle_info[isign_archive.VIEW_NESTED_BUNDLES_KEY]]
+        assert nested_paths == [
+            'Watch/isignTestWatchApp WatchKit App.app',
+            'Watch/isignTestWatchApp WatchKit App.app/PlugIns/isignTestWatchApp WatchKit Extension.appex'
+        ]
+        for nested in bundle_info[isign_archive.VIEW_NESTED_BUNDLES_KEY]:
+            assert 'CFBundleIdentifier' in nested['info']
+            assert 'Name' in nested['provisioning_profile']
+
+    def test_view_app_details(self):
+        bundle_info = self._view_without_temp_dirs(self.TEST_APP_XCODE7, details=True)
+        assert bundle_info['CFBundleName'] in ['IsignTestApp', 'isignTestApp']
+        assert bundle_info[isign_archive.VIEW_NESTED_BUNDLES_KEY] == []
+
+
 class TestArchivePrecheck(IsignBaseTest):
 
     def test_precheck_app(self):
@@ -0,0 +1,277 @@
+from isign_base_test import IsignBaseTest
+from isign import code_resources, zip_reader
+from isign.ledger import WriteLedger
+import hashlib
+import logging
+import os
+from os.path import join, relpath
+import plistlib
+import shutil
+from StringIO import StringIO
+import zipfile
+
+log = logging.getLogger(__name__)
+
+
+class TestCodeResources(IsignBaseTest):
+
+    def test_hashes(self):
+        """ both digests come from a single read of the file """
+        path = self.get_temp_file()
+        opened = []
+
+        def counting_open(*args, **kwargs):
+            opened.append(args[0])
+            return open(*args, **kwargs)
+
+        try:
+            content = 'x' * (3 * 1024 * 1024 + 17)
+            with open(path, 'wb') as f:
+                f.write(content)
+            code_resources.open = counting_open
+            digests = code_resources.get_hashes_binary(path)
+            assert digests['sha1'] == hashlib.sha1(content).digest()
+            assert digests['sha256'] == hashlib.sha256(content).digest()
+            assert code_resources.get_hash_hex(path, 'sha256') == hashlib.sha256(content).hexdigest()
+            assert opened == [path]
+            with self.assertRaises(ValueError):
+                code_resources.get_hash_binary(path, 'md5')
+        finally:
+            del code_resources.open
+            self.unlink(path)
+
+    def test_parallel_seal(self):
+        """ hashing on a pool of workers seals exactly like hashing serially """
+        temp_dir = self.get_temp_dir()
+        try:
+            seals = []
+            for workers in [1, 4]:
+                app_path = join(temp_dir, str(workers), 'Test.app')
+                shutil.copytree(self.TEST_APP_XCODE7, app_path)
+                seal_path = code_resources.make_seal(join(app_path, 'isignTestApp'),
+                                                     workers=workers)
+                seals.append(open(seal_path).read())
+            assert seals[0] == seals[1]
+            assert 'Info.plist' in seals[0]
+        finally:
+            self.unlink(temp_dir)
+
+    def test_scan_both(self):
+        """ one walk gives the same entries as scanning with and without omissions """
+        executable_path = join(self.TEST_APP_XCODE7, 'isignTestApp')
+        rules = code_resources.get_template()['rules2']
+        files, files2 = code_resources.ResourceBuilder(executable_path, rules).scan_both()
+        files = dict((path, entry.get_plist_value()) for path, entry in files.iteritems())
+        files2 = dict((path, entry.get_plist_value()) for path, entry in files2.iteritems())
+        assert files == code_resources.ResourceBuilder(executable_path, rules).scan()
+        assert files2 == code_resources.ResourceBuilder(executable_path, rules, True).scan()
+        assert set(files2) < set(files)
+
+    def test_seal_writer(self):
+        """ streaming entries writes exactly what plistlib would """
+        SealEntry = code_resources.SealEntry
+        files = {'Info.plist': SealEntry('\x01' * 20, '\x02' * 32),
+                 'a&b <c>.png': SealEntry('\xff' * 20, '\x00' * 32, optional=True),
+                 u'caf\xe9.lproj/x': SealEntry('x' * 20, 'y' * 32)}
+        files2 = dict(files)
+        files2['Current'] = SealEntry.for_symlink('A')
+        files2['lib&.dylib'] = SealEntry.for_symlink('../<lib>.dylib', optional=True)
+        del files2['Info.plist']
+        plist = code_resources.get_template()
+        plist['rules2']['^odd$'] = {'weight': 20.5, 'optional': True}
+        expected = dict(plist)
+        expected['files'] = dict((path, entry.get_plist_value()) for path, entry in files.iteritems())
+        expected['files2'] = dict((path, entry.get_plist_value()) for path, entry in files2.iteritems())
+        expected_output = StringIO()
+        plistlib.writePlist(expected, expected_output)
+        output = StringIO()
+        code_resources.SealWriter(output).write_seal(plist, files, files2)
+        assert output.getvalue() == expected_output.getvalue()
+        assert '<real>20.5</real>' in output.getvalue()
+
+    def test_rule_matcher(self):
+        """ the compiled matcher picks the same rules as trying each one in turn """
+        def find_rule(rules, path):
+            best_rule = code_resources.ResourceBuilder.NULL_PATH_RULE
+            for rule in rules:
+                if rule.matches(path):
+                    if rule.flags and rule.is_exclusion():
+                        return rule
+                    elif rule.weight > best_rule.weight:
+                        best_rule = rule
+            return best_rule
+
+        rules_data = code_resources.get_template()['rules2']
+        paths = ['Info.plist', 'info.PLIST', 'PkgInfo', 'isignTestApp', 'Assets.car',
+                 'en.lproj/Main.strings', 'fr.lproj/locversion.plist', 'a/.DS_Store',
+                 'Frameworks/Foo.framework/Foo', 'Foo.app.dSYM/Contents', 'PlugIns',
+                 'Base.lproj/LaunchScreen.storyboardc/Info.plist', 'version.plist']
+        custom_rules = dict(rules_data)
+        custom_rules[r'^(.)\1\.png$'] = {'weight': 3000.0}
+        for data in [rules_data, custom_rules]:
+            builder = code_resources.ResourceBuilder('Test.app/isignTestApp', data)
+            assert (builder.matcher.pattern is None) == (data is custom_rules)
+            for path in paths + ['aa.png', 'ab.png']:
+                assert builder.find_rule(path) is find_rule(builder.rules, path), path
+
+    def test_reuse_previous_seal(self):
+        """ files we didn't write, and which are older than the seal, aren't hashed again """
+        temp_dir = self.get_temp_dir()
+        get_hashes_binary = code_resources.get_hashes_binary
+        try:
+            app_path = join(temp_dir, 'Test.app')
+            shutil.copytree(self.TEST_APP_XCODE7, app_path)
+            executable_path = join(app_path, 'isignTestApp')
+            seal_path = code_resources.make_seal(executable_path, reuse=code_resources.REUSE_NEVER)
+            expected_seal = open(seal_path).read()
+            # as if the seal was made a minute after everything else
+            for root, _, filenames in os.walk(app_path):
+                for filename in filenames:
+                    os.utime(join(root, filename), (1000, 1000))
+            os.utime(seal_path, (1060, 1060))
+            os.utime(join(app_path, 'Assets.car'), (2000, 2000))
+            ledger = WriteLedger()
+            ledger.record(join(app_path, 'build.sh'))
+
+            hashed = []
+
+            def counting_get_hashes_binary(path):
+                hashed.append(relpath(path, app_path))
+                return get_hashes_binary(path)
+
+            code_resources.get_hashes_binary = counting_get_hashes_binary
+            seal_path = code_resources.make_seal(executable_path, ledger=ledger, workers=1,
+                                                 reuse=code_resources.REUSE_IF_OLDER)
+            assert open(seal_path).read() == expected_seal
+            assert seal_path in ledger
+            assert 'Assets.car' in hashed
+            assert 'build.sh' in hashed
+            assert 'Frameworks/libswiftUIKit.dylib' not in hashed
+            # files omitted from 'files2' have no sha256 there
+            assert 'PkgInfo' in hashed
+        finally:
+            code_resources.get_hashes_binary = get_hashes_binary
+            self.unlink(temp_dir)
+
+    def test_patched_resource(self):
+        """ a resource patched into an app, dated before its seal, is hashed again """
+        ipa_path = self.get_temp_file() + '.ipa'
+        output_path = self.get_temp_file() + '.ipa'
+        app_dir = 'Payload/IsignTestApp.app/'
+        icon_name = 'AppIcon60x60@2x.png'
+        patched_icon = 'not the original icon'
+        try:
+            original = zipfile.ZipFile(self.TEST_IPA_XCODE11)
+            seal_name = app_dir + '_CodeSignature/CodeResources'
+            original_seal = plistlib.readPlistFromString(original.read(seal_name))
+            patched = zipfile.ZipFile(ipa_path, 'w', zipfile.ZIP_DEFLATED)
+            for zinfo in original.infolist():
+                data = original.read(zinfo)
+                if zinfo.filename == app_dir + icon_name:
+                    data = patched_icon
+                    zinfo.date_time = (1990, 1, 1, 0, 0, 0)
+                patched.writestr(zinfo, data)
+            patched.close()
+            self.resign(ipa_path, output_path=output_path)
+            seal = plistlib.readPlistFromString(zipfile.ZipFile(output_path).read(seal_name))
+            assert seal['files'][icon_name]['hash'].data == hashlib.sha1(patched_icon).digest()
+            assert seal['files2'][icon_name]['hash2'].data == hashlib.sha256(patched_icon).digest()
+
+            # asking to trust the old seal is what lets its hashes through
+            self.resign(ipa_path, output_path=output_path, reuse=code_resources.REUSE_IF_UNWRITTEN)
+            seal = plistlib.readPlistFromString(zipfile.ZipFile(output_path).read(seal_name))
+            assert seal['files2'][icon_name]['hash2'] == original_seal['files2'][icon_name]['hash2']
+        finally:
+            self.unlink(ipa_path)
+            self.unlink(output_path)
+
+    def test_digest_cache(self):
+        """ digests are reused only while the file is unchanged, and only so many are kept """
+        temp_dir = self.get_temp_dir()
+        digest_cache = code_resources.get_digest_cache()
+        try:
+            path = join(temp_dir, 'file')
+            with open(path, 'wb') as f:
+                f.write('original')
+            assert code_resources.get_hashes_binary(path)['sha1'] == hashlib.sha1('original').digest()
+            hits = digest_cache.hits
+            code_resources.get_hashes_binary(path)
+            assert digest_cache.hits == hits + 1
+            with open(path, 'wb') as f:
+                f.write('changed')
+            assert code_resources.get_hashes_binary(path)['sha1'] == hashlib.sha1('changed').digest()
+            digest_cache.discard_tree(temp_dir)
+            assert path not in digest_cache.entries
+
+            small_cache = code_resources.DigestCache(max_entries=2)
+            for name in ['a', 'b', 'a', 'c']:
+                small_cache.put(name, (), {})
+            assert small_cache.entries.keys() == ['a', 'c']
+        finally:
+            self.unlink(temp_dir)
+
+    def test_custom_rules(self):
+        """ the template's rules are compiled once, and custom rules go on top of them """
+        assert code_resources.get_default_rules() is code_resources.get_default_rules()
+        temp_dir = self.get_temp_dir()
+        try:
+            app_path = join(temp_dir, 'Test.app')
+            shutil.copytree(self.TEST_APP_XCODE7, app_path)
+            rules = code_resources.get_default_rules().extend({r'^build\.sh$': {'omit': True, 'weight': 3000}})
+            assert r'^build\.sh$' not in code_resources.get_default_rules().data
+            seal_path = code_resources.make_seal(join(app_path, 'isignTestApp'), rules=rules)
+            seal = plistlib.readPlist(seal_path)
+            assert r'^build\.sh$' in seal['rules2']
+            assert 'build.sh' in seal['files']
+            assert 'build.sh' not in seal['files2']
+        finally:
+            self.unlink(temp_dir)
+
+    def test_nested_hashed_once(self):
+        """ resigning an app with nested bundles hashes no file twice """
+        output_path = self.get_temp_file()
+        hash_stream = zip_reader.hash_stream
+        hashed = []
+
+        def recording_hash_stream(source, target=None):
+            hashed.append(source.name.split('Payload/')[-1])
+            return hash_stream(source, target)
+
+        try:
+            zip_reader.hash_stream = recording_hash_stream
+            self.resign(self.TEST_WATCH_IPA_XCODE11, output_path=output_path)
+            assert len(hashed) > 0
+            assert len(set(hashed)) == len(hashed)
+        finally:
+            zip_reader.hash_stream = hash_stream
+            self.unlink(output_path)
+
+    def test_symlinks(self):
+        """ symlinks are sealed as links to their targets, and not read through """
+        temp_dir = self.get_temp_dir()
+        get_hashes_binary = code_resources.get_hashes_binary
+        try:
+            app_path = join(temp_dir, 'Test.app')
+            shutil.copytree(self.TEST_APP_XCODE7, app_path)
+            os.symlink('Assets.car', join(app_path, 'Shared.car'))
+            os.symlink('Base.lproj', join(app_path, 'Current'))
+            os.symlink('missing', join(app_path, 'broken'))
+            hashed = []
+
+            def counting_get_hashes_binary(path):
+                hashed.append(relpath(path, app_path))
+                return get_hashes_binary(path)
+
+            code_resources.get_hashes_binary = counting_get_hashes_binary
+            seal_path = code_resources.make_seal(join(app_path, 'isignTestApp'), workers=1)
+            seal = plistlib.readPlist(seal_path)
+            assert seal['files2']['Shared.car'] == {'symlink': 'Assets.car'}
+            assert seal['files2']['Current'] == {'symlink': 'Base.lproj'}
+            assert seal['files2']['broken'] == {'symlink': 'missing'}
+            assert 'Shared.car' not in seal['files']
+            assert not any(path.startswith('Current/') for path in seal['files2'])
+            assert hashed.count('Assets.car') == 1
+            assert 'Shared.car' not in hashed
+        finally:
+            code_resources.get_hashes_binary = get_hashes_binary
+            self.unlink(temp_dir)
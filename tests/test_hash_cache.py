@@ -0,0 +1,174 @@
+from isign_base_test import IsignBaseTest
+from isign import hash_cache, zip_reader
+import hashlib
+import os
+from os.path import join
+import logging
+import random
+import time
+import zipfile
+import zlib
+
+log = logging.getLogger(__name__)
+
+
+def make_digests(content):
+    return {'sha1': hashlib.sha1(content).digest(),
+            'sha256': hashlib.sha256(content).digest()}
+
+
+class TestHashCache(IsignBaseTest):
+
+    def check_cache(self, cache):
+        cache.put('a', make_digests('a'))
+        cache.put('b', make_digests('b'))
+        assert cache.get('a') == make_digests('a')
+        assert cache.get('c') is None
+        assert cache.get_stats() == {'hits': 1, 'misses': 1}
+
+    def test_sqlite(self):
+        path = self.get_temp_file()
+        try:
+            self.check_cache(hash_cache.SqliteHashCache(path))
+            # it persists
+            assert hash_cache.SqliteHashCache(path).get('b') == make_digests('b')
+        finally:
+            self.unlink(path)
+
+    def test_sqlite_evict(self):
+        """ the least recently used entries go """
+        path = self.get_temp_file()
+        try:
+            cache = hash_cache.SqliteHashCache(path, max_entries=2)
+            for key in ['a', 'b', 'c']:
+                cache.put(key, make_digests(key))
+                cache.connection.execute('UPDATE hashes SET used = ? WHERE key = ?', (ord(key), key))
+            cache.evict()
+            assert cache.get('a') is None
+            assert cache.get('c') is not None
+        finally:
+            self.unlink(path)
+
+    def test_sqlite_used(self):
+        """ a hit records when the entry was used, unless it did so recently """
+        path = self.get_temp_file()
+        try:
+            cache = hash_cache.SqliteHashCache(path)
+            cache.put('a', make_digests('a'))
+
+            def get_used():
+                return cache.connection.execute('SELECT used FROM hashes WHERE key = ?', ('a',)).fetchone()[0]
+            recently = time.time() - 10
+            cache.connection.execute('UPDATE hashes SET used = ?', (recently,))
+            cache.get('a')
+            assert get_used() == recently
+            cache.connection.execute('UPDATE hashes SET used = ?', (1000,))
+            cache.get('a')
+            assert get_used() > recently
+        finally:
+            self.unlink(path)
+
+    def test_directory(self):
+        path = self.get_temp_dir()
+        try:
+            self.check_cache(hash_cache.DirectoryHashCache(path))
+            assert hash_cache.DirectoryHashCache(path).get('b') == make_digests('b')
+        finally:
+            self.unlink(path)
+
+    def test_directory_evict(self):
+        """ the least recently used entries go, a shard at a time """
+        path = self.get_temp_dir()
+        try:
+            cache = hash_cache.DirectoryHashCache(path, max_entries=2 * hash_cache.DirectoryHashCache.SHARDS)
+            # all in shard '00'
+            keys = ['a00', 'b00', 'c00']
+            for key in keys:
+                cache.put(key, make_digests(key))
+                os.utime(cache.get_entry_path(key), (ord(key[0]), ord(key[0])))
+            # another shard is left alone
+            cache.put('a01', make_digests('a01'))
+            os.utime(cache.get_entry_path('a01'), (1, 1))
+            cache.evict_after_put('c00')
+            assert cache.get('a00') is None
+            assert cache.get('c00') is not None
+            assert cache.get('a01') is not None
+            cache.evict()
+            assert cache.get('b00') is not None
+            assert cache.get('a01') is not None
+        finally:
+            self.unlink(path)
+
+    def test_keys(self):
+        """ a file on disk has the same key as it had in the zip file """
+        temp_dir = self.get_temp_dir()
+        try:
+            index = zip_reader.ZipIndex(self.TEST_IPA_XCODE11)
+            zinfo = index.zipfile_obj.getinfo('Payload/IsignTestApp.app/Info.plist')
+            path = join(temp_dir, 'Info.plist')
+            with open(path, 'wb') as f:
+                f.write(index.read(zinfo.filename))
+            assert hash_cache.get_file_key(path) == hash_cache.get_zinfo_key(index.zipfile_obj, zinfo)
+            index.close()
+        finally:
+            self.unlink(temp_dir)
+
+    def test_large_keys(self):
+        """ the same for a file bigger than the samples, compressed in the zip file """
+        temp_dir = self.get_temp_dir()
+        try:
+            content = os.urandom(hash_cache.SAMPLE_SIZE) * 3 + 'end'
+            path = join(temp_dir, 'large')
+            with open(path, 'wb') as f:
+                f.write(content)
+            zip_path = join(temp_dir, 'large.zip')
+            with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipfile_obj:
+                zipfile_obj.write(path, 'large')
+            with zipfile.ZipFile(zip_path) as zipfile_obj:
+                zip_key = hash_cache.get_zinfo_key(zipfile_obj, zipfile_obj.getinfo('large'))
+            assert hash_cache.get_file_key(path) == zip_key
+        finally:
+            self.unlink(temp_dir)
+
+    def test_crc_collision(self):
+        """ files of the same size and CRC-32, but different contents, have different keys """
+        # random, since CRC-32 is linear, and similar contents collide much less often
+        seen = {}
+        generator = random.Random(0)
+        while True:
+            content = 'resource{:016x}'.format(generator.getrandbits(64))
+            crc = zlib.crc32(content)
+            if crc in seen:
+                break
+            seen[crc] = content
+        temp_dir = self.get_temp_dir()
+        try:
+            paths = []
+            for name, data in [('a', seen[crc]), ('b', content)]:
+                paths.append(join(temp_dir, name))
+                with open(paths[-1], 'wb') as f:
+                    f.write(data)
+            assert hash_cache.get_file_key(paths[0]) != hash_cache.get_file_key(paths[1])
+        finally:
+            self.unlink(temp_dir)
+
+    def test_extract(self):
+        """ the second time we see an archive, its large files aren't hashed. Small ones
+            aren't cached at all """
+        path = self.get_temp_file()
+        temp_dirs = [self.get_temp_dir(), self.get_temp_dir()]
+        try:
+            cache = hash_cache.configure(path)
+            ipa_path = self.TEST_FRAMEWORKS_IPA_XCODE11
+            manifests = [zip_reader.extract(ipa_path, temp_dir) for temp_dir in temp_dirs]
+            large = [zinfo for zinfo in zipfile.ZipFile(ipa_path).infolist()
+                     if zinfo.file_size > hash_cache.MAX_SAMPLED_SIZE]
+            assert cache.hits > 0
+            assert cache.hits == cache.misses
+            assert cache.hits <= len(large)
+            assert manifests[0].digests == manifests[1].digests
+        finally:
+            hash_cache.configure()
+            self.unlink(path)
+            for temp_dir in temp_dirs:
+                self.unlink(temp_dir)
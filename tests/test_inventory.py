@@ -0,0 +1,59 @@
+from isign_base_test import IsignBaseTest
+from isign import inventory
+import json
+import StringIO
+import struct
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class TestInventory(IsignBaseTest):
+
+    def test_inventory_app(self):
+        record = inventory.inventory_app(self.TEST_WATCH_IPA_XCODE11)
+        assert 'error' not in record
+        assert record['archive_type'] == 'IpaArchive'
+        assert record['bundle_id'] == 'net.neilk.isignTestWatchApp'
+        assert record['team_id'] == 'L37S4Z6BE9'
+        assert record['architectures'] == ['arm64']
+        nested_ids = [nested['bundle_id'] for nested in record['nested_bundles']]
+        assert nested_ids == ['net.neilk.isignTestWatchApp.watchkitapp',
+                              'net.neilk.isignTestWatchApp.watchkitapp.watchkitextension']
+
+    def test_inventory_app_dir(self):
+        record = inventory.inventory_app(self.TEST_UNSIGNED_FAT_APP)
+        assert record['archive_type'] == 'AppArchive'
+        assert record['architectures'] == ['armv7', 'arm64']
+
+    def test_fat_64_architectures(self):
+        """ 64-bit fat headers have bigger fat_archs; either kind may be byte-swapped """
+        archs = [(inventory.CPU_TYPE_ARM64, 0), (inventory.CPU_TYPE_ARM64, 2)]
+        # magic -> format of a fat_arch: cputype, cpusubtype, offset, size, align (, reserved)
+        fat_arch_fmts = {0xcafebabe: 'IIIII', 0xcafebabf: 'IIQQII'}
+        for byte_order, magic in [('>', 0xcafebabf), ('<', 0xcafebabf), ('<', 0xcafebabe)]:
+            fat_arch_fmt = byte_order + fat_arch_fmts[magic]
+            header = struct.pack(byte_order + 'II', magic, len(archs))
+            for cputype, cpusubtype in archs:
+                fields = [cputype, cpusubtype, 0, 0, 14, 0][:len(fat_arch_fmt) - 1]
+                header += struct.pack(fat_arch_fmt, *fields)
+            assert inventory.get_architectures(header) == ['arm64', 'arm64e']
+
+    def test_inventory_not_an_app(self):
+        record = inventory.inventory_app(self.TEST_NONAPP_IPA)
+        assert record['error'] == 'not an app'
+
+    def test_find_apps(self):
+        paths = list(inventory.find_apps([self.TEST_XCODE11_DIR, self.TEST_XCODE7_DIR]))
+        assert self.TEST_IPA_XCODE11 in paths
+        assert self.TEST_APP_XCODE7 in paths
+        # we don't look inside apps
+        assert not [path for path in paths if path.startswith(self.TEST_APP_XCODE7 + '/')]
+
+    def test_inventory(self):
+        output = StringIO.StringIO()
+        count = inventory.write_json_lines(inventory.inventory([self.TEST_XCODE11_DIR], processes=2), output)
+        lines = output.getvalue().splitlines()
+        assert count == len(lines) == len(list(inventory.find_apps([self.TEST_XCODE11_DIR])))
+        records = dict((record['path'], record) for record in map(json.loads, lines))
+        assert records[self.TEST_IPA_XCODE11]['bundle_id'] == 'net.neilk.IsignTestApp'
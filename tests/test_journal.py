@@ -0,0 +1,151 @@
+from isign_base_test import IsignBaseTest
+from isign import signable
+from isign import journal
+from isign.journal import JournaledFile
+import logging
+import os
+
+log = logging.getLogger(__name__)
+
+ORIGINAL = ''.join(chr(i % 256) for i in range(10000))
+
+
+class TestJournal(IsignBaseTest):
+
+    def write_original(self):
+        path = self.get_temp_file()
+        with open(path, 'wb') as f:
+            f.write(ORIGINAL)
+        return path
+
+    def patch(self, f):
+        f.seek(100)
+        f.write('a' * 50)
+        f.seek(120)
+        f.write('b' * 50)
+        f.seek(9990)
+        f.write('c' * 20)
+
+    def test_commit(self):
+        path = self.write_original()
+        try:
+            with JournaledFile(path) as f:
+                self.patch(f)
+            expected = ORIGINAL[:100] + 'a' * 20 + 'b' * 50 + ORIGINAL[170:9990] + 'c' * 20
+            assert open(path, 'rb').read() == expected
+        finally:
+            self.unlink(path)
+
+    def test_rollback(self):
+        """ everything we overwrote or appended is undone """
+        path = self.write_original()
+        try:
+            with self.assertRaises(ValueError):
+                with JournaledFile(path) as f:
+                    self.patch(f)
+                    assert f.get_journal_size() == 50 + 50 + 10
+                    raise ValueError()
+            assert open(path, 'rb').read() == ORIGINAL
+        finally:
+            self.unlink(path)
+
+    def test_reads_see_writes(self):
+        path = self.write_original()
+        try:
+            with JournaledFile(path) as f:
+                self.patch(f)
+                f.seek(95)
+                assert f.read(30) == ORIGINAL[95:100] + 'a' * 20 + 'b' * 5
+                f.seek(-25, os.SEEK_END)
+                assert f.read() == ORIGINAL[9985:9990] + 'c' * 20
+                assert open(path, 'rb').read() == ORIGINAL
+        finally:
+            self.unlink(path)
+
+    def test_recover(self):
+        """ if we die partway through patching, the journal on disk undoes it """
+        path = self.write_original()
+        journal_path = journal.get_journal_path(path)
+        try:
+            f = JournaledFile(path)
+            self.patch(f)
+            with open(journal_path, 'wb') as journal_file:
+                journal_file.write(journal.encode_journal(f.original_size, f.get_journal()))
+            # as if we were killed after the first two writes
+            for offset, data in f.writes[:2]:
+                f.f.seek(offset)
+                f.f.write(data)
+            f.f.close()
+            assert open(path, 'rb').read() != ORIGINAL
+            assert journal.recover(path) is True
+            assert open(path, 'rb').read() == ORIGINAL
+            assert not os.path.exists(journal_path)
+
+            # an incomplete journal is from before we wrote anything
+            with open(journal_path, 'wb') as journal_file:
+                journal_file.write(journal.encode_journal(10, [(0, 'xyz')])[:-1])
+            assert journal.recover(path) is True
+            assert open(path, 'rb').read() == ORIGINAL
+            assert journal.recover(path) is False
+        finally:
+            self.unlink(path)
+            self.unlink(journal_path)
+
+    def test_undo_in_memory(self):
+        """ a file that needn't survive a crash gets no journal on disk, but if
+            writing the patches fails, it is still put back """
+        path = self.write_original()
+        journal_path = journal.get_journal_path(path)
+
+        class FailingFile(object):
+            """ fails the second write, like a disk that was briefly full """
+            def __init__(self, f):
+                self.f = f
+                self.writes = 0
+
+            def write(self, data):
+                self.writes += 1
+                if self.writes == 2:
+                    assert not os.path.exists(journal_path)
+                    raise IOError("no space left on device")
+                self.f.write(data)
+
+            def __getattr__(self, name):
+                return getattr(self.f, name)
+        try:
+            f = JournaledFile(path, durable=False)
+            self.patch(f)
+            f.f = FailingFile(f.f)
+            with self.assertRaises(IOError):
+                f.commit()
+            assert open(path, 'rb').read() == ORIGINAL
+            assert not os.path.exists(journal_path)
+        finally:
+            self.unlink(path)
+
+    def test_scratch_not_durable(self):
+        """ resigning an archive patches copies in scratch space, which need no journal on disk """
+        def write_journal(self, journal):
+            raise AssertionError("journaled {} on disk".format(self.path))
+        output_path = self.get_temp_file()
+        original_write_journal = JournaledFile.write_journal
+        try:
+            JournaledFile.write_journal = write_journal
+            self.resign(self.TEST_WATCH_IPA_XCODE11, output_path=output_path)
+        finally:
+            JournaledFile.write_journal = original_write_journal
+            self.unlink(output_path)
+
+    def test_sign_in_place(self):
+        """ binaries whose new signatures fit are patched, not copied """
+        class NoTempFiles(object):
+            def NamedTemporaryFile(self, *args, **kwargs):
+                raise AssertionError("copied a binary to sign it")
+        output_path = self.get_temp_file()
+        tempfile = signable.tempfile
+        try:
+            signable.tempfile = NoTempFiles()
+            self.resign(self.TEST_WATCH_IPA_XCODE11, output_path=output_path)
+        finally:
+            signable.tempfile = tempfile
+            self.unlink(output_path)
@@ -0,0 +1,70 @@
+from isign_base_test import IsignBaseTest
+from isign import zip_writer
+from nose.plugins.skip import SkipTest
+import os
+from os.path import join
+import resource
+import sys
+import zipfile
+import logging
+
+log = logging.getLogger(__name__)
+
+# bigger than anything a zip file without Zip64 extensions can hold
+LARGE_FILE_SIZE = (1 << 32) + (1 << 20)
+LARGE_FILE_NAME = 'Payload/IsignTestApp.app/large.dat'
+
+# resigning should never need much more memory than this, however big the app
+MAX_RSS = 256 * 1024 * 1024
+
+
+def get_max_rss():
+    """ Peak resident memory of this process, in bytes """
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return max_rss
+    return max_rss * 1024
+
+
+class TestLargeArchive(IsignBaseTest):
+    """ Writes about 9GB of temporary files, so only runs if ISIGN_TEST_LARGE is set """
+
+    def setUp(self):
+        if not os.environ.get('ISIGN_TEST_LARGE'):
+            raise SkipTest
+        super(TestLargeArchive, self).setUp()
+
+    def make_large_ipa(self, temp_dir):
+        """ The test IPA, with a file over 4GB added in front, so every other
+            member is also past 4GB into the archive """
+        large_path = join(temp_dir, 'large.dat')
+        with open(large_path, 'wb') as f:
+            f.truncate(LARGE_FILE_SIZE)
+        ipa_path = join(temp_dir, 'large.ipa')
+        with open(self.TEST_IPA_XCODE11, 'rb') as source_fp, \
+                zip_writer.ZipWriter(ipa_path) as writer:
+            writer.write_file(large_path, LARGE_FILE_NAME, zipfile.ZIP_STORED)
+            for zinfo in zipfile.ZipFile(source_fp).infolist():
+                writer.copy_member(source_fp, zinfo)
+        os.unlink(large_path)
+        return ipa_path
+
+    def test_resign_large_ipa(self):
+        temp_dir = self.get_temp_dir()
+        try:
+            ipa_path = self.make_large_ipa(temp_dir)
+            output_path = join(temp_dir, 'resigned.ipa')
+            self.resign(ipa_path, output_path=output_path)
+
+            original = zipfile.ZipFile(ipa_path)
+            resigned = zipfile.ZipFile(output_path)
+            assert resigned.namelist() == original.namelist()
+            large_zinfo = resigned.getinfo(LARGE_FILE_NAME)
+            assert large_zinfo.file_size == LARGE_FILE_SIZE
+            assert large_zinfo.CRC == original.getinfo(LARGE_FILE_NAME).CRC
+            info_zinfo = resigned.getinfo('Payload/IsignTestApp.app/Info.plist')
+            assert info_zinfo.header_offset > zipfile.ZIP64_LIMIT
+            assert resigned.read(info_zinfo) == original.read(info_zinfo.filename)
+            assert get_max_rss() < MAX_RSS
+        finally:
+            self.unlink(temp_dir)
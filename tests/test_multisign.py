@@ -1,6 +1,7 @@
 from isign_base_test import IsignBaseTest
 import os
 from os.path import exists
+import zipfile
 from isign.multisign import multisign
 import logging
 
@@ -22,3 +23,19 @@ class TestMultisign(IsignBaseTest):
             assert exists(output_path)
             assert os.path.getsize(output_path) > 0
             self.unlink(output_path)
+
+    def test_multisign_app(self):
+        """ everything handed to the pool of processes can be pickled """
+        output_paths = [self.get_temp_file() + '.ipa', self.get_temp_file() + '.ipa']
+        creds_dir_to_output_paths = {
+            self.CREDENTIALS_DIR: output_paths[0],
+            self.CREDENTIALS_DIR_2: output_paths[1]
+        }
+        try:
+            results = multisign(self.TEST_IPA_XCODE11, creds_dir_to_output_paths)
+            assert sorted(results) == sorted(creds_dir_to_output_paths.items())
+            for output_path in output_paths:
+                assert zipfile.ZipFile(output_path).testzip() is None
+        finally:
+            for output_path in output_paths:
+                self.unlink(output_path)
@@ -0,0 +1,69 @@
+from isign_base_test import IsignBaseTest
+from isign import scratch
+from isign.archive import archive_factory
+from isign.exceptions import OutOfScratchSpace
+from os.path import exists, join
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class TestScratch(IsignBaseTest):
+
+    def test_budget(self):
+        """ space is reserved until the directory is removed """
+        root = self.get_temp_dir()
+        try:
+            scratch_space = scratch.ScratchSpace([root], budget=100)
+            first = scratch_space.mkdtemp(60)
+            assert scratch_space.reservations[first] == (root, 60)
+            with self.assertRaises(OutOfScratchSpace):
+                scratch_space.mkdtemp(60)
+            scratch_space.remove(first)
+            assert not exists(first)
+            second = scratch_space.mkdtemp(60)
+            scratch_space.cleanup()
+            assert not exists(second)
+            assert scratch_space.get_reserved() == 0
+        finally:
+            self.unlink(root)
+
+    def test_roots(self):
+        """ the first root with room is used """
+        small_root = self.get_temp_dir()
+        large_root = self.get_temp_dir()
+        get_free_space = scratch.get_free_space
+        try:
+            free_space = {small_root: 100, large_root: 1000}
+            scratch.get_free_space = lambda root: free_space[root]
+            scratch_space = scratch.ScratchSpace([join(small_root, 'missing'), small_root, large_root])
+            first = scratch_space.mkdtemp(60)
+            assert scratch_space.reservations[first][0] == small_root
+            # 40 bytes left on the small root
+            second = scratch_space.mkdtemp(60)
+            assert scratch_space.reservations[second][0] == large_root
+            with self.assertRaises(OutOfScratchSpace):
+                scratch_space.mkdtemp(2000)
+            scratch_space.cleanup()
+        finally:
+            scratch.get_free_space = get_free_space
+            self.unlink(small_root)
+            self.unlink(large_root)
+
+    def test_scratch_size(self):
+        """ selective extraction needs less space, worked out from the central directory """
+        archive = archive_factory(self.TEST_IPA_XCODE11)
+        selective_size = archive.get_scratch_size(selective=True)
+        assert 0 < selective_size < archive.get_scratch_size()
+
+    def test_resign_over_budget(self):
+        """ we fail before unarchiving anything """
+        output_path = self.get_temp_file()
+        try:
+            scratch.configure(budget=1)
+            with self.assertRaises(OutOfScratchSpace):
+                self.resign(self.TEST_IPA_XCODE11, output_path=output_path)
+            assert not exists(output_path)
+        finally:
+            scratch.configure()
+            self.unlink(output_path)
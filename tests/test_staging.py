@@ -0,0 +1,88 @@
+from isign_base_test import IsignBaseTest
+from isign import staging, utils
+import hashlib
+import os
+from os.path import join, relpath
+import shutil
+import logging
+
+log = logging.getLogger(__name__)
+
+
+def get_file_hashes(path):
+    """ sha1 of every file under path, by relative path """
+    hashes = {}
+    for root, _, filenames in os.walk(path):
+        for filename in filenames:
+            file_path = join(root, filename)
+            with open(file_path, 'rb') as f:
+                hashes[relpath(file_path, path)] = hashlib.sha1(f.read()).hexdigest()
+    return hashes
+
+
+class TestStaging(IsignBaseTest):
+
+    def test_stage(self):
+        """ staged apps have the same files, and never share the ones resigning rewrites """
+        temp_dir = self.get_temp_dir()
+        try:
+            staged_path = join(temp_dir, 'Test.app')
+            staging.stage(self.TEST_APP_XCODE7, staged_path)
+            assert get_file_hashes(staged_path) == get_file_hashes(self.TEST_APP_XCODE7)
+            for relative_path in ['Info.plist', 'isignTestApp', '_CodeSignature/CodeResources']:
+                original_stat = os.stat(join(self.TEST_APP_XCODE7, relative_path))
+                staged_stat = os.stat(join(staged_path, relative_path))
+                assert staged_stat.st_ino != original_stat.st_ino
+                assert staged_stat.st_mode == original_stat.st_mode
+            assert not staging.is_mutable(join(staged_path, 'Assets.car'), 'Assets.car')
+        finally:
+            self.unlink(temp_dir)
+
+    def test_break_link(self):
+        temp_dir = self.get_temp_dir()
+        try:
+            original_path = join(temp_dir, 'original')
+            linked_path = join(temp_dir, 'linked')
+            with open(original_path, 'w') as f:
+                f.write('original')
+            os.link(original_path, linked_path)
+            utils.break_link(linked_path)
+            with open(linked_path, 'w') as f:
+                f.write('changed')
+            assert open(original_path).read() == 'original'
+            assert os.stat(original_path).st_nlink == 1
+        finally:
+            self.unlink(temp_dir)
+
+    def test_resign_leaves_original(self):
+        """ resigning a staged app doesn't write through to the original """
+        temp_dir = self.get_temp_dir()
+        try:
+            app_path = join(temp_dir, 'Test.app')
+            shutil.copytree(self.TEST_APP_XCODE7, app_path)
+            original_hashes = get_file_hashes(app_path)
+            output_path = join(temp_dir, 'Resigned.app')
+            self.resign(app_path, output_path=output_path,
+                        info_props={'CFBundleDisplayName': 'Resigned'})
+            assert get_file_hashes(app_path) == original_hashes
+            assert get_file_hashes(output_path) != original_hashes
+        finally:
+            self.unlink(temp_dir)
+
+    def test_resigned_app_not_linked(self):
+        """ the resigned app shares no files with the original, even where staging linked them """
+        temp_dir = self.get_temp_dir()
+        try:
+            app_path = join(temp_dir, 'Test.app')
+            shutil.copytree(self.TEST_APP_XCODE7, app_path)
+            output_path = join(temp_dir, 'Resigned.app')
+            self.resign(app_path, output_path=output_path)
+            for root, _, filenames in os.walk(output_path):
+                for filename in filenames:
+                    st = os.lstat(join(root, filename))
+                    assert st.st_nlink == 1, relpath(join(root, filename), output_path)
+            for root, _, filenames in os.walk(app_path):
+                for filename in filenames:
+                    assert os.lstat(join(root, filename)).st_nlink == 1
+        finally:
+            self.unlink(temp_dir)
@@ -0,0 +1,182 @@
+from isign_base_test import IsignBaseTest
+from isign.exceptions import NotSignable
+from isign import code_resources, zip_reader
+import hashlib
+import os
+from os.path import exists, islink, join
+import plistlib
+import stat
+import struct
+import zipfile
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class TestZipReader(IsignBaseTest):
+
+    def _make_zip(self, members):
+        """ members is a list of (name, unix mode, contents) """
+        zip_path = self.get_temp_file() + '.zip'
+        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipfile_obj:
+            for name, mode, contents in members:
+                zinfo = zipfile.ZipInfo(name, (2020, 1, 2, 3, 4, 6))
+                zinfo.create_system = 3
+                zinfo.external_attr = mode << 16
+                zipfile_obj.writestr(zinfo, contents)
+        return zip_path
+
+    def test_extract(self):
+        zip_path = self._make_zip([
+            ('Payload/', stat.S_IFDIR | 0o755, ''),
+            ('Payload/Foo.app/Foo', stat.S_IFREG | 0o755, 'executable'),
+            ('Payload/Foo.app/data.txt', stat.S_IFREG | 0o644, 'data' * 10000),
+            ('Payload/Foo.app/link.txt', stat.S_IFLNK | 0o777, 'data.txt'),
+        ])
+        target_dir = self.get_temp_dir()
+        try:
+            zip_reader.extract(zip_path, target_dir)
+            app_dir = join(target_dir, 'Payload', 'Foo.app')
+            executable = join(app_dir, 'Foo')
+            assert open(executable).read() == 'executable'
+            assert stat.S_IMODE(os.stat(executable).st_mode) == 0o755
+            assert stat.S_IMODE(os.stat(join(app_dir, 'data.txt')).st_mode) == 0o644
+            assert open(join(app_dir, 'data.txt')).read() == 'data' * 10000
+            assert islink(join(app_dir, 'link.txt'))
+            assert os.readlink(join(app_dir, 'link.txt')) == 'data.txt'
+        finally:
+            self.unlink(target_dir)
+            self.unlink(zip_path)
+
+    def test_zip_index(self):
+        zip_path = self._make_zip([
+            ('Payload/Foo.app/Info.plist', stat.S_IFREG | 0o644, 'plist'),
+            ('Payload/Foo.app/Frameworks/Bar.framework/Bar', stat.S_IFREG | 0o755, 'bar'),
+            ('top.txt', stat.S_IFREG | 0o644, 'top'),
+        ])
+        try:
+            index = zip_reader.ZipIndex(zip_path)
+            assert index.dir_prefixes == set(['Payload/', 'Payload/Foo.app/'])
+            assert 'top.txt' in index.names
+            assert index.read('Payload/Foo.app/Info.plist') == 'plist'
+            assert 'Payload/Foo.app/Info.plist' in index.contents
+            index.close()
+        finally:
+            self.unlink(zip_path)
+
+    def test_is_macho(self):
+        """ thin and fat binaries, including fat ones with 64-bit headers """
+        members = [(name, stat.S_IFREG | 0o755, struct.pack('>I', magic) + 'rest')
+                   for name, magic in [('thin', 0xfeedfacf), ('fat', 0xcafebabe),
+                                       ('fat64', 0xcafebabf), ('text', 0x23212f62)]]
+        zip_path = self._make_zip(members)
+        try:
+            zipfile_obj = zipfile.ZipFile(zip_path)
+            assert [zip_reader.is_macho(zipfile_obj, zinfo) for zinfo in zipfile_obj.infolist()] == \
+                [True, True, True, False]
+            zipfile_obj.close()
+        finally:
+            self.unlink(zip_path)
+
+    def test_extract_unsafe_path(self):
+        zip_path = self._make_zip([
+            ('../escaped.txt', stat.S_IFREG | 0o644, 'nope'),
+        ])
+        target_dir = self.get_temp_dir()
+        try:
+            with self.assertRaises(NotSignable):
+                zip_reader.extract(zip_path, target_dir)
+            assert not exists(join(target_dir, '..', 'escaped.txt'))
+        finally:
+            self.unlink(target_dir)
+            self.unlink(zip_path)
+
+    def test_extract_utf8_name(self):
+        """ zipfile gives us unicode for these; we must still write byte paths,
+            which works whatever the locale's encoding is """
+        name = u'Payload/Foo.app/caf\xe9.txt'
+        zip_path = self._make_zip([(name, stat.S_IFREG | 0o644, 'data')])
+        target_dir = self.get_temp_dir()
+        try:
+            path = zip_reader.get_target_path(target_dir, name)
+            assert isinstance(path, str)
+            manifest = zip_reader.extract(zip_path, target_dir)
+            assert open(join(target_dir, name.encode('utf-8'))).read() == 'data'
+            assert manifest.is_unchanged(name)
+        finally:
+            self.unlink(target_dir)
+            self.unlink(zip_path)
+
+    def test_extract_ipa(self):
+        target_dir = self.get_temp_dir()
+        try:
+            zip_reader.extract(self.TEST_IPA_XCODE11, target_dir)
+            with zipfile.ZipFile(self.TEST_IPA_XCODE11) as zipfile_obj:
+                for zinfo in zipfile_obj.infolist():
+                    path = join(target_dir, zinfo.filename)
+                    assert os.path.lexists(path), path
+        finally:
+            self.unlink(target_dir)
+
+    def test_extract_selective(self):
+        """ only files that resigning rewrites are extracted, the rest are hashed from the zip """
+        target_dir = self.get_temp_dir()
+        try:
+            manifest = zip_reader.extract(self.TEST_IPA_XCODE11, target_dir, selective=True)
+            app_dir = join(target_dir, 'Payload', 'IsignTestApp.app')
+            for name in ['IsignTestApp', 'Info.plist', 'embedded.mobileprovision',
+                         join('_CodeSignature', 'CodeResources')]:
+                assert exists(join(app_dir, name)), name
+            assert exists(join(app_dir, 'Base.lproj', 'LaunchScreen.storyboardc'))
+            assert not exists(join(app_dir, 'Assets.car'))
+            assert not exists(join(app_dir, 'PkgInfo'))
+            assert 'Assets.car' in manifest.get_unextracted_filenames(app_dir)
+
+            asset_path = join(app_dir, 'Assets.car')
+            asset_name = 'Payload/IsignTestApp.app/Assets.car'
+            assert manifest.is_unchanged(asset_name)
+            contents = zipfile.ZipFile(self.TEST_IPA_XCODE11).read(asset_name)
+            assert manifest.get_hash_binary(asset_path, 'sha1') == hashlib.sha1(contents).digest()
+            assert manifest.get_hash_binary(asset_path, 'sha256') == hashlib.sha256(contents).digest()
+
+            # once something is written there, it's a changed file on disk
+            with open(asset_path, 'w') as f:
+                f.write('changed')
+            assert not manifest.is_unchanged(asset_name)
+            assert 'Assets.car' not in manifest.get_unextracted_filenames(app_dir)
+        finally:
+            self.unlink(target_dir)
+
+    def test_extract_hashes(self):
+        """ files are hashed while extracting, until they are changed """
+        target_dir = self.get_temp_dir()
+        try:
+            manifest = zip_reader.extract(self.TEST_IPA_XCODE11, target_dir)
+            info_path = join(target_dir, 'Payload', 'IsignTestApp.app', 'Info.plist')
+            contents = open(info_path, 'rb').read()
+            assert manifest.get_hash_binary(info_path, 'sha1') == hashlib.sha1(contents).digest()
+            assert manifest.get_hash_binary(info_path, 'sha256') == hashlib.sha256(contents).digest()
+            with open(info_path, 'ab') as f:
+                f.write('\n')
+            assert manifest.get_hash_binary(info_path, 'sha1') is None
+        finally:
+            self.unlink(target_dir)
+
+    def test_seal_selective(self):
+        """ sealing a selectively extracted app gives the same result as a full extraction """
+        full_dir = self.get_temp_dir()
+        selective_dir = self.get_temp_dir()
+        try:
+            app_path = join('Payload', 'isignTestWatchApp.app')
+            executable_path = join(app_path, 'isignTestWatchApp')
+            zip_reader.extract(self.TEST_WATCH_IPA_XCODE11, full_dir)
+            manifest = zip_reader.extract(self.TEST_WATCH_IPA_XCODE11, selective_dir, selective=True)
+            full_seal = code_resources.make_seal(join(full_dir, executable_path),
+                                                 join(full_dir, app_path))
+            selective_seal = code_resources.make_seal(join(selective_dir, executable_path),
+                                                      join(selective_dir, app_path),
+                                                      manifest)
+            assert plistlib.readPlist(full_seal) == plistlib.readPlist(selective_seal)
+        finally:
+            self.unlink(full_dir)
+            self.unlink(selective_dir)
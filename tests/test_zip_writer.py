@@ -0,0 +1,358 @@
+from isign_base_test import IsignBaseTest
+from isign.archive import archive_factory
+from isign import zip_reader, zip_writer
+from isign.exceptions import ArchiveLocked
+import fcntl
+import os
+import shutil
+import stat
+from os.path import exists, getsize, join
+import zipfile
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class TestZipWriter(IsignBaseTest):
+
+    def test_write_archive(self):
+        """ untouched members are copied byte for byte, changed and new ones are compressed """
+        target_dir = self.get_temp_dir()
+        output_path = self.get_temp_file()
+        try:
+            manifest = zip_reader.extract(self.TEST_IPA_XCODE11, target_dir)
+            app_dir = join(target_dir, 'Payload', 'IsignTestApp.app')
+            with open(join(app_dir, 'Info.plist'), 'ab') as f:
+                f.write('\n')
+            with open(join(app_dir, 'new_file.txt'), 'w') as f:
+                f.write('new')
+            os.unlink(join(app_dir, 'PkgInfo'))
+            zip_writer.write_archive(target_dir, output_path, manifest)
+
+            original = zipfile.ZipFile(self.TEST_IPA_XCODE11)
+            resigned = zipfile.ZipFile(output_path)
+            assert resigned.testzip() is None
+            names = resigned.namelist()
+            assert 'Payload/IsignTestApp.app/new_file.txt' in names
+            assert 'Payload/IsignTestApp.app/PkgInfo' not in names
+            for zinfo in original.infolist():
+                if zinfo.filename == 'Payload/IsignTestApp.app/PkgInfo':
+                    continue
+                new_zinfo = resigned.getinfo(zinfo.filename)
+                if zinfo.filename == 'Payload/IsignTestApp.app/Info.plist':
+                    assert new_zinfo.file_size == zinfo.file_size + 1
+                else:
+                    assert new_zinfo.CRC == zinfo.CRC
+                    assert new_zinfo.compress_size == zinfo.compress_size
+                    assert resigned.read(zinfo.filename) == original.read(zinfo.filename)
+        finally:
+            self.unlink(target_dir)
+            self.unlink(output_path)
+
+    def test_write_directory(self):
+        """ compressing in parallel gives the same members, in the same order, as one worker """
+        target_dir = self.get_temp_dir()
+        serial_path = self.get_temp_file()
+        parallel_path = self.get_temp_file()
+        try:
+            zip_reader.extract(self.TEST_IPA_XCODE11, target_dir)
+            incompressible = join(target_dir, 'Payload', 'IsignTestApp.app', 'random.bin')
+            with open(incompressible, 'wb') as f:
+                f.write(os.urandom(100000))
+            with zip_writer.ZipWriter(serial_path, workers=1) as writer:
+                for path, arcname in zip_writer._walk_arcnames(target_dir):
+                    writer.write_file(path, arcname)
+            zip_writer.write_directory(target_dir, parallel_path)
+
+            serial = zipfile.ZipFile(serial_path)
+            parallel = zipfile.ZipFile(parallel_path)
+            original = zipfile.ZipFile(self.TEST_IPA_XCODE11)
+            assert parallel.testzip() is None
+            assert parallel.namelist() == serial.namelist()
+            assert set(original.namelist()) < set(parallel.namelist())
+            for zinfo in original.infolist():
+                assert parallel.read(zinfo.filename) == original.read(zinfo.filename)
+                assert zip_reader.get_mode(parallel.getinfo(zinfo.filename)) == zip_reader.get_mode(zinfo)
+            random_zinfo = parallel.getinfo('Payload/IsignTestApp.app/random.bin')
+            assert random_zinfo.compress_type == zipfile.ZIP_STORED
+        finally:
+            self.unlink(target_dir)
+            self.unlink(serial_path)
+            self.unlink(parallel_path)
+
+    def test_compression_policy(self):
+        """ compressed formats are stored, everything else is deflated """
+        target_dir = self.get_temp_dir()
+        output_path = self.get_temp_file()
+        try:
+            zip_reader.extract(self.TEST_IPA_XCODE11, target_dir)
+            policy = zip_writer.CompressionPolicy(level=9, store_extensions=zip_writer.STORE_EXTENSIONS)
+            zip_writer.write_directory(target_dir, output_path, policy)
+            resigned = zipfile.ZipFile(output_path)
+            assert resigned.testzip() is None
+            app_name = 'Payload/IsignTestApp.app/'
+            for name in ['Assets.car', 'AppIcon60x60@2x.png']:
+                assert resigned.getinfo(app_name + name).compress_type == zipfile.ZIP_STORED
+            for name in ['Info.plist', 'IsignTestApp']:
+                assert resigned.getinfo(app_name + name).compress_type == zipfile.ZIP_DEFLATED
+        finally:
+            self.unlink(target_dir)
+            self.unlink(output_path)
+
+    def test_compression_policy_keep_original(self):
+        """ changed members can keep the compression method they had """
+        target_dir = self.get_temp_dir()
+        output_path = self.get_temp_file()
+        try:
+            manifest = zip_reader.extract(self.TEST_IPA_XCODE11, target_dir)
+            app_dir = join(target_dir, 'Payload', 'IsignTestApp.app')
+            for name in ['AppIcon60x60@2x.png', 'new.png']:
+                with open(join(app_dir, name), 'ab') as f:
+                    f.write('\0' * 1000)
+            policy = zip_writer.CompressionPolicy(store_extensions=['.PNG'], keep_original=True)
+            zip_writer.write_archive(target_dir, output_path, manifest, policy)
+            resigned = zipfile.ZipFile(output_path)
+            assert resigned.testzip() is None
+            changed = resigned.getinfo('Payload/IsignTestApp.app/AppIcon60x60@2x.png')
+            assert changed.compress_type == zipfile.ZIP_DEFLATED
+            added = resigned.getinfo('Payload/IsignTestApp.app/new.png')
+            assert added.compress_type == zipfile.ZIP_STORED
+        finally:
+            self.unlink(target_dir)
+            self.unlink(output_path)
+
+    def test_resign_copies_unchanged(self):
+        """ after resigning, resources are still compressed exactly as they were """
+        output_path = self.get_temp_file()
+        try:
+            self.resign(self.TEST_IPA_XCODE11, output_path=output_path)
+            original = zipfile.ZipFile(self.TEST_IPA_XCODE11)
+            resigned = zipfile.ZipFile(output_path)
+            assert resigned.testzip() is None
+            asset_name = 'Payload/IsignTestApp.app/Assets.car'
+            assert resigned.getinfo(asset_name).compress_size == original.getinfo(asset_name).compress_size
+        finally:
+            self.unlink(output_path)
+
+    def test_write_archive_selective(self):
+        """ members that were never extracted are copied from the original archive """
+        target_dir = self.get_temp_dir()
+        output_path = self.get_temp_file()
+        try:
+            manifest = zip_reader.extract(self.TEST_IPA_XCODE11, target_dir, selective=True)
+            app_dir = join(target_dir, 'Payload', 'IsignTestApp.app')
+            with open(join(app_dir, 'PkgInfo'), 'w') as f:
+                f.write('APPL????')
+            zip_writer.write_archive(target_dir, output_path, manifest)
+
+            original = zipfile.ZipFile(self.TEST_IPA_XCODE11)
+            resigned = zipfile.ZipFile(output_path)
+            assert resigned.testzip() is None
+            assert resigned.namelist() == original.namelist()
+            asset_name = 'Payload/IsignTestApp.app/Assets.car'
+            assert resigned.read(asset_name) == original.read(asset_name)
+            assert resigned.read('Payload/IsignTestApp.app/PkgInfo') == 'APPL????'
+        finally:
+            self.unlink(target_dir)
+            self.unlink(output_path)
+
+    def test_clone_manifest(self):
+        """ a clone of an extracted archive can still copy unchanged members """
+        archive = archive_factory(self.TEST_IPA_XCODE11)
+        ua = archive.unarchive_to_temp()
+        clone_path = ua.path + '_clone'
+        clone = None
+        try:
+            clone = ua.clone(clone_path)
+            assert clone.manifest.is_unchanged('Payload/IsignTestApp.app/Assets.car')
+            assert not ua.manifest.is_unchanged('Payload/IsignTestApp.app/no_such_file')
+        finally:
+            ua.remove()
+            if clone is not None:
+                clone.remove()
+
+    def test_clone_selective_manifest(self):
+        """ a clone of a selectively extracted archive knows what is still in the archive """
+        archive = archive_factory(self.TEST_IPA_XCODE11)
+        ua = archive.unarchive_to_temp(selective=True)
+        clone_path = ua.path + '_clone'
+        clone = None
+        try:
+            clone = ua.clone(clone_path)
+            app_dir = join(clone_path, 'Payload', 'IsignTestApp.app')
+            assert clone.manifest.get_unextracted_name(join(app_dir, 'Assets.car')) is not None
+            assert clone.manifest.is_unchanged('Payload/IsignTestApp.app/Assets.car')
+        finally:
+            ua.remove()
+            if clone is not None:
+                clone.remove()
+
+    def extract_copy(self, target_dir, ipa_path):
+        """ extract a copy of the test IPA, which we can update in place """
+        shutil.copyfile(self.TEST_IPA_XCODE11, ipa_path)
+        manifest = zip_reader.extract(ipa_path, target_dir)
+        app_dir = join(target_dir, 'Payload', 'IsignTestApp.app')
+        with open(join(app_dir, 'Info.plist'), 'ab') as f:
+            f.write('\n')
+        with open(join(app_dir, 'new_file.txt'), 'w') as f:
+            f.write('new')
+        os.unlink(join(app_dir, 'PkgInfo'))
+        return manifest
+
+    def test_update_archive(self):
+        """ changed members are appended, and nothing that was there is rewritten """
+        target_dir = self.get_temp_dir()
+        ipa_path = self.get_temp_file()
+        try:
+            manifest = self.extract_copy(target_dir, ipa_path)
+            original = zipfile.ZipFile(self.TEST_IPA_XCODE11)
+            zip_writer.update_archive(target_dir, manifest, max_dead_space_ratio=1)
+
+            with open(self.TEST_IPA_XCODE11, 'rb') as f:
+                original_members = f.read(original.start_dir)
+            with open(ipa_path, 'rb') as f:
+                assert f.read(original.start_dir) == original_members
+            updated = zipfile.ZipFile(ipa_path)
+            assert updated.testzip() is None
+            expected_names = [name for name in original.namelist() if name != 'Payload/IsignTestApp.app/PkgInfo']
+            expected_names.append('Payload/IsignTestApp.app/new_file.txt')
+            assert updated.namelist() == expected_names
+            info_name = 'Payload/IsignTestApp.app/Info.plist'
+            assert updated.read(info_name) == original.read(info_name) + '\n'
+            assert updated.getinfo(info_name).header_offset > original.start_dir
+            asset_name = 'Payload/IsignTestApp.app/Assets.car'
+            assert updated.getinfo(asset_name).header_offset == original.getinfo(asset_name).header_offset
+            assert zip_writer.get_dead_space(ipa_path) > 0
+            assert not exists(zip_writer.get_recovery_path(ipa_path))
+        finally:
+            self.unlink(target_dir)
+            self.unlink(ipa_path)
+
+    def test_update_archive_rollback(self):
+        """ if updating fails, the archive is left as it was """
+        target_dir = self.get_temp_dir()
+        ipa_path = self.get_temp_file()
+        compress_file = zip_writer.compress_file
+
+        def fail(*args):
+            raise IOError("no space left on device")
+        try:
+            manifest = self.extract_copy(target_dir, ipa_path)
+            zip_writer.compress_file = fail
+            with self.assertRaises(IOError):
+                zip_writer.update_archive(target_dir, manifest)
+            with open(self.TEST_IPA_XCODE11, 'rb') as original, open(ipa_path, 'rb') as updated:
+                assert updated.read() == original.read()
+            assert not exists(zip_writer.get_recovery_path(ipa_path))
+        finally:
+            zip_writer.compress_file = compress_file
+            self.unlink(target_dir)
+            self.unlink(ipa_path)
+
+    def interrupt_update(self, target_dir, ipa_path):
+        """ Start updating a copy of the test IPA in place, and stop as if we were killed:
+            the members are written, the central directory isn't """
+        manifest = self.extract_copy(target_dir, ipa_path)
+        writer = zip_writer.ZipWriter(ipa_path, append=True)
+        writer.write_file(manifest.get_path('Payload/IsignTestApp.app/new_file.txt'),
+                          'Payload/IsignTestApp.app/new_file.txt')
+        writer._drain()
+        writer.pool.terminate()
+        writer.zipfile_obj.fp.close()
+        # dying drops the lock
+        writer.archive_lock.release()
+        assert exists(zip_writer.get_recovery_path(ipa_path))
+        assert getsize(ipa_path) > getsize(self.TEST_IPA_XCODE11)
+        return manifest
+
+    def test_update_archive_recovers(self):
+        """ if we die while updating, the archive is restored the next time it's updated,
+            but not when it's just read """
+        target_dir = self.get_temp_dir()
+        ipa_path = self.get_temp_file() + '.ipa'
+        try:
+            manifest = self.interrupt_update(target_dir, ipa_path)
+            interrupted_size = getsize(ipa_path)
+            with archive_factory(ipa_path) as archive:
+                assert archive.bundle_info['CFBundleName'] == 'IsignTestApp'
+            assert getsize(ipa_path) == interrupted_size
+            assert exists(zip_writer.get_recovery_path(ipa_path))
+
+            assert zip_writer.recover_archive(ipa_path) is True
+            assert not exists(zip_writer.get_recovery_path(ipa_path))
+            with open(self.TEST_IPA_XCODE11, 'rb') as original, open(ipa_path, 'rb') as recovered:
+                assert recovered.read() == original.read()
+            assert zip_writer.recover_archive(ipa_path) is False
+            zip_writer.update_archive(target_dir, manifest, max_dead_space_ratio=1)
+            assert zipfile.ZipFile(ipa_path).testzip() is None
+        finally:
+            self.unlink(target_dir)
+            self.unlink(ipa_path)
+
+    def test_update_archive_locked(self):
+        """ while another process updates an archive, we neither update nor recover it """
+        target_dir = self.get_temp_dir()
+        ipa_path = self.get_temp_file() + '.ipa'
+        try:
+            manifest = self.interrupt_update(target_dir, ipa_path)
+            interrupted_size = getsize(ipa_path)
+            # a lock taken through another open file is as good as another process's
+            with open(ipa_path, 'rb') as other:
+                fcntl.flock(other.fileno(), fcntl.LOCK_EX)
+                assert zip_writer.recover_archive(ipa_path) is False
+                with self.assertRaises(ArchiveLocked):
+                    zip_writer.update_archive(target_dir, manifest)
+                assert getsize(ipa_path) == interrupted_size
+                assert exists(zip_writer.get_recovery_path(ipa_path))
+            assert zip_writer.recover_archive(ipa_path) is True
+            assert not zip_writer.ArchiveLock.held
+        finally:
+            self.unlink(target_dir)
+            self.unlink(ipa_path)
+
+    def test_update_archive_compacts(self):
+        """ an archive that is mostly dead space gets rewritten without it """
+        target_dir = self.get_temp_dir()
+        ipa_path = self.get_temp_file()
+        try:
+            manifest = self.extract_copy(target_dir, ipa_path)
+            os.chmod(ipa_path, 0o640)
+            zip_writer.update_archive(target_dir, manifest, max_dead_space_ratio=0)
+            assert zip_writer.get_dead_space(ipa_path) == 0
+            assert stat.S_IMODE(os.stat(ipa_path).st_mode) == 0o640
+            updated = zipfile.ZipFile(ipa_path)
+            assert updated.testzip() is None
+            assert updated.read('Payload/IsignTestApp.app/new_file.txt') == 'new'
+            assert 'Payload/IsignTestApp.app/PkgInfo' not in updated.namelist()
+        finally:
+            self.unlink(target_dir)
+            self.unlink(ipa_path)
+
+    def test_copy_truncated_member(self):
+        """ copying a member whose data was cut short fails, rather than writing a broken archive """
+        source_path = self.get_temp_file()
+        output_path = self.get_temp_file()
+        try:
+            with zipfile.ZipFile(source_path, 'w', zipfile.ZIP_STORED) as source:
+                source.writestr('member', 'x' * 1000)
+            zinfo = zipfile.ZipFile(source_path).getinfo('member')
+            with open(source_path, 'r+b') as f:
+                f.truncate(zip_writer.get_data_offset(f, zinfo) + 500)
+            with self.assertRaises(zipfile.BadZipfile):
+                with open(source_path, 'rb') as source_fp, zip_writer.ZipWriter(output_path) as writer:
+                    writer.copy_member(source_fp, zinfo)
+        finally:
+            self.unlink(source_path)
+            self.unlink(output_path)
+
+    def test_resign_in_place(self):
+        """ resigning an IPA in place updates it """
+        ipa_path = self.get_temp_file() + '.ipa'
+        try:
+            shutil.copyfile(self.TEST_IPA_XCODE11, ipa_path)
+            self.resign(ipa_path, output_path=ipa_path)
+            resigned = zipfile.ZipFile(ipa_path)
+            assert resigned.testzip() is None
+            assert resigned.namelist() == zipfile.ZipFile(self.TEST_IPA_XCODE11).namelist()
+        finally:
+            self.unlink(ipa_path)